@@ -9,20 +9,24 @@ import tornado
 from tornado.web import UIModule, StaticFileHandler
 from tornado import web, iostream
 from tornado.ioloop import IOLoop
-from tornado.locks import Condition
+from tornado.locks import Condition, Semaphore as AsynSemaphore, Lock as AsynLock
+from tornado.util import TimeoutError as AsynTimeoutError
+from tornado.queues import LifoQueue as AsynLifoQueue, QueueEmpty as AsynQueueEmpty
 from tornado.options import options, define
-from tornado.process import Subprocess
+from tornado.process import Subprocess, fork_processes
+from tornado.netutil import bind_sockets
 from tornado.concurrent import run_on_executor, Future
 from tornado import gen, web, httpserver, ioloop
-from tornado.gen import coroutine, Return, Task, sleep
+from tornado.gen import coroutine, Return, Task, sleep, maybe_future
 from tornado.httpclient import HTTPClient, AsyncHTTPClient, HTTPError, HTTPRequest
 
 from kombu import Queue as RMQueue, Exchange
-from celery.exceptions import Ignore
+from celery.exceptions import Ignore, TimeoutError as CeleryTimeoutError
 from celery import Task as CeleryTask, platforms, Celery, task, states
 from celery.schedules import crontab
 
-from thrift.server import TServer
+from thrift import TTornado
+from thrift.server import TServer, TNonblockingServer
 from thrift.transport import TSocket
 from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol, TCompactProtocol
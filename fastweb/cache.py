@@ -1,90 +1,819 @@
 # encoding:utf-8
 
+"""缓存模块
+
+读穿透缓存装饰器,被装饰函数的返回值序列化后以一个key存入redis
+命中时只需要一次GET,未命中时调用函数并写入缓存
+可选的进程内LocalCache作为一级缓存,失效消息通过redis发布订阅广播到所有进程
+QueryCache用于mysql查询结果缓存,按表标签失效
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import pickle
+import random
+import threading
 from functools import wraps
+from hashlib import sha1
+from collections import OrderedDict
+
+import redis
 
-from fastweb.util.python import dict2sequence, list2sequence
-from fastweb.accesspoint import coroutine
+import fastweb.manager
+from fastweb.util.log import recorder
+from fastweb.util.thread import FThread
+from fastweb.components import PendingComponent
+from fastweb.accesspoint import coroutine, Return, maybe_future
+from fastweb.exception import RedisError, ParameterError
 from fastweb.component.db.rds import SyncRedis, AsynRedis
 
+# 提前刷新的默认系数,为0时不提前刷新
+DEFAULT_BETA = 1.0
+# 一级缓存默认最大条目数
+DEFAULT_LOCAL_MAXSIZE = 1024
+# 一级缓存默认过期时间(秒),限制没有失效广播时数据不一致的时间
+DEFAULT_LOCAL_TTL = 5
+# 缓存失效广播频道
+DEFAULT_INVALIDATE_CHANNEL = 'fastweb:cache:invalidate'
+# 订阅线程每次等待消息的时间(秒),关闭时最多等待一个周期
+INVALIDATE_POLL = 0.1
+# 查询缓存默认过期时间(秒)
+DEFAULT_QUERY_EXPIRE = 60
+# 查询缓存key前缀
+DEFAULT_QUERY_PREFIX = 'fastweb:sql:'
+
+# sql中的表名,包括FROM/JOIN后逗号分隔的多个表
+_TABLE_NAME = r'(?:`?\w+`?\.)?`?\w+`?(?:\s+(?:as\s+)?\w+)?'
+_TABLE_RE = re.compile(r'\b(?:from|join|into|update|table)\s+({name}(?:\s*,\s*{name})*)'.format(name=_TABLE_NAME),
+                       re.IGNORECASE)
+# 会修改数据的语句
+_WRITE_STATEMENTS = ('insert', 'update', 'delete', 'replace', 'truncate', 'alter', 'drop', 'create', 'rename', 'load')
+
+
+class JsonCodec(object):
+    """json序列化"""
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, separators=(',', ':'))
+
+    @staticmethod
+    def loads(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class PickleCodec(object):
+    """pickle序列化,只能用于可信的数据"""
+
+    name = 'pickle'
+
+    @staticmethod
+    def dumps(value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(object):
+    """msgpack序列化,需要安装msgpack"""
+
+    name = 'msgpack'
+
+    @staticmethod
+    def dumps(value):
+        import msgpack
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        import msgpack
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, PickleCodec, MsgpackCodec)}
+
+
+def get_codec(codec):
+    """根据名称获取序列化方式,也可以直接传入实现了dumps/loads的对象"""
+
+    if hasattr(codec, 'dumps') and hasattr(codec, 'loads'):
+        return codec
+
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ParameterError('unsupported cache codec [{codec}]'.format(codec=codec))
+
+
+class SyncSingleFlight(object):
+    """同一个key的并发调用只执行一次,其余线程等待并共享结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _SyncCall()
+
+        if not leader:
+            call.event.wait()
+            if call.exc_info:
+                raise call.exc_info[1]
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class _SyncCall(object):
+    __slots__ = ('event', 'result', 'exc_info')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class AsynSingleFlight(object):
+    """同一个key的并发调用只执行一次,其余协程等待同一个future"""
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, fn):
+        future = self._calls.get(key)
+
+        if future is None:
+            future = self._calls[key] = maybe_future(fn())
+            future.add_done_callback(lambda f: self._calls.get(key) is f and self._calls.pop(key))
+        return future
+
+
+class LocalCache(object):
+    """进程内一级缓存,LRU淘汰,支持过期时间和内存占用限制
+
+    内存占用按缓存值序列化后的长度计算
+    返回的是共享对象,调用方不要修改
+
+    :parameter:
+      - `maxsize`:最大条目数
+      - `ttl`:过期时间(秒),为None时只受二级缓存过期时间限制
+      - `maxmemory`:最大内存占用(字节),为None时不限制
+    """
+
+    def __init__(self, maxsize=DEFAULT_LOCAL_MAXSIZE, ttl=DEFAULT_LOCAL_TTL, maxmemory=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxmemory = maxmemory
+        self.memory = 0
+
+        # key -> (value, expire_at, size)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hit': 0, 'miss': 0, 'expire': 0, 'evict': 0, 'invalidate': 0}
+
+    def __str__(self):
+        return '<LocalCache {size}/{maxsize} {memory}B>'.format(size=len(self._data), maxsize=self.maxsize,
+                                                              memory=self.memory)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        """获取缓存,返回(是否命中, 值)"""
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is not None and entry[1] and entry[1] <= time.time():
+                self._remove(key)
+                self._stats['expire'] += 1
+                entry = None
+
+            if entry is None:
+                self._stats['miss'] += 1
+                return False, None
+
+            # 移到队尾,队首为最久未使用
+            self._data[key] = self._data.pop(key)
+            self._stats['hit'] += 1
+            return True, entry[0]
+
+    def set(self, key, value, size=0, ttl=None):
+        """写入缓存
+
+        :parameter:
+          - `size`:缓存值占用的内存
+          - `ttl`:过期时间(秒),与自身的ttl取较小值
+        """
+
+        ttl = min(t for t in (ttl, self.ttl) if t) if ttl or self.ttl else None
+
+        with self._lock:
+            self._remove(key)
+
+            if self.maxmemory and size > self.maxmemory:
+                return
+
+            self._data[key] = (value, time.time() + ttl if ttl else 0, size)
+            self.memory += size
+
+            while self._data and (len(self._data) > self.maxsize or
+                                  (self.maxmemory and self.memory > self.maxmemory)):
+                self._remove(next(iter(self._data)))
+                self._stats['evict'] += 1
+
+    def delete(self, key):
+        """删除缓存"""
+
+        with self._lock:
+            if self._remove(key):
+                self._stats['invalidate'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.memory = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.memory -= entry[2]
+            return True
+        return False
+
+    def stats(self):
+        """缓存统计信息"""
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+            stats['memory'] = self.memory
+
+        total = stats['hit'] + stats['miss']
+        stats['hit_ratio'] = float(stats['hit']) / total if total else 0
+        return stats
+
+
+class LocalInvalidator(object):
+    """进程内失效广播,用于测试或单进程部署"""
+
+    def __init__(self):
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        """订阅失效消息,callback参数为失效的key"""
+
+        self._callbacks.append(callback)
+
+    def publish(self, storage, key):
+        """广播失效消息"""
+
+        for callback in self._callbacks:
+            callback(key)
+
+    def check(self):
+        """读一级缓存前调用,检查订阅是否可用"""
+
+
+class RedisInvalidator(LocalInvalidator):
+    """基于redis发布订阅的失效广播
+
+    发布通过缓存使用的redis组件完成,订阅在后台线程中使用独立的连接
+    fork之后子进程第一次使用时重新订阅并启动订阅线程
+
+    :parameter:
+      - `setting`:订阅连接的redis参数,同redis.StrictRedis
+      - `channel`:广播频道
+    """
+
+    def __init__(self, setting=None, channel=DEFAULT_INVALIDATE_CHANNEL, **kwargs):
+        super(RedisInvalidator, self).__init__()
+        self.setting = dict(setting or {}, **kwargs)
+        self.channel = channel
+        self._pubsub = None
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._pubsub = redis.StrictRedis(**self.setting).pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+        self._thread = FThread(name='cache-invalidator', task=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def subscribe(self, callback):
+        super(RedisInvalidator, self).subscribe(callback)
+
+        if self._thread is None:
+            self._start()
+
+    def check(self):
+        """fork之后的子进程中没有订阅线程,重新订阅
+
+        继承的订阅连接与父进程共用socket,子进程中不使用也不关闭
+        """
+
+        if self._thread is not None and self._pid != os.getpid():
+            self._start()
+
+    def publish(self, storage, key):
+        self.check()
+        return storage.execute('PUBLISH', self.channel, key)
+
+    def _listen(self, thread):
+        try:
+            message = self._pubsub.get_message(timeout=INVALIDATE_POLL)
+        except redis.ConnectionError as e:
+            recorder('WARN', '{obj} subscribe error ({e})'.format(obj=self, e=e))
+            time.sleep(1)
+            return
+
+        if message and message['type'] == 'message':
+            key = message['data']
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            for callback in self._callbacks:
+                callback(key)
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            # 等待订阅线程退出后再关闭连接,避免两个线程同时操作连接
+            self._thread.join(INVALIDATE_POLL * 10)
+            self._pubsub.close()
+            self._thread = None
+
+    def __str__(self):
+        return '<RedisInvalidator {channel}>'.format(channel=self.channel)
+
 
 class cache(object):
-    def __init__(self, storage, key, expire=None):
-        self._storage = storage
-        self._storage_obj = None
-        self._expire = expire
-        self._key = key
-        self._rkey = None
+    """读穿透缓存装饰器
+
+    被装饰的函数第一个参数为持有存储组件的对象(如Api/Page/Handler),key由其余参数格式化得到
+    存储组件为AsynRedis时被装饰函数需为协程,调用返回future;为SyncRedis时同步返回结果
+
+    缓存值中保存了计算耗时和过期时间,命中时按概率提前刷新(XFetch),越接近过期刷新概率越高
+    设置local后先读进程内一级缓存,未命中再读redis
+
+    :parameter:
+      - `storage`:存储组件在对象上的属性名,或直接传入redis组件
+      - `key`:缓存key模板,使用str.format格式化函数参数
+      - `expire`:过期时间(秒),为None时不过期
+      - `codec`:序列化方式,json/msgpack/pickle
+      - `beta`:提前刷新系数,越大越倾向提前刷新,为0时不提前刷新
+      - `local`:一级缓存,LocalCache实例,为True时使用默认配置
+      - `invalidator`:失效广播,LocalInvalidator或RedisInvalidator,update/invalidate时通知所有进程删除一级缓存
+
+    被装饰函数上附加的方法:
+      - `invalidate(obj, *args, **kwargs)`:删除缓存
+      - `update(obj, value, *args, **kwargs)`:写入缓存
+    """
+
+    def __init__(self, storage, key, expire=None, codec='json', beta=DEFAULT_BETA, local=None, invalidator=None):
+        self.storage = storage
+        self.key = key
+        self.expire = expire
+        self.codec = get_codec(codec)
+        self.beta = beta if expire else 0
+        self.local = LocalCache() if local is True else local
+        self.invalidator = invalidator
+
+        if self.local is not None and self.invalidator is not None:
+            self.invalidator.subscribe(self.local.delete)
+
+        self._sync_flight = SyncSingleFlight()
+        self._asyn_flight = AsynSingleFlight()
 
     def __call__(self, func):
-        @coroutine
         @wraps(func)
-        def wrapped_func(cls, *args):
-            key = self._key.format(*args)
-            storage = getattr(cls, self._storage)
-            self._storage_obj = storage
-            self._rkey = key
-            if isinstance(self._storage_obj, AsynRedis):
-                info = yield AsynCache.read(cls, self._storage_obj, key, func, args, self)
-                return info
-            elif isinstance(self._storage_obj, SyncRedis):
-                SyncCache.read(cls, self._storage_obj, key, func, args, self)
+        def wrapped_func(obj, *args, **kwargs):
+            storage = self.get_storage(obj)
+            if isinstance(storage, PendingComponent):
+                return self._acquired(storage, wrapped_func, obj, *args, **kwargs)
+            key = self.make_key(*args, **kwargs)
+
+            if self.local is not None:
+                if self.invalidator is not None:
+                    self.invalidator.check()
+                hit, value = self.local.get(key)
+                if hit:
+                    return maybe_future(value) if isinstance(storage, AsynRedis) else value
+
+            if isinstance(storage, AsynRedis):
+                return self._asyn_read(storage, key, func, obj, args, kwargs)
+            elif isinstance(storage, SyncRedis):
+                return self._sync_read(storage, key, func, obj, args, kwargs)
+            else:
+                raise ParameterError('cache storage must be redis component [{storage}]'.format(storage=storage))
+
+        def invalidate(obj, *args, **kwargs):
+            storage = self.get_storage(obj)
+            if isinstance(storage, PendingComponent):
+                return self._acquired(storage, invalidate, obj, *args, **kwargs)
+            key = self.make_key(*args, **kwargs)
+            return self._write(storage, key, ('DEL', key))
+
+        def update(obj, value, *args, **kwargs):
+            storage = self.get_storage(obj)
+            if isinstance(storage, PendingComponent):
+                return self._acquired(storage, update, obj, value, *args, **kwargs)
+            key = self.make_key(*args, **kwargs)
+            return self._write(storage, key, self._set_command(key, self._dump(value, 0)))
+
+        wrapped_func.invalidate = invalidate
+        wrapped_func.update = update
+        wrapped_func.cache = self
         return wrapped_func
 
+    @staticmethod
     @coroutine
-    def update(self, data):
-        if isinstance(self._storage_obj, AsynRedis):
-            info = yield AsynCache.update(self._storage_obj, self._rkey, data)
-            return info
-        elif isinstance(self._storage_obj, SyncRedis):
-            SyncCache.update(self._storage_obj, self._rkey, data)
+    def _acquired(pending, func, *args, **kwargs):
+        """等待获取异步连接池中的storage后再调用func,func中从宿主的组件缓冲池取得storage"""
 
+        yield pending.acquire()
+        ret = yield func(*args, **kwargs)
+        raise Return(ret)
 
-class AsynCache(cache):
+    def get_storage(self, obj):
+        if isinstance(self.storage, str):
+            return getattr(obj, self.storage)
+        return self.storage
+
+    def make_key(self, *args, **kwargs):
+        return self.key.format(*args, **kwargs)
+
+    def _load(self, storage, key, data):
+        """解析缓存值,返回(是否可用, 值, 过期时间)
+
+        不可用包括未命中,解析失败,以及按概率决定提前刷新
+        """
+
+        if data is None:
+            return False, None, 0
+
+        try:
+            value, delta, expire_at = self.codec.loads(data)
+        except Exception as e:
+            storage.recorder('WARN', 'cache {key} load failed [{msg}]'.format(key=key, msg=e))
+            return False, None, 0
+
+        if self.beta and expire_at and time.time() - delta * self.beta * math.log(random.random() or 1e-12) >= expire_at:
+            storage.recorder('DEBUG', 'cache {key} early refresh'.format(key=key))
+            return False, value, expire_at
+
+        return True, value, expire_at
+
+    def _dump(self, value, delta):
+        """序列化缓存值,值中保存计算耗时和过期时间用于提前刷新"""
+
+        expire_at = time.time() + self.expire if self.expire else 0
+        return self.codec.dumps([value, delta, expire_at])
+
+    def _set_command(self, key, data):
+        if self.expire:
+            return 'SET', key, data, 'EX', int(math.ceil(self.expire))
+        return 'SET', key, data
+
+    def _keep(self, key, value, data, expire_at=0):
+        """写入一级缓存"""
+
+        if self.local is not None:
+            ttl = expire_at - time.time() if expire_at else self.expire
+            self.local.set(key, value, len(data), ttl)
+
+    def _write(self, storage, key, command):
+        """执行写命令,删除一级缓存并广播失效"""
+
+        if isinstance(storage, AsynRedis):
+            return self._asyn_write(storage, key, command)
+
+        response = storage.execute(*command)
+        self._expire_local(storage, key)
+        return response
 
-    @staticmethod
     @coroutine
-    def read(cls, storage, key, fn, args, obj):
-        """从缓存中读取"""
-        ist = yield storage.query("EXISTS {}".format(key))
-        if ist:
-            _type = yield storage.query("TYPE {}".format(key))
-            if _type == 'hash':
-                info = yield storage.query("HGETALL {}".format(key))
-                return info
-            elif _type == 'list':
-                info = yield storage.query("LRANGE {} 0 -1".format(key))
-                return info
-        else:
-            r = yield fn(cls, *args, __cache__=obj)
-            return r
+    def _asyn_write(self, storage, key, command):
+        response = yield storage.execute(*command)
+        yield maybe_future(self._expire_local(storage, key))
+        raise Return(response)
+
+    def _expire_local(self, storage, key):
+        if self.local is not None:
+            self.local.delete(key)
+        if self.invalidator is not None:
+            return self.invalidator.publish(storage, key)
+
+    def _sync_read(self, storage, key, func, obj, args, kwargs):
+        try:
+            data = storage.execute('GET', key)
+            hit, value, expire_at = self._load(storage, key, data)
+        except RedisError:
+            hit, value = False, None
+
+        if hit:
+            self._keep(key, value, data, expire_at)
+            return value
+
+        def load():
+            start = time.time()
+            value = func(obj, *args, **kwargs)
+            data = self._dump(value, time.time() - start)
+            try:
+                storage.execute(*self._set_command(key, data))
+            except RedisError:
+                storage.recorder('WARN', 'cache {key} store failed'.format(key=key))
+            self._keep(key, value, data)
+            return value
+
+        return self._sync_flight.do(key, load)
 
-    @staticmethod
     @coroutine
-    def update(storage, key, data):
-        """更新缓存"""
+    def _asyn_read(self, storage, key, func, obj, args, kwargs):
+        try:
+            data = yield storage.execute('GET', key)
+            hit, value, expire_at = self._load(storage, key, data)
+        except RedisError:
+            hit, value = False, None
+
+        if hit:
+            self._keep(key, value, data, expire_at)
+            raise Return(value)
+
+        @coroutine
+        def load():
+            start = time.time()
+            value = yield maybe_future(func(obj, *args, **kwargs))
+            data = self._dump(value, time.time() - start)
+            try:
+                yield storage.execute(*self._set_command(key, data))
+            except RedisError:
+                storage.recorder('WARN', 'cache {key} store failed'.format(key=key))
+            self._keep(key, value, data)
+            raise Return(value)
+
+        value = yield self._asyn_flight.do(key, load)
+        raise Return(value)
+
+
+class QueryCache(object):
+    """mysql查询结果缓存
+
+    key为规范化的sql及参数的摘要,值为序列化后的结果集
+    每个表对应一个标签集合,记录引用了该表的缓存key,写操作时按表删除这些缓存
+    同一个storage和过期时间的组件共享一个QueryCache,统计信息也是共享的
+
+    :parameter:
+      - `storage`:redis组件名称(通过Manager获取),或直接传入redis组件
+      - `expire`:过期时间(秒)
+      - `codec`:序列化方式,结果集中常有datetime/Decimal,默认使用pickle
+      - `prefix`:key前缀
+    """
 
-        if isinstance(data, dict):
-            data_sequence = dict2sequence(data)
-            yield storage.query("HMSET {} {}".format(key, data_sequence))
-        elif isinstance(data, list):
-            data_sequence = list2sequence(data)
-            yield storage.query("LPUSH {} {}".format(key, data_sequence))
+    _caches = {}
 
+    def __init__(self, storage, expire=DEFAULT_QUERY_EXPIRE, codec='pickle', prefix=DEFAULT_QUERY_PREFIX):
+        self.storage = storage
+        self.expire = expire
+        self.codec = get_codec(codec)
+        self.prefix = prefix
 
-class SyncCache(object):
+        self._lock = threading.Lock()
+        self._stats = {'hit': 0, 'miss': 0, 'store': 0, 'invalidate': 0, 'saved_time': 0.0}
+
+    def __str__(self):
+        return '<QueryCache {storage} {expire}>'.format(storage=self.storage, expire=self.expire)
+
+    @classmethod
+    def get(cls, storage, expire=DEFAULT_QUERY_EXPIRE):
+        """获取共享的QueryCache"""
+
+        key = (storage, expire)
+        query_cache = cls._caches.get(key)
+
+        if query_cache is None:
+            query_cache = cls._caches.setdefault(key, cls(storage, expire))
+        return query_cache
+
+    @staticmethod
+    def normalize(sql):
+        """合并空白字符,去掉结尾的分号"""
+
+        return ' '.join(sql.split()).rstrip(';').rstrip()
+
+    @staticmethod
+    def parse_tables(sql):
+        """解析sql中引用的表名,去掉库名和反引号"""
+
+        tables = set()
+
+        for group in _TABLE_RE.findall(sql):
+            for name in group.split(','):
+                tables.add(name.split()[0].replace('`', '').split('.')[-1].lower())
+        return tables
 
     @staticmethod
-    def read(cls, storage, key, fn, args):
-        ist = storage.query("EXISTS {}".format(key))
-        if ist:
-            info = storage.query("HGETALL {}".format(key))
-            return info
+    def is_cacheable(sql):
+        """只缓存不加锁的SELECT语句"""
+
+        sql = sql.lstrip().lower()
+        return sql.startswith('select') and 'for update' not in sql and 'lock in share mode' not in sql
 
     @staticmethod
-    def update(cls, storage, key):
-        """更新缓存"""
-        pass
+    def is_write(sql):
+        parts = sql.split(None, 1)
+        return bool(parts) and parts[0].lower() in _WRITE_STATEMENTS
+
+    def make_key(self, sql, args=None):
+        args = json.dumps(args, sort_keys=True, default=str) if args is not None else ''
+        digest = sha1('{sql}\0{args}'.format(sql=self.normalize(sql), args=args).encode('utf-8')).hexdigest()
+        return '{prefix}{digest}'.format(prefix=self.prefix, digest=digest)
+
+    def tag(self, table):
+        return '{prefix}table:{table}'.format(prefix=self.prefix, table=table)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _load(self, data):
+        """解析缓存值,返回(是否命中, 结果集)"""
+
+        if data is None:
+            self._count('miss')
+            return False, None
+
+        try:
+            rows, delta = self.codec.loads(data)
+        except Exception as e:
+            recorder('WARN', '{obj} load failed [{msg}]'.format(obj=self, msg=e))
+            self._count('miss')
+            return False, None
+
+        with self._lock:
+            self._stats['hit'] += 1
+            self._stats['saved_time'] += delta
+        return True, rows
+
+    def _store_commands(self, sql, args, rows, delta):
+        key = self.make_key(sql, args)
+        commands = [('SET', key, self.codec.dumps([list(rows), delta]), 'EX', self.expire)]
+
+        for table in self.parse_tables(sql):
+            commands.append(('SADD', self.tag(table), key))
+            commands.append(('EXPIRE', self.tag(table), self.expire))
+        return commands
+
+    def _borrow(self, owner):
+        if isinstance(self.storage, str):
+            return fastweb.manager.Manager.get_component(self.storage, owner)
+        return self.storage
+
+    def _giveback(self, storage):
+        if isinstance(self.storage, str):
+            fastweb.manager.Manager.return_component(self.storage, storage)
+
+    def get_sync(self, owner, sql, args=None):
+        """读取缓存,返回(是否命中, 结果集)"""
+
+        storage = self._borrow(owner)
+
+        try:
+            return self._load(storage.execute('GET', self.make_key(sql, args)))
+        except RedisError:
+            self._count('miss')
+            return False, None
+        finally:
+            self._giveback(storage)
+
+    def set_sync(self, owner, sql, args, rows, delta):
+        """写入缓存
+
+        :parameter:
+          - `delta`:查询耗时(秒),命中时累加到saved_time
+        """
+
+        storage = self._borrow(owner)
+
+        try:
+            storage.batch(self._store_commands(sql, args, rows, delta))
+            self._count('store')
+        except RedisError:
+            recorder('WARN', '{obj} store failed\n{sql}'.format(obj=self, sql=sql))
+        finally:
+            self._giveback(storage)
+
+    def invalidate_sync(self, owner, tables):
+        """删除引用了这些表的缓存"""
+
+        if not tables:
+            return
+
+        storage = self._borrow(owner)
+        tags = [self.tag(table) for table in tables]
+
+        try:
+            keys = storage.batch([('SMEMBERS', tag) for tag in tags])
+            storage.execute('DEL', *(tags + [key for members in keys for key in members]))
+            self._count('invalidate')
+        except RedisError:
+            recorder('WARN', '{obj} invalidate failed {tables}'.format(obj=self, tables=tables))
+        finally:
+            self._giveback(storage)
+
+    @coroutine
+    def _asyn_borrow(self, owner):
+        if isinstance(self.storage, str):
+            storage = yield fastweb.manager.Manager.acquire_component(self.storage, owner)
+            raise Return(storage)
+        raise Return(self.storage)
+
+    @coroutine
+    def get_asyn(self, owner, sql, args=None):
+        """读取缓存,返回(是否命中, 结果集)"""
+
+        storage = yield self._asyn_borrow(owner)
+
+        try:
+            data = yield storage.execute('GET', self.make_key(sql, args))
+            raise Return(self._load(data))
+        except RedisError:
+            self._count('miss')
+            raise Return((False, None))
+        finally:
+            self._giveback(storage)
+
+    @coroutine
+    def set_asyn(self, owner, sql, args, rows, delta):
+        """写入缓存"""
+
+        storage = yield self._asyn_borrow(owner)
+
+        try:
+            yield storage.batch(self._store_commands(sql, args, rows, delta))
+            self._count('store')
+        except RedisError:
+            recorder('WARN', '{obj} store failed\n{sql}'.format(obj=self, sql=sql))
+        finally:
+            self._giveback(storage)
+
+    @coroutine
+    def invalidate_asyn(self, owner, tables):
+        """删除引用了这些表的缓存"""
+
+        if not tables:
+            return
+
+        storage = yield self._asyn_borrow(owner)
+        tags = [self.tag(table) for table in tables]
 
+        try:
+            keys = yield storage.batch([('SMEMBERS', tag) for tag in tags])
+            yield storage.execute('DEL', *(tags + [key for members in keys for key in members]))
+            self._count('invalidate')
+        except RedisError:
+            recorder('WARN', '{obj} invalidate failed {tables}'.format(obj=self, tables=tables))
+        finally:
+            self._giveback(storage)
 
+    def stats(self):
+        """命中率及节省的数据库时间"""
 
+        with self._lock:
+            stats = dict(self._stats)
 
+        total = stats['hit'] + stats['miss']
+        stats['hit_ratio'] = float(stats['hit']) / total if total else 0
+        return stats
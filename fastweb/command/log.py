@@ -0,0 +1,48 @@
+# coding:utf8
+
+
+"""fastweb structured log tool
+
+Usage:
+    fastlog index <logpath>...
+    fastlog trace [--exact] [--raw] <logpath> <requestid>
+
+Options:
+    -h --help     Show this screen.
+    --exact       Only records of the requestid, without task/service ids derived from it.
+    --raw         Print records as json lines.
+"""
+
+
+import json
+
+from fastweb.accesspoint import docopt
+from fastweb.util.tool import timing
+from fastweb.util.log import console_recorder
+from fastweb.util.logindex import log_files, build_index, trace
+
+
+def main():
+    args = docopt(__doc__)
+
+    if args['index']:
+        for path in args['<logpath>']:
+            for log in log_files(path):
+                with timing('ms', 3) as t:
+                    idx = build_index(log)
+                console_recorder('INFO', 'index {log} -> {idx} -- {t}'.format(log=log, idx=idx, t=t))
+        return
+
+    path = args['<logpath>'][0]
+    with timing('ms', 3) as t:
+        records = trace(path, args['<requestid>'], exact=args['--exact'])
+
+    if args['--raw']:
+        for record in records:
+            print(json.dumps(record, ensure_ascii=False))
+        return
+
+    for record in records:
+        print('[{requestid}] [{level}] {ts:.6f} {component}.{op} {latency}\n{msg}'.format(**record))
+    console_recorder('INFO', '{count} records of <{requestid}> -- {t}'.format(count=len(records),
+                                                                            requestid=args['<requestid>'], t=t))
@@ -2,6 +2,7 @@
 
 
 from fastweb.util.log import recorder
+from fastweb.util.tool import timing
 from fastweb.exception import ConfigurationError
 
 
@@ -85,6 +86,21 @@ class Component(object):
         self.owner = owner
         self.recorder = owner.recorder
 
+    def span(self, op, sink=None, unit='s', precision=10):
+        """组件调用计时
+
+        宿主有调用树时记录为宿主当前span的子节点,名称为(组件名称, op),否则只计时
+
+        :parameter:
+          - `op`:操作
+          - `sink`:接收耗时(秒)的对象,如指标直方图
+        """
+
+        spans = getattr(self.owner, 'spans', None)
+        if spans is None:
+            return timing(unit, precision, sink)
+        return spans.span((self.name, op), unit, precision, sink)
+
     def set_error(self, ex):
         """设置为错误状态,等待回收"""
 
@@ -7,8 +7,9 @@ from motor import motor_tornado
 from tornado.gen import coroutine, Return
 from pymongo.errors import ConnectionFailure
 
-import fastweb.util.tool as tool
 from fastweb.util.python import dumps
+from fastweb.util.log import lazy, log_fields
+from fastweb.util.metrics import COMPONENT_CALL
 from fastweb.exception import MongoError
 from fastweb.component import Component
 
@@ -123,14 +124,15 @@ class SyncMongo(Mongo):
             self.recorder('CRITICAL', 'please select db first!')
 
         shell_command = 'db.runCommand(\n{cmd}\n)'.format(cmd=dumps(command, indent=4, whole=4))
-        self.recorder('INFO', '{obj} command start\n{cmd}'.format(obj=self, cmd=shell_command))
+        self.recorder('INFO', lazy('{obj} command start\n{cmd}', obj=self, cmd=shell_command))
         try:
-            with tool.timing('s', 10) as t:
+            with self.span('command', COMPONENT_CALL.labels(self.name, 'command')) as t:
                 response = self._db.command(command=command, value=value, check=check, allowable_errors=allowable_errors, **kwargs)
         except pymongo.errors.PyMongoError as e:
             self.recorder('ERROR', '{obj} command error [{msg}]'.format(obj=self, msg=e))
             raise MongoError
-        self.recorder('INFO', '{obj} command successful\n{cmd} -- {time}'.format(obj=self, cmd=shell_command, time=t))
+        self.recorder('INFO', log_fields(lazy('{obj} command successful\n{cmd} -- {time}', obj=self, cmd=shell_command,
+                                              time=t), self.name, 'command', t))
 
         self._response = self._parse_response(response)
         return self._response
@@ -174,15 +176,16 @@ class AsynMongo(Mongo):
             self.recorder('CRITICAL', 'please select db first!')
 
         shell_command = 'db.runCommand(\n{cmd}\n)'.format(cmd=dumps(command, indent=4, whole=4))
-        self.recorder('INFO', '{obj} command start\n{cmd}'.format(obj=self, cmd=shell_command))
+        self.recorder('INFO', lazy('{obj} command start\n{cmd}', obj=self, cmd=shell_command))
         try:
-            with tool.timing('s', 10) as t:
+            with self.span('command', COMPONENT_CALL.labels(self.name, 'command')) as t:
                 response = yield self._db.command(command=command, value=value, check=check,
                                                   allowable_errors=allowable_errors, **kwargs)
         except pymongo.errors.PyMongoError as e:
             self.recorder('ERROR', '{obj} command error [{msg}]'.format(obj=self, msg=e))
             raise MongoError
-        self.recorder('INFO', '{obj} command successful\n{cmd} -- {time}'.format(obj=self, cmd=shell_command, time=t))
+        self.recorder('INFO', log_fields(lazy('{obj} command successful\n{cmd} -- {time}', obj=self, cmd=shell_command,
+                                              time=t), self.name, 'command', t))
 
         self._response = self._parse_response(response)
         raise Return(self._response)
@@ -2,12 +2,25 @@
 
 """Mysql模块"""
 
+import re
+import time
+import random
+import weakref
+import threading
+from itertools import chain
+from collections import deque, OrderedDict
 
 import fastweb.util.tool as tool
+from fastweb.util.log import lazy, log_fields
+from fastweb.util.metrics import COMPONENT_CALL, MYSQL_STATEMENT, MYSQL_SLOW
+from fastweb.cache import QueryCache
 from fastweb.component import Component
-from fastweb.exception import MysqlError
+from fastweb.util.log import recorder
+from fastweb.exception import MysqlError, ConfigurationError, PoolError
+from fastweb.pool import SyncConnectionPool, AsynConnectionPool
 from fastweb.util.tool import Retry, RetryPolicy
 from fastweb.accesspoint import iostream, pymysql, tornado_mysql, coroutine, Return
+from pymysql.cursors import RE_INSERT_VALUES
 
 pymysql.threadsafety = 2
 tornado_mysql.threadsafety = 2
@@ -16,13 +29,477 @@ DEFAULT_PORT = 3306
 DEFAULT_TIMEOUT = 5
 DEFAULT_CHARSET = 'utf8'
 DEFAULT_AUTOCOMMIT = True
+DEFAULT_CACHE_EXPIRE = 60
+# 流式查询每批获取的行数
+DEFAULT_STREAM_BATCH = 1000
+# 批量插入每条语句的最大行数
+DEFAULT_BULK_BATCH = 1000
+# 无法获取服务端max_allowed_packet时使用的默认值
+DEFAULT_MAX_PACKET = 1024 * 1024
+# 批量语句为协议头等预留的空间
+PACKET_RESERVED = 1024
+# 慢查询阈值(秒),为0时不记录慢查询
+DEFAULT_SLOW_QUERY = 1.0
+# 慢查询日志采样率
+DEFAULT_SLOW_SAMPLE = 1.0
+# 耗时指标的最大语句指纹数,超过后归入OTHER_STATEMENTS
+DEFAULT_MAX_STATEMENTS = 1000
+OTHER_STATEMENTS = '<other>'
+# 已经记录过耗时的语句指纹
+_statements = set()
+# 超过该长度的sql(如批量插入)不进入模板缓存
+PREPARE_MAX_SQL = 2048
+# 从库负载均衡策略: 最少未完成请求 / 平滑加权轮询
+BALANCE_LEAST = 'least'
+BALANCE_WEIGHTED = 'weighted'
+# 写操作后读请求继续发往主库的时间(秒)
+DEFAULT_STICKY_PRIMARY = 1.0
+# 从库连续失败次数达到该值后摘除
+DEFAULT_REPLICA_FAILURES = 3
+# 从库摘除时间(秒),到期后重新尝试
+DEFAULT_REPLICA_EJECT = 30.0
+# 每个从库连接池的最大连接数
+DEFAULT_REPLICA_POOL = 20
+# 从库连接沿用的主库连接参数
+REPLICA_SETTING = ('user', 'password', 'db', 'timeout', 'charset')
+
+# sql指纹,常量替换为?,多行VALUES和IN列表合并
+_ROW = r'\(\s*\?(?:\s*,\s*\?)*\s*\)'
+_FINGERPRINT_RES = [(re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+                    (re.compile(r'"(?:[^"\\]|\\.)*"'), '?'),
+                    (re.compile(r'%\(\w+\)s|%s'), '?'),
+                    (re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b'), '?'),
+                    (re.compile(r'\bNULL\b', re.IGNORECASE), '?'),
+                    (re.compile(r'\s+'), ' '),
+                    (re.compile(r'\bIN\s*' + _ROW, re.IGNORECASE), 'IN (?+)'),
+                    (re.compile(r'(' + _ROW + r')(?:\s*,\s*' + _ROW + r')+'), r'\1...')]
+# 依赖会话状态或加锁的语句只能在主库执行
+_PRIMARY_ONLY_RE = re.compile(r'\b(?:last_insert_id|found_rows|row_count|get_lock|release_lock|is_free_lock|is_used_lock)'
+                              r'\s*\(|@|\bfor\s+update\b|\block\s+in\s+share\s+mode\b|\binto\s+(?:out|dump)file\b',
+                              re.IGNORECASE)
+# sql模板中的占位符: 普通文本, %(name)s, %s, %%, 其余不支持的%
+_PLACEHOLDER_RE = re.compile(r'([^%]*)(?:%\((\w+)\)s|(%s)|(%%)|(%.?)|$)', re.DOTALL)
+# 指纹缓存,短sql才缓存
+_fingerprints = {}
+_FINGERPRINT_CACHE_SIZE = 4096
+_FINGERPRINT_CACHE_SQL = 2048
+
+
+def fingerprint(sql):
+    """sql指纹,常量和占位符不同的同类语句指纹相同"""
+
+    fp = _fingerprints.get(sql)
+    if fp is not None:
+        return fp
+
+    fp = sql
+    for pattern, repl in _FINGERPRINT_RES:
+        fp = pattern.sub(repl, fp)
+    fp = fp.strip().rstrip(';')
+
+    if len(sql) <= _FINGERPRINT_CACHE_SQL:
+        if len(_fingerprints) >= _FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[sql] = fp
+    return fp
+
+
+def _statement_label(fp):
+    """指标的fingerprint标签,语句指纹超过DEFAULT_MAX_STATEMENTS个后归入OTHER_STATEMENTS"""
+
+    if fp not in _statements:
+        if len(_statements) >= DEFAULT_MAX_STATEMENTS:
+            return OTHER_STATEMENTS
+        _statements.add(fp)
+    return fp
+
+
+def is_readonly(sql):
+    """是否为可以在从库执行的只读语句"""
+
+    return QueryCache.is_cacheable(sql) and not _PRIMARY_ONLY_RE.search(sql)
+
+
+class SqlStatement(object):
+    """sql及参数,转为字符串时才格式化,用于日志"""
+
+    __slots__ = ('sql', 'args')
+
+    def __init__(self, sql, args=None):
+        self.sql = sql
+        self.args = args
+
+    def __str__(self):
+        def type_convert(v):
+            if v is None:
+                return 'NULL'
+            return v
+
+        args = self.args
+
+        try:
+            if isinstance(args, dict):
+                return self.sql % {k: type_convert(v) for k, v in args.items()}
+            elif isinstance(args, tuple):
+                return self.sql % tuple(type_convert(v) for v in args)
+            elif isinstance(args, str):
+                return self.sql % args
+        except (KeyError, TypeError, ValueError):
+            return '{sql} {args}'.format(sql=self.sql, args=args)
+        return self.sql
+
+
+class PreparedStatement(object):
+    """解析后的sql模板
+
+    占位符位置,指纹,是否可缓存,写入的表只在第一次执行时解析
+    执行时逐个转义参数并拼接,不再对整条sql进行%格式化
+    """
+
+    __slots__ = ('sql', 'fingerprint', 'parts', 'keys', 'cacheable', 'readonly', 'error', '_tables')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.fingerprint = fingerprint(sql)
+        self.cacheable = QueryCache.is_cacheable(sql)
+        self.readonly = is_readonly(sql)
+        self._tables = None
+        # 不支持的%,传入参数时与pymysql的%格式化一样抛出ValueError
+        self.error = None
+
+        # parts比keys多一个元素,keys为位置参数的序号或命名参数的名称
+        self.parts = []
+        self.keys = []
+        literal = []
+        position = 0
+
+        index = 0
+        for text, name, positional, percent, unsupported in _PLACEHOLDER_RE.findall(sql):
+            literal.append(text)
+            index += len(text)
+            if unsupported and self.error is None:
+                if len(unsupported) == 1:
+                    self.error = 'incomplete format'
+                else:
+                    self.error = "unsupported format character '{char}' (0x{code:x}) at index {index}".format(
+                        char=unsupported[1], code=ord(unsupported[1]), index=index + 1)
+            if percent:
+                literal.append('%')
+            elif name or positional:
+                self.parts.append(''.join(literal))
+                literal = []
+                if name:
+                    self.keys.append(name)
+                else:
+                    self.keys.append(position)
+                    position += 1
+            index += len(name) + 4 if name else len(positional or percent or unsupported)
+        self.parts.append(''.join(literal))
+
+        if position and position != len(self.keys):
+            raise TypeError('sql mixes positional and named placeholders: {sql}'.format(sql=sql))
+
+    @property
+    def tables(self):
+        """写操作影响的表"""
+
+        if self._tables is None:
+            self._tables = QueryCache.parse_tables(self.sql) if QueryCache.is_write(self.sql) else set()
+        return self._tables
+
+    def render(self, args, literal):
+        """使用转义后的参数生成sql,与cursor.execute(sql, args)结果一致"""
+
+        if args is None:
+            return self.sql
+
+        if self.error is not None:
+            raise ValueError(self.error)
+
+        if not isinstance(args, (tuple, list, dict)):
+            args = (args, )
+
+        if isinstance(args, dict):
+            if self.keys and not isinstance(self.keys[0], str):
+                raise TypeError('format requires a tuple for positional placeholders')
+            values = [literal(args[key]) for key in self.keys]
+        else:
+            if len(args) != len(self.keys) or (self.keys and isinstance(self.keys[0], str)):
+                raise TypeError('not all arguments converted during string formatting')
+            values = [literal(arg) for arg in args]
+
+        rendered = [self.parts[0]]
+        for value, part in zip(values, self.parts[1:]):
+            rendered.append(value)
+            rendered.append(part)
+        return ''.join(rendered)
+
+
+class Replica(object):
+    """从库节点"""
+
+    __slots__ = ('host', 'port', 'weight', 'outstanding', 'current_weight', 'failures', 'ejected_until',
+                 'requests', 'errors')
+
+    def __init__(self, host, port=DEFAULT_PORT, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = weight
+
+        # 未完成的请求数
+        self.outstanding = 0
+        # 平滑加权轮询的当前权重
+        self.current_weight = 0
+        # 连续失败次数
+        self.failures = 0
+        self.ejected_until = 0
+
+        self.requests = 0
+        self.errors = 0
+
+    def __str__(self):
+        return self.key
+
+    @property
+    def key(self):
+        return '{host}:{port}'.format(host=self.host, port=self.port)
+
+
+class ReplicaSet(object):
+    """从库集合
+
+    配置格式为逗号分隔的host[:port][*weight],如 10.0.0.2:3306*2, 10.0.0.3
+    同一配置的组件共享一个ReplicaSet,负载和健康状态在所有连接间共享
+    连续失败failures次的从库摘除eject秒,全部摘除时读请求发往主库
+    每个从库使用一个连接池,同一从库的连接在所有组件间共享
+    写操作后的粘滞期限按session(组件的宿主)记录,与使用哪个主库连接无关
+
+    :parameter:
+      - `replicas`:从库列表
+      - `balance`:负载均衡策略,least(最少未完成请求)或weighted(平滑加权轮询)
+      - `failures`:摘除前允许的连续失败次数
+      - `eject`:摘除时间(秒)
+    """
+
+    _sets = {}
+
+    def __init__(self, replicas, balance=BALANCE_LEAST, failures=DEFAULT_REPLICA_FAILURES, eject=DEFAULT_REPLICA_EJECT):
+        if balance not in (BALANCE_LEAST, BALANCE_WEIGHTED):
+            raise ConfigurationError
+
+        self.replicas = replicas
+        self.balance = balance
+        self.failures = failures
+        self.eject = eject
+
+        self._lock = threading.Lock()
+        # 最少未完成请求相同时轮流选择
+        self._offset = 0
+        # session -> 该时间之前的读请求发往主库,session释放后自动删除
+        self._sticky = weakref.WeakKeyDictionary()
+        # (从库, 组件类, 连接参数) -> 连接池
+        self._pools = {}
+
+    def __str__(self):
+        return '<ReplicaSet {balance} {replicas}>'.format(balance=self.balance,
+                                                         replicas=','.join(str(r) for r in self.replicas))
+
+    @staticmethod
+    def parse(spec, port=DEFAULT_PORT):
+        """解析从库配置"""
+
+        replicas = []
+
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+
+            try:
+                address, _, weight = item.partition('*')
+                host, _, replica_port = address.strip().partition(':')
+                replicas.append(Replica(host, int(replica_port or port), int(weight or 1)))
+            except ValueError as e:
+                recorder('ERROR', '<replicas> format error {item} ({e})'.format(item=item, e=e))
+                raise ConfigurationError
+
+        return replicas
+
+    @classmethod
+    def get(cls, spec, port=DEFAULT_PORT, balance=BALANCE_LEAST, failures=DEFAULT_REPLICA_FAILURES,
+            eject=DEFAULT_REPLICA_EJECT):
+        """获取共享的ReplicaSet"""
+
+        key = (spec, port, balance, failures, eject)
+        replica_set = cls._sets.get(key)
+
+        if replica_set is None:
+            replica_set = cls._sets.setdefault(key, cls(cls.parse(spec, port), balance, failures, eject))
+        return replica_set
+
+    def choose(self):
+        """选择一个从库并增加其未完成请求数,没有可用从库时返回None"""
+
+        now = time.time()
+
+        with self._lock:
+            alive = [replica for replica in self.replicas if replica.ejected_until <= now and replica.weight > 0]
+
+            if not alive:
+                return None
+
+            if self.balance == BALANCE_WEIGHTED:
+                total = 0
+                for replica in alive:
+                    replica.current_weight += replica.weight
+                    total += replica.weight
+                chosen = max(alive, key=lambda r: r.current_weight)
+                chosen.current_weight -= total
+            else:
+                self._offset = (self._offset + 1) % len(alive)
+                alive = alive[self._offset:] + alive[:self._offset]
+                chosen = min(alive, key=lambda r: float(r.outstanding) / r.weight)
+
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, replica, ok=True):
+        """请求结束,失败次数达到阈值时摘除从库"""
+
+        with self._lock:
+            replica.outstanding -= 1
+
+            if ok:
+                replica.failures = 0
+                return
+
+            replica.errors += 1
+            replica.failures += 1
+            if replica.failures >= self.failures:
+                replica.ejected_until = time.time() + self.eject
+                # 恢复后再失败一次就重新摘除
+                replica.failures = self.failures - 1
+                recorder('WARN', '{replica} ejected for {eject}s'.format(replica=replica, eject=self.eject))
+
+    def stick(self, session, seconds):
+        """session在seconds秒内的读请求发往主库"""
+
+        with self._lock:
+            self._sticky[session] = time.time() + seconds
+
+    def is_sticky(self, session):
+        """session的读请求是否需要发往主库"""
+
+        with self._lock:
+            until = self._sticky.get(session)
+            if until is None:
+                return False
+            if until > time.time():
+                return True
+            del self._sticky[session]
+            return False
+
+    def pool(self, replica, cls, pool_cls, setting, maxconnections):
+        """获取从库的连接池,第一次使用时创建,连接在借用时按需建立
+
+        :parameter:
+          - `replica`:从库
+          - `cls`:连接池中的组件类
+          - `pool_cls`:连接池类
+          - `setting`:组件参数
+          - `maxconnections`:最大连接数
+        """
+
+        key = (replica.key, cls, tuple(sorted(setting.items())))
+
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = pool_cls(cls, setting, 0, 'replica {replica}'.format(replica=replica),
+                                                   maxconnections=maxconnections)
+                pool.rescue()
+            return pool
+
+    def stats(self):
+        now = time.time()
+
+        with self._lock:
+            return {replica.key: {'weight': replica.weight,
+                                  'outstanding': replica.outstanding,
+                                  'requests': replica.requests,
+                                  'errors': replica.errors,
+                                  'ejected': replica.ejected_until > now} for replica in self.replicas}
+
+
+def quote_identifier(name):
+    """用反引号引用表名或列名,名称中的反引号转义为两个反引号"""
+
+    return '`{name}`'.format(name=str(name).replace('`', '``'))
+
+
+def chunks(sequence, size):
+    """按size切分序列"""
+
+    batch = []
+    for item in sequence:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class CachedCursor(object):
+    """查询缓存的结果集,提供与DictCursor相同的fetch接口"""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self.rownumber = 0
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        if self.rownumber >= len(self._rows):
+            return None
+        row = self._rows[self.rownumber]
+        self.rownumber += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self.rownumber:]
+        self.rownumber = len(self._rows)
+        return rows
+
+    def close(self):
+        pass
 
 
 class Mysql(Component):
-    """Mysql基类"""
+    """Mysql基类
+
+    配置cache为redis组件名称后,query(sql, cache=True)的SELECT结果缓存到redis,过期时间为cache_expire
+    写操作按表删除相关缓存,事务中的写操作在提交后删除
+
+    每条语句的耗时按sql指纹记录到fastweb_mysql_statement_seconds,慢查询次数记录到fastweb_mysql_slow_total
+    超过slow_query(秒)的语句按slow_sample采样率记录慢查询日志
+
+    配置prepare_cache后每个连接用LRU缓存最多prepare_cache条解析后的sql模板(PreparedStatement)
+    驱动不支持服务端预处理语句,这里缓存的是客户端解析结果
+
+    配置replicas(见ReplicaSet)后事务之外的只读SELECT发往从库,按replica_balance选择从库
+    从库连接从ReplicaSet的连接池中借用,每个从库最多replica_pool个连接
+    同一宿主(请求)写操作及事务提交后sticky_primary秒内的读请求仍然发往主库,从库执行失败时改由主库执行
+    """
 
     eattr = {'host': str}
-    oattr = {'port': int, 'user': str, 'password': str, 'db': str, 'timeout': int, 'charset': str, 'autocommit': bool}
+    oattr = {'port': int, 'user': str, 'password': str, 'db': str, 'timeout': int, 'charset': str, 'autocommit': bool,
+             'cache': str, 'cache_expire': int, 'slow_query': float, 'slow_sample': float, 'prepare_cache': int,
+             'replicas': str, 'replica_balance': str, 'replica_failures': int, 'replica_eject': float,
+             'replica_pool': int, 'sticky_primary': float}
+
+    # 从库连接池类
+    replica_pool_class = None
 
     def __init__(self, setting):
         self.port = DEFAULT_PORT
@@ -42,6 +519,26 @@ class Mysql(Component):
         # 最后执行sql参数
         self._args = None
 
+        # 查询缓存
+        self.query_cache = None
+        # 事务中修改过的表,提交后删除相关缓存
+        self._dirty_tables = set()
+
+        # 未结束的流式查询,结束前连接不能执行其他语句,也不能归还连接池
+        self._stream = None
+        self._stream_callbacks = []
+
+        # 服务端max_allowed_packet,第一次批量插入时获取
+        self._max_packet = None
+
+        # sql模板缓存 sql -> PreparedStatement
+        self._prepared = OrderedDict()
+        self.prepared_stats = {'hit': 0, 'miss': 0, 'evict': 0}
+
+        # 从库 ReplicaSet,从库连接池 key -> pool
+        self.replica_set = None
+        self._replica_pools = {}
+
         self._prepare()
 
     def _prepare(self):
@@ -49,28 +546,238 @@ class Mysql(Component):
         self.setting['passwd'] = self.setting.pop('password', None)
         self.setting['connect_timeout'] = self.setting.pop('timeout', DEFAULT_TIMEOUT)
 
-    def _format_sql(self, sql, args):
-        """格式化sql
-        占位符不需要严格区分类型，%s是一个好的选择"""
+        self.prepare_cache = self.setting.pop('prepare_cache', None) or 0
 
-        def type_convert(v):
-            if v is None:
-                return 'NULL'
-            return v
+        slow_query = self.setting.pop('slow_query', None)
+        slow_sample = self.setting.pop('slow_sample', None)
+        self.slow_query = DEFAULT_SLOW_QUERY if slow_query is None else slow_query
+        self.slow_sample = DEFAULT_SLOW_SAMPLE if slow_sample is None else slow_sample
 
-        if isinstance(args, dict):
-            self._args = args = {k: type_convert(v) for k, v in list(args.items())}
-            self._sql = sql % args
-        elif isinstance(args, tuple):
-            self._args = args = tuple([type_convert(v) for v in args])
-            self._sql = sql % args
-        elif isinstance(args, str):
-            self._sql = sql % args
+        cache = self.setting.pop('cache', None)
+        cache_expire = self.setting.pop('cache_expire', None) or DEFAULT_CACHE_EXPIRE
+        if cache:
+            self.query_cache = QueryCache.get(cache, cache_expire)
+
+        replicas = self.setting.pop('replicas', None)
+        balance = self.setting.pop('replica_balance', None) or BALANCE_LEAST
+        failures = self.setting.pop('replica_failures', None) or DEFAULT_REPLICA_FAILURES
+        eject = self.setting.pop('replica_eject', None) or DEFAULT_REPLICA_EJECT
+        self.replica_pool = self.setting.pop('replica_pool', None) or DEFAULT_REPLICA_POOL
+        sticky = self.setting.pop('sticky_primary', None)
+        self.sticky_primary = DEFAULT_STICKY_PRIMARY if sticky is None else sticky
+        if replicas:
+            self.replica_set = ReplicaSet.get(replicas, self.setting.get('port', DEFAULT_PORT), balance, failures, eject)
+
+    def _use_cache(self, sql, cache):
+        """是否从查询缓存中读取,事务中始终读取数据库"""
+
+        if not cache or self.query_cache is None or self._event:
+            return False
+
+        statement = self._prepared.get(sql)
+        return statement.cacheable if statement is not None else QueryCache.is_cacheable(sql)
+
+    def _written_tables(self, sql):
+        """写操作影响的表,未配置查询缓存时不解析"""
+
+        if self.query_cache is None:
+            return set()
+
+        statement = self._prepared.get(sql)
+        if statement is not None:
+            return statement.tables
+        if QueryCache.is_write(sql):
+            return QueryCache.parse_tables(sql)
+        return set()
+
+    def _choose_replica(self, sql):
+        """选择执行读请求的从库,需要在主库执行时返回None"""
+
+        if self.replica_set is None or self._event or self._stream is not None:
+            return None
+
+        if self.replica_set.is_sticky(self._session):
+            return None
+
+        statement = self._prepared.get(sql)
+        if not (statement.readonly if statement is not None else is_readonly(sql)):
+            return None
+
+        return self.replica_set.choose()
+
+    def _stick_primary(self, sql=None):
+        """写操作后一段时间内的读请求发往主库,避免读不到刚写入的数据"""
+
+        if self.replica_set is None or not self.sticky_primary:
+            return
+
+        if sql is None or self._event or not is_readonly(sql):
+            self.replica_set.stick(self._session, self.sticky_primary)
+
+    @property
+    def _session(self):
+        """读写分离的session,使用中为宿主,否则为组件自身"""
+
+        return self.owner if self.owner is not None else self
+
+    def _replica_pool(self, replica):
+        """从库的连接池,从库只执行单条读语句,使用自动提交避免读到旧快照"""
+
+        pool = self._replica_pools.get(replica.key)
+
+        if pool is None:
+            setting = dict((key, value) for key, value in self._setting.items() if key in REPLICA_SETTING)
+            setting.update(host=replica.host, port=replica.port, autocommit=True)
+            pool = self._replica_pools[replica.key] = self.replica_set.pool(replica, type(self),
+                                                                            self.replica_pool_class, setting,
+                                                                            self.replica_pool)
+        return pool
+
+    def _replica_failed(self, replica, error, pool=None, connection=None):
+        self.replica_set.release(replica, False)
+        if connection is not None:
+            pool.remove_connection(connection)
+
+        self.recorder('WARN', '{obj} replica {replica} error, fallback to primary [{msg}]'.format(obj=self,
+                                                                                               replica=replica,
+                                                                                               msg=error))
+
+    def _statement(self, sql):
+        """从连接的模板缓存中获取解析后的语句,未开启模板缓存时返回None"""
+
+        if not self.prepare_cache or len(sql) > PREPARE_MAX_SQL:
+            return None
+
+        statement = self._prepared.pop(sql, None)
+
+        if statement is None:
+            statement = PreparedStatement(sql)
+            self.prepared_stats['miss'] += 1
+            if len(self._prepared) >= self.prepare_cache:
+                self._prepared.popitem(last=False)
+                self.prepared_stats['evict'] += 1
         else:
-            self._sql = sql
+            self.prepared_stats['hit'] += 1
+
+        # 重新插入到队尾,队首为最久未使用
+        self._prepared[sql] = statement
+        return statement
+
+    def _escape_args(self, args):
+        if isinstance(args, (tuple, list)):
+            return tuple(self._conn.literal(arg) for arg in args)
+        elif isinstance(args, dict):
+            return {key: self._conn.literal(value) for key, value in args.items()}
+        return self._conn.literal(args)
+
+    def _bulk_values(self, table, rows, columns=None):
+        """生成批量插入语句的前缀和每一行的VALUES"""
+
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return None, []
+
+        if columns is None and isinstance(first, dict):
+            columns = list(first.keys())
+
+        def row_values(row):
+            if isinstance(row, dict):
+                row = [row[column] for column in columns]
+            return '({values})'.format(values=','.join(self._conn.literal(value) for value in row))
+
+        prefix = 'INSERT INTO {table} {columns}VALUES '.format(
+            table='.'.join(quote_identifier(name) for name in table.split('.')),
+            columns='({columns}) '.format(columns=','.join(quote_identifier(c) for c in columns)) if columns else '')
+        values = (row_values(row) for row in chain([first], rows))
+        return prefix, values
+
+    @staticmethod
+    def _bulk_statements(prefix, values, postfix, batch_size, max_packet):
+        """把多行VALUES拼接为多条语句,每条不超过batch_size行且不超过max_packet字节"""
+
+        base = len(prefix.encode('utf-8')) + len(postfix.encode('utf-8'))
+        batch, size = [], base
+
+        for value in values:
+            length = len(value.encode('utf-8')) + 1
+            if batch and (len(batch) >= batch_size or size + length > max_packet):
+                yield prefix + ','.join(batch) + postfix
+                batch, size = [], base
+            batch.append(value)
+            size += length
+
+        if batch:
+            yield prefix + ','.join(batch) + postfix
+
+    def executemany(self, sql, args_list, batch_size=DEFAULT_BULK_BATCH):
+        """批量执行
+
+        INSERT/REPLACE ... VALUES语句合并为多行插入,每条语句不超过max_allowed_packet,每条语句提交一次
+        其他语句每batch_size条在一个事务中执行
+        返回影响的总行数
+        """
+        raise NotImplementedError
+
+    def bulk_insert(self, table, rows, batch_size=DEFAULT_BULK_BATCH, columns=None):
+        """批量插入
+
+        :parameter:
+          - `table`:表名
+          - `rows`:字典列表,或与columns顺序一致的序列列表
+          - `batch_size`:每条插入语句的最大行数
+          - `columns`:列名,rows为字典时默认使用第一行的key
+        """
+        raise NotImplementedError
+
+    @property
+    def streaming(self):
+        """是否有未结束的流式查询"""
+        return self._stream is not None
+
+    def on_stream_end(self, callback):
+        """流式查询结束后回调,Manager用于延迟归还连接"""
+
+        if self._stream is None:
+            callback()
+        else:
+            self._stream_callbacks.append(callback)
+
+    def _check_stream(self):
+        if self._stream is not None:
+            self.recorder('CRITICAL', '{obj} connection is busy with {stream}'.format(obj=self, stream=self._stream))
+            raise MysqlError
 
+    def _open_stream(self, stream):
+        self._check_stream()
+        self._stream = stream
+
+    def _close_stream(self):
+        self._stream = None
+        callbacks, self._stream_callbacks = self._stream_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _format_sql(self, sql, args):
+        """记录最后执行的sql,输出日志时才会格式化"""
+
+        self._sql = SqlStatement(sql, args)
+        self._args = args
         return sql
 
+    def _observe(self, sql, elapsed, statement=None):
+        """记录语句耗时,超过慢查询阈值时按采样率记录日志"""
+
+        slow = bool(self.slow_query) and elapsed >= self.slow_query
+        fp = _statement_label(statement.fingerprint if statement else fingerprint(sql))
+        MYSQL_STATEMENT.labels(fp).observe(elapsed)
+        if slow:
+            MYSQL_SLOW.labels(fp).inc()
+        COMPONENT_CALL.labels(self.name, 'query').observe(elapsed)
+
+        if slow and (self.slow_sample >= 1 or random.random() < self.slow_sample):
+            self.recorder('WARN', lazy('{obj} slow query [{time:.6f}s]\n{sql}', obj=self, time=elapsed, sql=self._sql))
+
     def connect(self):
         """建立连接"""
         raise NotImplementedError
@@ -98,8 +805,21 @@ class Mysql(Component):
 
         raise NotImplementedError
 
-    def query(self, sql, **kwargs):
-        """查询sql"""
+    def query(self, sql, args=None, cache=False):
+        """查询sql
+
+        :parameter:
+          - `cache`:是否使用查询缓存
+        """
+        raise NotImplementedError
+
+    def stream(self, sql, args=None, batch_size=DEFAULT_STREAM_BATCH, batches=False):
+        """流式查询,使用无缓冲游标分批读取结果,不会一次性加载整个结果集
+
+        :parameter:
+          - `batch_size`:每批读取的行数
+          - `batches`:为True时按批返回行列表,否则逐行返回
+        """
         raise NotImplementedError
 
     def fetch(self):
@@ -137,6 +857,8 @@ class SyncMysql(Mysql):
     """同步mysql
        线程不安全"""
 
+    replica_pool_class = SyncConnectionPool
+
     def __reduce__(self):
         return SyncMysql, (self.setting,)
 
@@ -154,9 +876,9 @@ class SyncMysql(Mysql):
         """建立连接"""
 
         try:
-            self.recorder('INFO', '{obj} connect start'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} connect start', obj=self))
             self._conn = pymysql.connect(**self.setting)
-            self.recorder('INFO', '{obj} connect successful ({threadid})'.format(obj=self, threadid=self._conn.server_thread_id[0]))
+            self.recorder('INFO', lazy('{obj} connect successful ({threadid})', obj=self, threadid=self._conn.server_thread_id[0]))
         except pymysql.Error as e:
             self.recorder('ERROR', '{obj} connect failed [{msg}]'.format(obj=self, msg=e))
             raise MysqlError
@@ -167,9 +889,9 @@ class SyncMysql(Mysql):
         """保持连接"""
 
         try:
-            self.recorder('INFO', '{obj} ping start'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} ping start', obj=self))
             self._conn.ping()
-            self.recorder('INFO', '{obj} ping successful'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} ping successful', obj=self))
         except pymysql.Error as e:
             self.recorder('WARN', '{obj} ping error [{msg}]'.format(obj=self, msg=e))
             raise MysqlError
@@ -193,7 +915,7 @@ class SyncMysql(Mysql):
 
         try:
             self._event = True
-            self.recorder('INFO', '{obj} start event'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} start event', obj=self))
             self._conn.begin()
         except pymysql.OperationalError as e:
             self.recorder('WARN', '{obj} event start error [{msg}]'.format(msg=e))
@@ -204,7 +926,7 @@ class SyncMysql(Mysql):
         """事务执行"""
 
         if self._event:
-            self.recorder('INFO', '{obj} execute event'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} execute event', obj=self))
             return self.query(sql, args)
         else:
             self.recorder('CRITICAL', 'please start event first!')
@@ -215,18 +937,181 @@ class SyncMysql(Mysql):
 
         if self._event:
             self._event = False
-            self.recorder('INFO', '{obj} end event'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} end event', obj=self))
             self.commit()
+            self._stick_primary()
+            tables, self._dirty_tables = self._dirty_tables, set()
+            self.query_cache and self.query_cache.invalidate_sync(self, tables)
         else:
             self.recorder('CRITICAL', 'please start event first! ')
             raise MysqlError
 
-    def query(self, sql, args=None):
-        """查询sql"""
+    def query(self, sql, args=None, cache=False):
+        """查询sql
+
+        :parameter:
+          - `cache`:是否使用查询缓存,命中时不访问数据库
+        """
+
+        self._check_stream()
+
+        if self._use_cache(sql, cache):
+            hit, rows = self.query_cache.get_sync(self, sql, args)
+            if hit:
+                self.recorder('INFO', lazy('{obj} query cache hit\n{sql}', obj=self, sql=sql))
+                self._cur = CachedCursor(rows)
+                return len(rows)
+
+        start = time.time()
+        replica = self._choose_replica(sql)
+        effect = self._replica_query(replica, sql, args) if replica else None
+
+        if effect is None:
+            # 执行过程中的重试,只重试一次
+            mysql_retry_policy = RetryPolicy(times=1, error=MysqlError)
+            effect = Retry(self, '{obj}'.format(obj=self), self._query, sql, mysql_retry_policy, args).run_sync()
+            self._stick_primary(sql)
+
+        if self._use_cache(sql, cache):
+            rows = list(self._cur.fetchall())
+            self.query_cache.set_sync(self, sql, args, rows, time.time() - start)
+            self._cur = CachedCursor(rows)
+        else:
+            tables = self._written_tables(sql)
+            if self._event:
+                self._dirty_tables.update(tables)
+            elif tables:
+                self.query_cache.invalidate_sync(self, tables)
+
+        return effect
+
+    def max_allowed_packet(self):
+        """服务端允许的最大语句长度"""
+
+        if self._max_packet is None:
+            try:
+                cur = self._conn.cursor()
+                cur.execute('SELECT @@max_allowed_packet')
+                self._max_packet = int(cur.fetchone()[0]) - PACKET_RESERVED
+                cur.close()
+            except pymysql.Error as e:
+                self.recorder('WARN', '{obj} get max_allowed_packet error [{msg}]'.format(obj=self, msg=e))
+                self._max_packet = DEFAULT_MAX_PACKET - PACKET_RESERVED
+        return self._max_packet
+
+    def executemany(self, sql, args_list, batch_size=DEFAULT_BULK_BATCH):
+        """批量执行,返回影响的总行数"""
+
+        match = RE_INSERT_VALUES.match(sql)
+
+        if match:
+            prefix, template, postfix = match.groups()
+            values = (template % self._escape_args(args) for args in args_list)
+            return self._bulk_execute(prefix, values, postfix, batch_size)
+
+        effect = 0
+        for batch in chunks(args_list, batch_size):
+            effect += self._execute_batch(sql, batch)
+        return effect
+
+    def bulk_insert(self, table, rows, batch_size=DEFAULT_BULK_BATCH, columns=None):
+        """批量插入,返回插入的总行数"""
+
+        prefix, values = self._bulk_values(table, rows, columns)
+        if prefix is None:
+            return 0
+        return self._bulk_execute(prefix, values, '', batch_size)
+
+    def _bulk_execute(self, prefix, values, postfix, batch_size):
+        effect = 0
+        for statement in self._bulk_statements(prefix, values, postfix, batch_size, self.max_allowed_packet()):
+            effect += self.query(statement)
+        return effect
+
+    def _execute_batch(self, sql, batch):
+        """在事务中执行一批语句,已经在事务中时由外层提交"""
+
+        own_event = not self._event
+        if own_event:
+            self.start_event()
+
+        effect = 0
+        try:
+            for args in batch:
+                effect += self.exec_event(sql, args)
+        except MysqlError:
+            if own_event:
+                self._event = False
+                self.rollback()
+            raise
+
+        if own_event:
+            self.end_event()
+        return effect
+
+    def stream(self, sql, args=None, batch_size=DEFAULT_STREAM_BATCH, batches=False):
+        """流式查询,返回可迭代对象
+
+        迭代结束或close之前连接一直被占用,提前结束迭代时需要调用close或使用with
+        """
+
+        return SyncMysqlStream(self, sql, args, batch_size, batches)
+
+    def _replica_query(self, replica, sql, args):
+        """在从库执行只读查询,从库不可用时返回None,改由主库执行"""
+
+        pool = self._replica_pool(replica)
 
-        # 执行过程中的重试,只重试一次
-        mysql_retry_policy = RetryPolicy(times=1, error=MysqlError)
-        return Retry(self, '{obj}'.format(obj=self), self._query, sql, mysql_retry_policy, args).run_sync()
+        try:
+            connection = pool.acquire()
+        except PoolError:
+            self.replica_set.release(replica)
+            self.recorder('WARN', '{obj} replica {replica} pool busy, fallback to primary'.format(obj=self,
+                                                                                                 replica=replica))
+            return None
+        except MysqlError as e:
+            self._replica_failed(replica, e)
+            return None
+
+        try:
+            conn = connection._conn
+            cur = conn.cursor(pymysql.cursors.DictCursor)
+
+            self._format_sql(sql, args)
+            self.recorder('INFO', lazy('{obj} replica {replica} query start\n{sql}', obj=self, replica=replica,
+                                       sql=self._sql))
+            statement = self._statement(sql)
+            with self.span('replica query') as t:
+                if statement is not None:
+                    cur.execute(statement.render(args, conn.literal))
+                else:
+                    cur.execute(sql, args)
+            self._observe(sql, t.seconds, statement)
+            self.recorder('INFO', log_fields(lazy('{obj} replica {replica} query successful\n{sql}\t[{time}]\t[{effect}]',
+                                                  obj=self, replica=replica, sql=self._sql, time=t, effect=cur.rowcount),
+                                             self.name, 'replica query', t))
+        except (pymysql.IntegrityError, pymysql.ProgrammingError) as e:
+            pool.release(connection)
+            self.replica_set.release(replica)
+            self.recorder('ERROR', '{obj} query error\n{sql}\n[{msg}]'.format(obj=self, sql=self._sql, msg=e))
+            raise MysqlError
+        except (KeyError, TypeError) as e:
+            pool.release(connection)
+            self.replica_set.release(replica)
+            self.recorder('ERROR',
+                          '{obj} sql format error\n{sql}\n{args}\n[{msg}]'.format(obj=self, sql=sql, args=args,
+                                                                                  msg=e))
+            raise MysqlError
+        except pymysql.Error as e:
+            self._replica_failed(replica, e, pool, connection)
+            return None
+
+        # 结果已经读取到客户端,执行后即可归还从库连接
+        pool.release(connection)
+        self.replica_set.release(replica)
+        self._cur and self._cur.close()
+        self._cur = cur
+        return cur.rowcount
 
     def _query(self, sql, retry, args):
 
@@ -239,12 +1124,17 @@ class SyncMysql(Mysql):
         try:
             self._format_sql(sql, args)
 
-            self.recorder('INFO', '{obj} query start ({threadid})\n{sql}'.format(obj=self, threadid=self._conn.server_thread_id[0], sql=self._sql))
-            with tool.timing('s', 10) as t:
-                self._cur.execute(sql, args)
-            self.recorder('INFO',
-                          '{obj} query successful\n{sql}\t[{time}]\t[{effect}]'.format(obj=self, sql=self._sql, time=t,
-                                                                                       effect=self._cur.rowcount))
+            self.recorder('INFO', lazy('{obj} query start ({threadid})\n{sql}', obj=self, threadid=self._conn.server_thread_id[0], sql=self._sql))
+            statement = self._statement(sql)
+            with self.span('query') as t:
+                if statement is not None:
+                    self._cur.execute(statement.render(args, self._conn.literal))
+                else:
+                    self._cur.execute(sql, args)
+            self._observe(sql, t.seconds, statement)
+            self.recorder('INFO', log_fields(lazy('{obj} query successful\n{sql}\t[{time}]\t[{effect}]', obj=self,
+                                                  sql=self._sql, time=t, effect=self._cur.rowcount),
+                                             self.name, 'query', t))
         except pymysql.OperationalError as e:
             self.recorder('ERROR', '{obj} mysql has gone away [{msg}]'.format(obj=self, msg=e))
             self.reconnect()
@@ -268,28 +1158,31 @@ class SyncMysql(Mysql):
     def close(self):
         """关闭连接"""
 
-        self.recorder('INFO', '{obj} connection close start'.format(obj=self))
-        self._cur.close()
+        self.recorder('INFO', lazy('{obj} connection close start', obj=self))
+        self._cur and self._cur.close()
         self._conn.close()
-        self.recorder('INFO', '{obj} connection close successful'.format(obj=self))
+        self.recorder('INFO', lazy('{obj} connection close successful', obj=self))
 
     def rollback(self):
         """回滚"""
 
         # TODO:记录本次事务语句
+        self._dirty_tables = set()
         self._conn.rollback()
-        self.recorder('INFO', '{obj} query rollback'.format(obj=self))
+        self.recorder('INFO', lazy('{obj} query rollback', obj=self))
 
     def commit(self):
         """事务提交"""
 
         self._conn.commit()
-        self.recorder('INFO', '{obj} query commit'.format(obj=self))
+        self.recorder('INFO', lazy('{obj} query commit', obj=self))
 
 
 class AsynMysql(Mysql):
     """异步mysql组件"""
 
+    replica_pool_class = AsynConnectionPool
+
     def __reduce__(self):
         return AsynMysql, (self.setting,)
 
@@ -308,9 +1201,9 @@ class AsynMysql(Mysql):
         """建立连接"""
 
         try:
-            self.recorder('INFO', '{obj} connect start'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} connect start', obj=self))
             self._conn = yield tornado_mysql.connect(**self.setting)
-            self.recorder('INFO', '{obj} connect successful ({threadid})'.format(obj=self, threadid=self._conn.server_thread_id[0]))
+            self.recorder('INFO', lazy('{obj} connect successful ({threadid})', obj=self, threadid=self._conn.server_thread_id[0]))
         except (tornado_mysql.Error, tornado_mysql.OperationalError) as e:
             self.recorder('ERROR', '{obj} connect error [{msg}]'.format(obj=self, msg=e))
             raise MysqlError
@@ -350,7 +1243,7 @@ class AsynMysql(Mysql):
 
         try:
             self._event = True
-            self.recorder('INFO', '{obj} start event'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} start event', obj=self))
             yield self._conn.begin()
         except tornado_mysql.OperationalError as e:
             self.recorder('WARN', '{obj} event start error [{msg}]'.format(obj=self, msg=e))
@@ -362,7 +1255,7 @@ class AsynMysql(Mysql):
         """事务执行"""
 
         if self._event:
-            self.recorder('INFO', '{obj} execute event'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} execute event', obj=self))
             rows = yield self.query(sql, args)
             raise Return(rows)
         else:
@@ -375,20 +1268,200 @@ class AsynMysql(Mysql):
 
         if self._event:
             self._event = False
-            self.recorder('INFO', '{obj} end event'.format(obj=self))
+            self.recorder('INFO', lazy('{obj} end event', obj=self))
             yield self.commit()
+            self._stick_primary()
+            tables, self._dirty_tables = self._dirty_tables, set()
+            if self.query_cache:
+                yield self.query_cache.invalidate_asyn(self, tables)
         else:
             self.recorder('CRITICAL', 'please start event first! ')
             raise MysqlError
 
     @coroutine
-    def query(self, sql, args=None):
-        """查询sql"""
+    def query(self, sql, args=None, cache=False):
+        """查询sql
+
+        :parameter:
+          - `cache`:是否使用查询缓存,命中时不访问数据库
+        """
+
+        self._check_stream()
+
+        if self._use_cache(sql, cache):
+            hit, rows = yield self.query_cache.get_asyn(self, sql, args)
+            if hit:
+                self.recorder('INFO', lazy('{obj} query cache hit\n{sql}', obj=self, sql=sql))
+                self._cur = CachedCursor(rows)
+                raise Return(len(rows))
+
+        start = time.time()
+        replica = self._choose_replica(sql)
+        effect = (yield self._replica_query(replica, sql, args)) if replica else None
+
+        if effect is None:
+            mysql_retry_policy = RetryPolicy(times=1, error=MysqlError)
+            effect = yield Retry(self, '{obj}'.format(obj=self), self._query, sql, mysql_retry_policy, args).run_asyn()
+            self._stick_primary(sql)
+
+        if self._use_cache(sql, cache):
+            rows = list(self._cur.fetchall())
+            yield self.query_cache.set_asyn(self, sql, args, rows, time.time() - start)
+            self._cur = CachedCursor(rows)
+        else:
+            tables = self._written_tables(sql)
+            if self._event:
+                self._dirty_tables.update(tables)
+            elif tables:
+                yield self.query_cache.invalidate_asyn(self, tables)
 
-        mysql_retry_policy = RetryPolicy(times=1, error=MysqlError)
-        effect = yield Retry(self, '{obj}'.format(obj=self), self._query, sql, mysql_retry_policy, args).run_asyn()
         raise Return(effect)
 
+    @coroutine
+    def max_allowed_packet(self):
+        """服务端允许的最大语句长度"""
+
+        if self._max_packet is None:
+            try:
+                cur = self._conn.cursor()
+                yield cur.execute('SELECT @@max_allowed_packet')
+                self._max_packet = int(cur.fetchone()[0]) - PACKET_RESERVED
+                yield cur.close()
+            except tornado_mysql.Error as e:
+                self.recorder('WARN', '{obj} get max_allowed_packet error [{msg}]'.format(obj=self, msg=e))
+                self._max_packet = DEFAULT_MAX_PACKET - PACKET_RESERVED
+        raise Return(self._max_packet)
+
+    @coroutine
+    def executemany(self, sql, args_list, batch_size=DEFAULT_BULK_BATCH):
+        """批量执行,返回影响的总行数"""
+
+        match = RE_INSERT_VALUES.match(sql)
+
+        if match:
+            prefix, template, postfix = match.groups()
+            values = (template % self._escape_args(args) for args in args_list)
+            effect = yield self._bulk_execute(prefix, values, postfix, batch_size)
+            raise Return(effect)
+
+        effect = 0
+        for batch in chunks(args_list, batch_size):
+            count = yield self._execute_batch(sql, batch)
+            effect += count
+        raise Return(effect)
+
+    @coroutine
+    def bulk_insert(self, table, rows, batch_size=DEFAULT_BULK_BATCH, columns=None):
+        """批量插入,返回插入的总行数"""
+
+        prefix, values = self._bulk_values(table, rows, columns)
+        if prefix is None:
+            raise Return(0)
+        effect = yield self._bulk_execute(prefix, values, '', batch_size)
+        raise Return(effect)
+
+    @coroutine
+    def _bulk_execute(self, prefix, values, postfix, batch_size):
+        max_packet = yield self.max_allowed_packet()
+        effect = 0
+        for statement in self._bulk_statements(prefix, values, postfix, batch_size, max_packet):
+            count = yield self.query(statement)
+            effect += count
+        raise Return(effect)
+
+    @coroutine
+    def _execute_batch(self, sql, batch):
+        """在事务中执行一批语句,已经在事务中时由外层提交"""
+
+        own_event = not self._event
+        if own_event:
+            yield self.start_event()
+
+        effect = 0
+        try:
+            for args in batch:
+                count = yield self.exec_event(sql, args)
+                effect += count
+        except MysqlError:
+            if own_event:
+                self._event = False
+                yield self.rollback()
+            raise
+
+        if own_event:
+            yield self.end_event()
+        raise Return(effect)
+
+    def stream(self, sql, args=None, batch_size=DEFAULT_STREAM_BATCH, batches=False):
+        """流式查询,返回异步迭代对象
+
+        使用async for迭代,或循环yield stream.fetch()直到返回空列表
+        迭代结束或close之前连接一直被占用,提前结束迭代时需要调用close
+        """
+
+        return AsynMysqlStream(self, sql, args, batch_size, batches)
+
+    @coroutine
+    def _replica_query(self, replica, sql, args=None):
+        """在从库执行只读查询,从库不可用时返回None,改由主库执行"""
+
+        pool = self._replica_pool(replica)
+
+        try:
+            if pool.total < self.replica_pool and not pool.stats()['idle']:
+                # 没有空闲连接时直接建立连接,从库不可用时立即改由主库执行
+                yield pool.add_connection()
+            connection = yield pool.acquire()
+        except PoolError:
+            self.replica_set.release(replica)
+            self.recorder('WARN', '{obj} replica {replica} pool busy, fallback to primary'.format(obj=self,
+                                                                                                 replica=replica))
+            raise Return(None)
+        except MysqlError as e:
+            self._replica_failed(replica, e)
+            raise Return(None)
+
+        try:
+            conn = connection._conn
+            cur = conn.cursor(tornado_mysql.cursors.DictCursor)
+
+            self._format_sql(sql, args)
+            self.recorder('INFO', lazy('{obj} replica {replica} query start\n{sql}', obj=self, replica=replica,
+                                       sql=self._sql))
+            statement = self._statement(sql)
+            with self.span('replica query', unit='ms') as t:
+                if statement is not None:
+                    yield cur.execute(statement.render(args, conn.literal))
+                else:
+                    yield cur.execute(sql, args)
+            self._observe(sql, t.seconds, statement)
+            self.recorder('INFO', log_fields(lazy('{obj} replica {replica} query successful\n{sql}\t[{time}]\t[{effect}]',
+                                                  obj=self, replica=replica, sql=self._sql, time=t, effect=cur.rowcount),
+                                             self.name, 'replica query', t))
+        except (tornado_mysql.IntegrityError, tornado_mysql.ProgrammingError) as e:
+            pool.release(connection)
+            self.replica_set.release(replica)
+            self.recorder('ERROR', '{obj} query error\n{sql}\n[{msg}]'.format(obj=self, sql=sql, msg=e))
+            raise MysqlError
+        except (KeyError, TypeError) as e:
+            pool.release(connection)
+            self.replica_set.release(replica)
+            self.recorder('ERROR',
+                          '{obj} sql format error\n{sql}\n{args}\n[{msg}]'.format(obj=self, sql=sql, args=args,
+                                                                                  msg=e))
+            raise MysqlError
+        except (tornado_mysql.Error, iostream.StreamClosedError) as e:
+            self._replica_failed(replica, e, pool, connection)
+            raise Return(None)
+
+        # 结果已经读取到客户端,执行后即可归还从库连接
+        pool.release(connection)
+        self.replica_set.release(replica)
+        if self._cur:
+            yield self._cur.close()
+        self._cur = cur
+        raise Return(cur.rowcount)
+
     @coroutine
     def _query(self, sql, retry, args=None):
         if not self._cur:
@@ -399,13 +1472,18 @@ class AsynMysql(Mysql):
 
         try:
             self._format_sql(sql, args)
-            self.recorder('INFO', '{obj} query start ({threadid})\n{sql}'.format(obj=self,
-                          threadid=self._conn.server_thread_id[0], sql=sql))
-            with tool.timing('ms', 10) as t:
-                yield self._cur.execute(sql, args)
-            self.recorder('INFO',
-                          '{obj} query successful\n{sql}\t[{time}]\t[{effect}]'.format(obj=self, sql=sql, time=t,
-                                                                                       effect=self._cur.rowcount))
+            self.recorder('INFO', lazy('{obj} query start ({threadid})\n{sql}', obj=self,
+                                       threadid=self._conn.server_thread_id[0], sql=self._sql))
+            statement = self._statement(sql)
+            with self.span('query', unit='ms') as t:
+                if statement is not None:
+                    yield self._cur.execute(statement.render(args, self._conn.literal))
+                else:
+                    yield self._cur.execute(sql, args)
+            self._observe(sql, t.seconds, statement)
+            self.recorder('INFO', log_fields(lazy('{obj} query successful\n{sql}\t[{time}]\t[{effect}]', obj=self,
+                                                  sql=self._sql, time=t, effect=self._cur.rowcount),
+                                             self.name, 'query', t))
         except (tornado_mysql.OperationalError, tornado_mysql.InterfaceError, iostream.StreamClosedError) as e:
             self.recorder('ERROR', '{obj} mysql has gone away [{msg}]'.format(obj=self, msg=e))
             yield self.reconnect()
@@ -431,6 +1509,7 @@ class AsynMysql(Mysql):
     def rollback(self):
         """回滚"""
 
+        self._dirty_tables = set()
         yield self._conn.rollback()
 
     @coroutine
@@ -443,5 +1522,218 @@ class AsynMysql(Mysql):
     def close(self):
         """关闭连接"""
 
-        yield self._cur.close()
+        if self._cur:
+            yield self._cur.close()
         yield self._conn.close()
+
+
+class MysqlStream(object):
+    """流式查询结果
+
+    创建时即占用连接,读取完毕或close后释放
+    """
+
+    def __init__(self, mysql, sql, args=None, batch_size=DEFAULT_STREAM_BATCH, batches=False):
+        self.sql = sql
+        self.args = args
+        self.batch_size = batch_size
+        self.batches = batches
+        # 已读取的行数
+        self.rownumber = 0
+
+        self._mysql = mysql
+        self._cur = None
+        self._closed = False
+
+        mysql._open_stream(self)
+
+    def __str__(self):
+        return '<{cls} {rows} rows\n{sql}>'.format(cls=self.__class__.__name__, rows=self.rownumber, sql=self.sql)
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class SyncMysqlStream(MysqlStream):
+    """同步流式查询结果,基于SSDictCursor"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                rows = self.fetch()
+                if not rows:
+                    break
+
+                if self.batches:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+        finally:
+            self.close()
+
+    def _execute(self):
+        mysql = self._mysql
+        self._cur = mysql._conn.cursor(pymysql.cursors.SSDictCursor)
+
+        try:
+            mysql._format_sql(self.sql, self.args)
+            mysql.recorder('INFO', lazy('{obj} stream start\n{sql}', obj=mysql, sql=mysql._sql))
+            self._cur.execute(self.sql, self.args)
+        except pymysql.OperationalError as e:
+            mysql.recorder('ERROR', '{obj} mysql has gone away [{msg}]'.format(obj=mysql, msg=e))
+            self._cur = None
+            self.close()
+            mysql.reconnect()
+            raise MysqlError
+        except (pymysql.IntegrityError, pymysql.ProgrammingError, KeyError, TypeError) as e:
+            mysql.recorder('ERROR', '{obj} stream error\n{sql}\n[{msg}]'.format(obj=mysql, sql=self.sql, msg=e))
+            self.close()
+            raise MysqlError
+
+    def fetch(self):
+        """读取下一批数据,读取完毕时返回空列表并释放连接"""
+
+        if self._closed:
+            return []
+
+        if self._cur is None:
+            self._execute()
+
+        try:
+            rows = self._cur.fetchmany(self.batch_size)
+        except pymysql.OperationalError as e:
+            self._mysql.recorder('ERROR', '{obj} stream interrupted [{msg}]'.format(obj=self, msg=e))
+            self._cur = None
+            self.close()
+            self._mysql.reconnect()
+            raise MysqlError
+
+        if not rows:
+            self.close()
+            return []
+
+        self.rownumber += len(rows)
+        return list(rows)
+
+    def close(self):
+        """关闭游标并释放连接,未读取的数据会被丢弃"""
+
+        if self._closed:
+            return
+
+        self._closed = True
+        try:
+            if self._cur is not None:
+                self._cur.close()
+                self._mysql.recorder('INFO', lazy('{obj} stream end [{rows}]', obj=self._mysql, rows=self.rownumber))
+        except pymysql.Error as e:
+            self._mysql.recorder('WARN', '{obj} stream close error [{msg}]'.format(obj=self._mysql, msg=e))
+        finally:
+            self._cur = None
+            self._mysql._close_stream()
+
+
+class AsynMysqlStream(MysqlStream):
+    """异步流式查询结果,基于tornado_mysql的SSDictCursor"""
+
+    def __init__(self, mysql, sql, args=None, batch_size=DEFAULT_STREAM_BATCH, batches=False):
+        super(AsynMysqlStream, self).__init__(mysql, sql, args, batch_size, batches)
+        self._buffer = deque()
+
+    def __aiter__(self):
+        return self
+
+    @coroutine
+    def __anext__(self):
+        if self.batches:
+            rows = yield self.fetch()
+            if not rows:
+                raise StopAsyncIteration
+            raise Return(rows)
+
+        if not self._buffer:
+            rows = yield self.fetch()
+            if not rows:
+                raise StopAsyncIteration
+            self._buffer.extend(rows)
+        raise Return(self._buffer.popleft())
+
+    @coroutine
+    def __aenter__(self):
+        raise Return(self)
+
+    @coroutine
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        yield self.close()
+
+    @coroutine
+    def _execute(self):
+        mysql = self._mysql
+        self._cur = mysql._conn.cursor(tornado_mysql.cursors.SSDictCursor)
+
+        try:
+            mysql._format_sql(self.sql, self.args)
+            mysql.recorder('INFO', lazy('{obj} stream start\n{sql}', obj=mysql, sql=mysql._sql))
+            yield self._cur.execute(self.sql, self.args)
+        except (tornado_mysql.OperationalError, tornado_mysql.InterfaceError, iostream.StreamClosedError) as e:
+            mysql.recorder('ERROR', '{obj} mysql has gone away [{msg}]'.format(obj=mysql, msg=e))
+            self._cur = None
+            yield self.close()
+            yield mysql.reconnect()
+            raise MysqlError
+        except (tornado_mysql.IntegrityError, tornado_mysql.ProgrammingError, KeyError, TypeError) as e:
+            mysql.recorder('ERROR', '{obj} stream error\n{sql}\n[{msg}]'.format(obj=mysql, sql=self.sql, msg=e))
+            yield self.close()
+            raise MysqlError
+
+    @coroutine
+    def fetch(self):
+        """读取下一批数据,读取完毕时返回空列表并释放连接"""
+
+        if self._closed:
+            raise Return([])
+
+        if self._cur is None:
+            yield self._execute()
+
+        try:
+            rows = yield self._cur.fetchmany(self.batch_size)
+        except (tornado_mysql.OperationalError, tornado_mysql.InterfaceError, iostream.StreamClosedError) as e:
+            self._mysql.recorder('ERROR', '{obj} stream interrupted [{msg}]'.format(obj=self, msg=e))
+            self._cur = None
+            yield self.close()
+            yield self._mysql.reconnect()
+            raise MysqlError
+
+        if not rows:
+            yield self.close()
+            raise Return([])
+
+        self.rownumber += len(rows)
+        raise Return(list(rows))
+
+    @coroutine
+    def close(self):
+        """关闭游标并释放连接,未读取的数据会被丢弃"""
+
+        if self._closed:
+            return
+
+        self._closed = True
+        try:
+            if self._cur is not None:
+                yield self._cur.close()
+                self._mysql.recorder('INFO', lazy('{obj} stream end [{rows}]', obj=self._mysql, rows=self.rownumber))
+        except (tornado_mysql.Error, iostream.StreamClosedError) as e:
+            self._mysql.recorder('WARN', '{obj} stream close error [{msg}]'.format(obj=self._mysql, msg=e))
+        finally:
+            self._cur = None
+            self._mysql._close_stream()
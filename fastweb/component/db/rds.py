@@ -5,12 +5,13 @@ import shlex
 
 import tornadis
 from tornadis.exceptions import ConnectionError as torConnectionError
-from redis.exceptions import ConnectionError, TimeoutError, ResponseError
+from redis.exceptions import ConnectionError, TimeoutError, ResponseError, WatchError
 
 from fastweb.accesspoint import coroutine, Return
 
-import fastweb.util.tool as tool
 import fastweb.util.python as py
+from fastweb.util.log import lazy, log_fields
+from fastweb.util.metrics import COMPONENT_CALL
 from fastweb.exception import RedisError
 from fastweb.component import Component
 
@@ -20,6 +21,82 @@ DEFAULT_TIMEOUT = 5
 DEFAULT_CHARSET = 'utf8'
 
 
+def _split_command(args):
+    """单个字符串参数按命令行解析,单个列表参数展开,其余情况原样返回"""
+
+    if len(args) == 1:
+        if isinstance(args[0], str):
+            return shlex.split(args[0])
+        if isinstance(args[0], (list, tuple)):
+            return args[0]
+    return args
+
+
+def _command_name(args):
+    """命令名称,用于选择解析函数"""
+
+    name = args[0]
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    return name.upper()
+
+
+def _normalize_command(args):
+    """命令名称转为大写,redis-py按大写的命令名称查找回调"""
+
+    return (_command_name(args), ) + tuple(args[1:])
+
+
+def _format_command(args):
+    return ' '.join(str(_decode(arg)) for arg in args)
+
+
+def _decode(value):
+    """bytes解码为unicode,无法解码的二进制数据原样返回,保留list/tuple/set的类型"""
+
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    if isinstance(value, (list, tuple, set)):
+        return type(value)(_decode(v) for v in value)
+    return value
+
+
+def _decode_number(value):
+    if isinstance(value, (bytes, str)) and value.isdigit():
+        return int(value)
+    return value
+
+
+def _decode_hash(response):
+    """字典的field和value解码,数字字符串转为int"""
+
+    return dict((_decode_number(_decode(k)), _decode_number(_decode(v))) for k, v in response.items())
+
+
+def _decode_sequence(value):
+    """能解码的元素按序列格式解析为字典,二进制数据原样返回"""
+
+    value = _decode(value)
+    return py.sequence2dict(value) if isinstance(value, str) else value
+
+
+def _decode_sequence_list(response):
+    return [_decode_sequence(v) for v in response]
+
+
+# redis-py按命令名称注册的回调,把状态回复转为True,EXISTS转为bool,SMEMBERS转为set等
+RESPONSE_CALLBACKS = redis.StrictRedis.RESPONSE_CALLBACKS
+
+# 在回调的结果之上按命令名称选择解码函数,未列出的命令使用_decode
+RESPONSE_DECODERS = {
+    'HGETALL': _decode_hash,
+    'LRANGE': _decode_sequence_list,
+}
+
+
 class Redis(Component):
     """Redis基类
     TODO: 增加序列化json的功能"""
@@ -27,6 +104,9 @@ class Redis(Component):
     eattr = {'host': str}
     oattr = {'port': int, 'password': str, 'db': int, 'timeout': int, 'charset': str}
 
+    # 客户端没有应用redis-py回调时,由_parse_response按命令名称应用
+    response_callbacks = RESPONSE_CALLBACKS
+
     def __init__(self, setting):
         self.db = DEFAULT_DB
         self.port = DEFAULT_PORT
@@ -38,21 +118,22 @@ class Redis(Component):
         self._client = None
         self._command = None
 
-    def _parse_response(self, response):
-        """解析response"""
+    def _parse_response(self, response, command=None):
+        """解析response
 
-        if response == 'OK':
-            return True
-        elif isinstance(response, tornadis.ClientError):
+        :parameter:
+          - `response`:返回值
+          - `command`:命令名称,默认为最后执行的命令
+        """
+
+        if isinstance(response, tornadis.ClientError):
             raise RedisError(response)
-        else:
-            print(self._command)
-            # TODO: 根据不同类型的命令解析返回值
-            if self._command in ('HGETALL', ):
-                response = py.utf8(py.list2dict(response))
-            elif self._command in ('LRANGE', ):
-                response = [py.sequence2dict(i) for i in response]
-            return py.utf8(response)
+
+        command = command or self._command
+        callback = self.response_callbacks.get(command)
+        if callback is not None:
+            response = callback(response)
+        return RESPONSE_DECODERS.get(command, _decode)(response)
 
     def reconnect(self):
         pass
@@ -60,14 +141,94 @@ class Redis(Component):
     def ping(self):
         pass
 
-    def _parse_command(self, command):
-        self._command = py.sequence2list(command)[0].upper()
+    def query(self, *args):
+        """执行redis命令
+
+        兼容命令行形式: query('HGETALL key')
+        推荐直接传入参数: query('HGETALL', key),参数不会经过shlex解析
+        """
+
+        return self.execute(*_split_command(args))
+
+    def execute(self, *args):
+        """执行redis命令,参数原样发送,支持bytes
+
+        :parameter:
+          - `args`:命令名称及参数,如execute('HGETALL', key)
+        """
+
+        raise NotImplementedError
+
+    def pipeline(self, transaction=False):
+        """获取管道,多条命令一次发送
+
+        :parameter:
+          - `transaction`:是否使用MULTI/EXEC事务执行
+        """
+
+        raise NotImplementedError
+
+    def batch(self, commands, transaction=False):
+        """批量执行命令,按顺序返回解析后的结果
+
+        :parameter:
+          - `commands`:命令列表,每条命令为命令行字符串或参数列表
+          - `transaction`:是否使用MULTI/EXEC事务执行
+        """
+
+        raise NotImplementedError
+
+
+class RedisPipeline(object):
+    """redis管道基类
+
+    命令先在本地排队,execute时一次性写入,按顺序返回解析后的结果
+    transaction为True时使用MULTI/EXEC包裹,所有命令作为一个事务执行
+    """
+
+    def __init__(self, redis, transaction=False):
+        self._redis = redis
+        self.transaction = transaction
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __str__(self):
+        return '<{cls} {redis} {count} commands{tx}>'.format(cls=self.__class__.__name__,
+                                                             redis=self._redis,
+                                                             count=len(self._commands),
+                                                             tx=' (transaction)' if self.transaction else '')
+
+    def query(self, *args):
+        """加入一条命令
+
+        :parameter:
+          - `args`:命令行字符串,或命令名称及参数
+        """
+
+        self._commands.append(_split_command(args))
+        return self
+
+    def _parse_responses(self, responses):
+        """按顺序解析所有命令的返回值"""
+
+        return [self._redis._parse_response(response, _command_name(command))
+                for command, response in zip(self._commands, responses)]
+
+    def execute(self):
+        """执行管道中的所有命令"""
+
+        raise NotImplementedError
 
 
 class SyncRedis(Redis):
     """同步redis
        线程不安全"""
 
+    # redis-py的客户端和管道已经按命令名称应用了回调
+    response_callbacks = {}
+
     def __reduce__(self):
         return SyncRedis, (self.setting,)
 
@@ -87,19 +248,19 @@ class SyncRedis(Redis):
             raise RedisError
         return self
 
-    def query(self, command):
-        """命令行操作
+    def execute(self, *args):
+        """执行redis命令
            ConnectionError可能是超出连接最大数
            TimeoutError可能是连接不通"""
 
         try:
-            self._parse_command(command)
-            cmd = shlex.split(command)
-            self.recorder('INFO', '{obj} query start\n{cmd}'.format(obj=self, cmd=command))
-            with tool.timing('s', 10) as t:
-                response = self._client.execute_command(*cmd)
+            self._command = _command_name(args)
+            self.recorder('INFO', lazy('{obj} query start\n{cmd}', obj=self, cmd=_format_command(args)))
+            with self.span(self._command, COMPONENT_CALL.labels(self.name, self._command)) as t:
+                response = self._client.execute_command(*_normalize_command(args))
             response = self._parse_response(response)
-            self.recorder('INFO', '{obj} query successful\n{cmd} -- {time}'.format(obj=self, cmd=py.utf8(command), time=t))
+            self.recorder('INFO', log_fields(lazy('{obj} query successful\n{cmd} -- {time}', obj=self,
+                                                  cmd=_format_command(args), time=t), self.name, self._command, t))
         except (ConnectionError, TimeoutError) as e:
             # redis内部对这两种异常进行了重试操作
             self.recorder('ERROR', '{obj} connection error [{msg}]'.format(obj=self, msg=e))
@@ -110,6 +271,51 @@ class SyncRedis(Redis):
 
         return response
 
+    def pipeline(self, transaction=False):
+        """获取管道,多条命令一次发送"""
+
+        return SyncRedisPipeline(self, transaction)
+
+    def batch(self, commands, transaction=False):
+        """批量执行命令,按顺序返回解析后的结果"""
+
+        pipeline = self.pipeline(transaction)
+        for command in commands:
+            pipeline.query(command)
+        return pipeline.execute()
+
+
+class SyncRedisPipeline(RedisPipeline):
+    """同步redis管道,基于redis-py的pipeline"""
+
+    def execute(self):
+        """执行管道中的所有命令"""
+
+        if not self._commands:
+            return []
+
+        redis = self._redis
+
+        try:
+            redis.recorder('INFO', lazy('{obj} pipeline start', obj=self))
+            with redis.span('PIPELINE', COMPONENT_CALL.labels(redis.name, 'PIPELINE')) as t:
+                pipeline = redis._client.pipeline(transaction=self.transaction)
+                for command in self._commands:
+                    pipeline.execute_command(*_normalize_command(command))
+                responses = pipeline.execute()
+            responses = self._parse_responses(responses)
+            redis.recorder('INFO', lazy('{obj} pipeline successful -- {time}', obj=self, time=t))
+        except (ConnectionError, TimeoutError) as e:
+            redis.recorder('ERROR', '{obj} connection error [{msg}]'.format(obj=self, msg=e))
+            raise RedisError
+        except (ResponseError, WatchError) as e:
+            redis.recorder('ERROR', '{obj} pipeline error [{msg}]'.format(obj=self, msg=e))
+            raise RedisError
+        finally:
+            self._commands = []
+
+        return responses
+
 
 class AsynRedis(Redis):
     """异步redis组件"""
@@ -139,24 +345,86 @@ class AsynRedis(Redis):
         raise Return(self)
 
     @coroutine
-    def query(self, command):
+    def execute(self, *args):
         """执行redis命令"""
 
         try:
-            self._parse_command(command)
-            cmd = shlex.split(command)
-            self.recorder('INFO', '{obj} query start\nCommand: {cmd}'.format(obj=self, cmd=command))
-            with tool.timing('s', 10) as t:
+            self._command = _command_name(args)
+            self.recorder('INFO', lazy('{obj} query start\nCommand: {cmd}', obj=self, cmd=_format_command(args)))
+            with self.span(self._command, COMPONENT_CALL.labels(self.name, self._command)) as t:
                 if not self._client.is_connected():
                     yield self.connect()
-                response = yield self._client.call(*cmd)
+                response = yield self._client.call(*args)
             response = self._parse_response(response)
-            self.recorder('INFO', '{obj} query success\nCommand: {cmd}\nResponse: {res} -- {time}'.format(obj=self,
-                                                                                                          cmd=py.utf8(command),
-                                                                                                          res=py.utf8(response),
-                                                                                                          time=t))
+            self.recorder('INFO', log_fields(lazy('{obj} query success\nCommand: {cmd}\nResponse: {res} -- {time}',
+                                                  obj=self,
+                                                  cmd=_format_command(args),
+                                                  res=response,
+                                                  time=t), self.name, self._command, t))
         except torConnectionError as e:
             self.recorder('ERROR', '{obj} connection error [{msg}]'.format(obj=self, msg=e))
             raise RedisError
 
         raise Return(response)
+
+    def pipeline(self, transaction=False):
+        """获取管道,多条命令一次发送"""
+
+        return AsynRedisPipeline(self, transaction)
+
+    @coroutine
+    def batch(self, commands, transaction=False):
+        """批量执行命令,按顺序返回解析后的结果"""
+
+        pipeline = self.pipeline(transaction)
+        for command in commands:
+            pipeline.query(command)
+        responses = yield pipeline.execute()
+        raise Return(responses)
+
+
+class AsynRedisPipeline(RedisPipeline):
+    """异步redis管道,基于tornadis的Pipeline"""
+
+    @coroutine
+    def execute(self):
+        """执行管道中的所有命令"""
+
+        if not self._commands:
+            raise Return([])
+
+        redis = self._redis
+        pipeline = tornadis.Pipeline()
+
+        if self.transaction:
+            pipeline.stack_call('MULTI')
+        for command in self._commands:
+            pipeline.stack_call(*command)
+        if self.transaction:
+            pipeline.stack_call('EXEC')
+
+        try:
+            redis.recorder('INFO', lazy('{obj} pipeline start', obj=self))
+            with redis.span('PIPELINE', COMPONENT_CALL.labels(redis.name, 'PIPELINE')) as t:
+                if not redis._client.is_connected():
+                    yield redis.connect()
+                responses = yield redis._client.call(pipeline)
+
+            if isinstance(responses, torConnectionError):
+                raise responses
+
+            if self.transaction:
+                # MULTI和QUEUED之后,EXEC的返回值是所有命令的结果
+                responses = responses[-1]
+                if responses is None or isinstance(responses, tornadis.ClientError):
+                    redis.recorder('ERROR', '{obj} transaction aborted [{msg}]'.format(obj=self, msg=responses))
+                    raise RedisError
+            responses = self._parse_responses(responses)
+            redis.recorder('INFO', lazy('{obj} pipeline successful -- {time}', obj=self, time=t))
+        except torConnectionError as e:
+            redis.recorder('ERROR', '{obj} connection error [{msg}]'.format(obj=self, msg=e))
+            raise RedisError
+        finally:
+            self._commands = []
+
+        raise Return(responses)
@@ -2,13 +2,14 @@
 
 import os
 import six
+from functools import partial
 
 from thrift import TTornado
 from thrift.protocol import TCompactProtocol
 from thrift.transport import TTransport, TSocket
-from fastweb.accesspoint import coroutine, Return
+from fastweb.accesspoint import (coroutine, Return, gen, ioloop, AsynSemaphore, AsynLock, AsynTimeoutError)
 
-from fastweb.util.log import recorder
+from fastweb.util.log import recorder, lazy
 from fastweb.component import Component
 from fastweb.exception import RpcError, ConfigurationError
 from fastweb.util.python import AsynProxyCall, ExceptionProcessor, load_module
@@ -25,8 +26,155 @@ TftRpc是Thrift客户端的实现，fastweb.service.Service是Thrift服务端的
 关于Protocal:
     Thrift官方实现了多种Protocal，目前选择的是TCompactProtocol，一种压缩的高性能二进制编码，这种传输方式类似于ProtocolBuffer，性能会
     比TBinaryProtocol高
+
+关于多路复用:
+    tornado生成的异步Client按seqid匹配响应,同一个连接上可以同时有多个未完成的调用
+    配置multiplex后,每个AsynTftRpc(连接池中的每个连接)使用自己的TftMultiplexer,同一组件上并发的调用共用这个连接
+    TTornadoServer按顺序处理同一连接上的请求,多个连接之间才能并行,并行度由连接池的连接数决定
 """
 
+# 多路复用连接上同时进行的调用数
+DEFAULT_MULTIPLEX = 100
+# 单次调用的最大时间(秒),为0时不限制
+DEFAULT_DEADLINE = 0
+
+
+class TftMultiplexer(object):
+    """多路复用的异步Thrift连接
+
+    同时进行的调用数不超过concurrency,等待并发名额的时间也计入deadline
+    超过deadline的调用抛出RpcError,迟到的响应被丢弃
+    连接断开时未完成的调用抛出TTransportException,下次调用前自动重连
+
+    :parameter:
+      - `host`:服务地址
+      - `port`:服务端口
+      - `module`:thrift模块路径
+      - `concurrency`:同时进行的最大调用数
+      - `deadline`:单次调用的最大时间(秒),为0时不限制
+    """
+
+    def __init__(self, host, port, module, concurrency=DEFAULT_MULTIPLEX, deadline=DEFAULT_DEADLINE):
+        self.host = host
+        self.port = port
+        self.module = module
+        self.concurrency = concurrency
+        self.deadline = deadline
+
+        self._cls = getattr(load_module(module), 'Client')
+        self._transport = None
+        self._client = None
+        self._semaphore = AsynSemaphore(concurrency)
+        # 同一时间只有一个重连
+        self._lock = AsynLock()
+        self._stats = {'calls': 0, 'errors': 0, 'timeouts': 0, 'connects': 0, 'inflight': 0, 'peak': 0}
+
+    def __str__(self):
+        return '<TftMultiplexer {host} {port} {module} {concurrency}>'.format(host=self.host, port=self.port,
+                                                                             module=self.module,
+                                                                             concurrency=self.concurrency)
+
+    def __getattr__(self, name):
+        """获取远程调用方法"""
+
+        if name.startswith('_') or not hasattr(self._cls, name):
+            raise AttributeError(name)
+        return partial(self.call, name)
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    @coroutine
+    def connect(self):
+        """建立连接,已经连接时直接返回"""
+
+        with (yield self._lock.acquire()):
+            if self._client is None:
+                recorder('INFO', '{obj} connect start'.format(obj=self))
+                transport = TTornado.TTornadoStreamTransport(self.host, self.port)
+
+                try:
+                    yield transport.open()
+                except TTransport.TTransportException as e:
+                    recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=e))
+                    raise RpcError
+
+                transport.set_close_callback(partial(self._on_close, transport))
+                self._transport = transport
+                self._client = self._cls(transport, TCompactProtocol.TCompactProtocolFactory())
+                self._stats['connects'] += 1
+                recorder('INFO', '{obj} connect successful'.format(obj=self))
+
+        raise Return(self)
+
+    def _on_close(self, transport):
+        """连接断开,下次调用时重连"""
+
+        if transport is self._transport:
+            recorder('WARN', '{obj} connection closed'.format(obj=self))
+            self._transport = None
+            self._client = None
+
+    @coroutine
+    def call(self, name, *args, **kwargs):
+        """远程调用"""
+
+        io_loop = ioloop.IOLoop.current()
+        deadline = io_loop.time() + self.deadline if self.deadline else None
+
+        try:
+            yield self._semaphore.acquire(deadline)
+        except AsynTimeoutError:
+            self._stats['timeouts'] += 1
+            recorder('ERROR', '{obj} <{name}> wait timeout ({deadline}s)'.format(obj=self, name=name,
+                                                                                deadline=self.deadline))
+            raise RpcError
+
+        self._stats['calls'] += 1
+        self._stats['inflight'] += 1
+        self._stats['peak'] = max(self._stats['peak'], self._stats['inflight'])
+
+        try:
+            if self._client is None:
+                yield self.connect()
+
+            client = self._client
+            try:
+                future = getattr(client, name)(*args, **kwargs)
+            except TTransport.TTransportException:
+                # 请求没有发出,不会有响应
+                client._reqs.pop(client._seqid, None)
+                self.close()
+                raise
+            seqid = client._seqid
+
+            try:
+                ret = yield (gen.with_timeout(deadline, future) if deadline else future)
+            except AsynTimeoutError:
+                client._reqs.pop(seqid, None)
+                self._stats['timeouts'] += 1
+                recorder('ERROR', '{obj} <{name}> deadline exceeded ({deadline}s)'.format(obj=self, name=name,
+                                                                                         deadline=self.deadline))
+                raise RpcError
+            raise Return(ret)
+        except TTransport.TTransportException:
+            self._stats['errors'] += 1
+            raise
+        finally:
+            self._stats['inflight'] -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return dict(self._stats)
+
+    def close(self):
+        """关闭连接,未完成的调用抛出TTransportException"""
+
+        transport, self._transport, self._client = self._transport, None, None
+        if transport:
+            transport.close()
+
 
 class TftRpc(Component):
 
@@ -84,7 +232,7 @@ class SyncTftRpc(TftRpc):
             self._transport.open()
             self.recorder('INFO', '{obj} connect successful'.format(obj=self))
         except TTransport.TTransportException as e:
-            self.recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=e)) if self.recorder else recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=ex))
+            self._recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=e))
             raise RpcError
 
         return self
@@ -95,9 +243,9 @@ class SyncTftRpc(TftRpc):
     def __getattr__(self, name):
         self._client._seqid = int(self.owner.requestid) if self.owner else 0
         if hasattr(self._client, name):
-            self._recorder('INFO', 'call {obj} {name} start'.format(obj=self, name=name))
+            self._recorder('INFO', lazy('call {obj} {name} start', obj=self, name=name))
             r = getattr(self._client, name)
-            self._recorder('INFO', 'call {obj} {name} success'.format(obj=self, name=name))
+            self._recorder('INFO', lazy('call {obj} {name} success', obj=self, name=name))
             return r
         else:
             raise AttributeError
@@ -107,7 +255,17 @@ class SyncTftRpc(TftRpc):
 
 
 class AsynTftRpc(TftRpc):
-    """Thrift Rpc异步组件"""
+    """Thrift Rpc异步组件
+
+    配置multiplex(同时进行的最大调用数)后组件使用自己的TftMultiplexer连接,deadline为单次调用的最大时间(秒)
+    """
+
+    oattr = {'multiplex': int, 'deadline': float}
+
+    def __init__(self, setting):
+        super(AsynTftRpc, self).__init__(setting)
+
+        self.multiplexer = None
 
     def __str__(self):
         return '<AsynTftRpc {host} {port} {module} {name}>'.format(
@@ -122,6 +280,18 @@ class AsynTftRpc(TftRpc):
 
         if isinstance(self.thrift_module, six.string_types):
             module = load_module(self.thrift_module)
+        else:
+            self.recorder('ERROR', '{obj} module [{module}] load error'.format(obj=self,
+                                                                               module=self.thrift_module))
+            raise ConfigurationError
+
+        if self.setting.get('multiplex'):
+            if self.multiplexer is None:
+                self.multiplexer = TftMultiplexer(self.host, self.port, self.thrift_module, self.setting['multiplex'],
+                                                  self.setting.get('deadline') or DEFAULT_DEADLINE)
+            yield self.multiplexer.connect()
+            self._client = self.other = self.multiplexer
+            raise Return(self)
 
         self.recorder('INFO', '{obj} connect start'.format(obj=self))
         self._transport = TTornado.TTornadoStreamTransport(self.host, self.port)
@@ -137,25 +307,40 @@ class AsynTftRpc(TftRpc):
         try:
             yield self._transport.open()
         except TTransport.TTransportException as e:
-            self.recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=e)) if self.recorder else recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=ex))
+            self._recorder('ERROR', '{obj} connect error ({e})'.format(obj=self, e=e))
             raise RpcError
 
+    @coroutine
     def reconnect(self):
-        pass
+        """重新连接
+
+        原连接的接收循环已经结束,需要重建transport和client
+        """
+
+        if self.multiplexer:
+            yield self.multiplexer.connect()
+        else:
+            self._transport and self._transport.close()
+            yield self.connect()
+        raise Return(self)
 
     def __getattr__(self, name):
         """获取远程调用方法"""
         # self._client._seqid = int(self.owner.requestid) if self.owner else 0
-        exception_processor = ExceptionProcessor(AttributeError, self._connect)
+        exception_processor = ExceptionProcessor(AttributeError, self.reconnect)
 
         if hasattr(self._client, name):
-            self._recorder('INFO', 'call {obj} {name} start'.format(obj=self, name=name))
+            self._recorder('INFO', lazy('call {obj} {name} start', obj=self, name=name))
             r = AsynProxyCall(self, name, throw_exception=RpcError, exception_processor=exception_processor)
-            self._recorder('INFO', 'call {obj} {name} success'.format(obj=self, name=name))
+            self._recorder('INFO', lazy('call {obj} {name} success', obj=self, name=name))
             return r
         else:
             raise AttributeError
 
     def close(self):
         """关闭连接"""
-        self._transport.close()
+
+        if self.multiplexer:
+            self.multiplexer.close()
+        else:
+            self._transport.close()
@@ -3,19 +3,24 @@
 """任务模块"""
 
 import json
+import time
+from collections import OrderedDict
 
 import fastweb
 from fastweb.loader import app
 from fastweb.spec import torcelery
-from fastweb.util.tool import timing
+from fastweb.util.tool import timing, uniqueid
 from fastweb.component import Component
 from fastweb.exception import TaskError
-from fastweb.accesspoint import CeleryTask, Celery, RMQueue, Exchange, coroutine, Return, crontab
+from fastweb.accesspoint import (CeleryTask, Celery, RMQueue, Exchange, coroutine, Return, crontab,
+                                 CeleryTimeoutError)
 
 from celery.loaders.base import BaseLoader
 
 
 DEFAULT_TIMEOUT = 5
+# 同步等待结果时轮询的间隔(秒),redis结果后端使用发布订阅,不需要轮询
+DEFAULT_INTERVAL = 0.05
 
 
 class TaskLoader(BaseLoader):
@@ -92,6 +97,51 @@ class Task(Component, CeleryTask):
         self.application = app
         self.bind(app)
 
+    def _publish_many(self, args_list, kwargs_list=None):
+        """通过同一个producer批量发送任务,返回taskid列表
+
+        taskid为 requestid-任务名-批次id-序号,同一请求多次批量调用的taskid不会重复
+        """
+
+        self.requestid = self.owner.requestid + '-' + self.name if self.owner else None
+        batch = uniqueid()
+        task_ids = ['{requestid}-{batch}-{index}'.format(requestid=self.requestid, batch=batch, index=index)
+                    for index in range(len(args_list))] if self.requestid else None
+
+        with timing('ms', 10) as t:
+            results = torcelery.publish_many(self, args_list, kwargs_list, task_ids,
+                                             queue=self.queue,
+                                             exchange=self.exchange,
+                                             routing_key=self.routing_key)
+        self.recorder('INFO', 'batch call {obj} {count} tasks successful -- {t}'.format(obj=self,
+                                                                                    count=len(results),
+                                                                                    t=t))
+        return [result.id for result in results]
+
+    def _gathered(self, task_ids, metas, t):
+        """整理批量等待的结果
+
+        :return: (已结束任务的 taskid->结果 有序字典, 未结束的taskid列表)
+        """
+
+        results = OrderedDict()
+        pending = []
+        for task_id in task_ids:
+            meta = metas.get(task_id)
+            if meta is None:
+                pending.append(task_id)
+            else:
+                results[task_id] = meta['result']
+
+        if pending:
+            self.recorder('WARN', 'gather {obj} {done}/{count} tasks, {pending} timeout -- {t}'.format(
+                obj=self, done=len(results), count=len(task_ids), pending=len(pending), t=t))
+        else:
+            self.recorder('INFO', 'gather {obj} {count} tasks successful -- {t}'.format(obj=self,
+                                                                                    count=len(task_ids),
+                                                                                    t=t))
+        return results, pending
+
 
 class SyncTask(Task):
     """同步任务类"""
@@ -129,9 +179,10 @@ class SyncTask(Task):
                                       *args,
                                       **kwargs)
 
-            while True:
-                if result.ready():
-                    break
+            try:
+                result.get(timeout=self.timeout, interval=DEFAULT_INTERVAL, propagate=False)
+            except CeleryTimeoutError:
+                result = None
 
         if not result:
             self.recorder('ERROR',
@@ -143,6 +194,47 @@ class SyncTask(Task):
                                                                                          t=t))
         return result.result
 
+    def call_many(self, args_list, kwargs_list=None):
+        """批量异步调用,所有任务通过同一个producer发送
+
+        :parameter:
+          - `args_list`:每个任务的位置参数
+          - `kwargs_list`:每个任务的关键字参数
+
+        :return: taskid列表
+        """
+
+        return self._publish_many(args_list, kwargs_list)
+
+    def gather(self, task_ids, timeout=None):
+        """等待多个任务结束,所有任务共用同一个截止时间
+
+        :parameter:
+          - `task_ids`:taskid列表
+          - `timeout`:超时时间,默认为任务的timeout
+
+        :return: (已结束任务的 taskid->结果 有序字典, 未结束的taskid列表)
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        metas = {}
+        with timing('ms', 10) as t:
+            try:
+                if hasattr(self.backend, 'get_many'):
+                    for task_id, meta in self.backend.get_many(task_ids, timeout=timeout, interval=DEFAULT_INTERVAL):
+                        metas[task_id] = meta
+                else:
+                    deadline = time.time() + timeout
+                    for task_id in task_ids:
+                        result = self.AsyncResult(task_id)
+                        result.get(timeout=max(deadline - time.time(), 0), interval=DEFAULT_INTERVAL,
+                                   propagate=False)
+                        metas[task_id] = {'result': result.result}
+            except CeleryTimeoutError:
+                pass
+
+        return self._gathered(task_ids, metas, t)
+
 
 class AsynTask(Task):
     """异步任务类"""
@@ -159,13 +251,18 @@ class AsynTask(Task):
                                                                                                     args=args,
                                                                                                     kwargs=kwargs))
             # 调用task层时，调用方的requestid会成为本次任务的taskid， 任务的requesid也为透传id
-            taskid = yield torcelery.async(self,
-                                           task_id=self.requestid,
-                                           queue=self.queue,
-                                           exchange=self.exchange,
-                                           routing_key=self.routing_key,
-                                           *args,
-                                           **kwargs)
+            taskid = yield torcelery.asyn(self, self.timeout,
+                                          task_id=self.requestid,
+                                          queue=self.queue,
+                                          exchange=self.exchange,
+                                          routing_key=self.routing_key,
+                                          *args,
+                                          **kwargs)
+
+        if not taskid:
+            self.recorder('ERROR', 'asynchronous call {obj} timeout -- {t}'.format(obj=self, t=t))
+            raise TaskError
+
         self.recorder('INFO', 'asynchronous call {obj} successful -- {t}'.format(obj=self, t=t))
         raise Return(taskid)
 
@@ -197,3 +294,32 @@ class AsynTask(Task):
                                                            ret=result,
                                                            t=t))
         raise Return(result)
+
+    @coroutine
+    def call_many(self, args_list, kwargs_list=None):
+        """批量异步调用,所有任务通过同一个producer发送
+
+        :parameter:
+          - `args_list`:每个任务的位置参数
+          - `kwargs_list`:每个任务的关键字参数
+
+        :return: taskid列表
+        """
+
+        raise Return(self._publish_many(args_list, kwargs_list))
+
+    @coroutine
+    def gather(self, task_ids, timeout=None):
+        """并发等待多个任务结束,所有任务共用同一个截止时间
+
+        :parameter:
+          - `task_ids`:taskid列表
+          - `timeout`:超时时间,默认为任务的timeout
+
+        :return: (已结束任务的 taskid->结果 有序字典, 未结束的taskid列表)
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        with timing('ms', 10) as t:
+            metas = yield torcelery.gather(self.backend, task_ids, timeout)
+        raise Return(self._gathered(task_ids, dict(zip(task_ids, metas)), t))
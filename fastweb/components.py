@@ -12,13 +12,15 @@ import fastweb.manager
 from fastweb import app
 from fastweb.compat import subprocess
 from fastweb.spec.req import HttpClient
-from fastweb.util.log import record, recorder
-from fastweb.util.tool import uniqueid, timing, RetryPolicy, Retry
-from fastweb.accesspoint import CachingClient, UsernameToken, Error, Transport, RequestHTTPError
+from fastweb.util.log import record, recorder, lazy, log_fields
+from fastweb.util.metrics import COMPONENT_CALL
+from fastweb.util.tool import uniqueid, timing, RetryPolicy, Retry, SpanTree
+from fastweb.accesspoint import (CachingClient, UsernameToken, Error, Transport, RequestHTTPError, coroutine, Return,
+                                 maybe_future)
 from fastweb.exception import ComponentError, SubProcessError, SubProcessTimeoutError, HttpError, SoapError
 
 
-__all__ = ['UsernameToken', 'Components']
+__all__ = ['UsernameToken', 'Components', 'PendingComponent']
 
 
 class Components(object):
@@ -36,6 +38,8 @@ class Components(object):
         self.errcode = fastweb.loader.app.errcode
         self.configs = fastweb.loader.app.configs
         self.requestid = self.gen_requestid()
+        # 请求的调用树,组件调用自动记录为当前span的子节点
+        self.spans = SpanTree()
 
         # 组件缓冲池,确保同一请求对同一组件只获取一次
         self._components = {}
@@ -48,7 +52,8 @@ class Components(object):
         """
 
         if name in self._blacklist:
-            recorder('WARN', '{attr} in blacklist'.format(attr=name))
+            # tornado等框架会通过hasattr探测这些属性,每个请求都会发生
+            recorder('DEBUG', lazy('{attr} in blacklist', attr=name))
             raise AttributeError
 
         # 缓冲池中存在则使用缓冲池中的组件
@@ -62,22 +67,46 @@ class Components(object):
                 raise ComponentError
 
             self._components[name] = component
-            self.recorder('DEBUG', '{obj} get component from manager {name} {com}'.format(obj=self,
-                                                                                          name=name,
-                                                                                          com=component))
+            self.recorder('DEBUG', lazy('{obj} get component from manager {name} {com}', obj=self,
+                                        name=name,
+                                        com=component))
             return component
         else:
-            self.recorder('DEBUG', '{obj} get component from components cache {name} {com}'.format(obj=self,
-                                                                                                   name=name,
-                                                                                                   com=component))
+            self.recorder('DEBUG', lazy('{obj} get component from components cache {name} {com}', obj=self,
+                                        name=name,
+                                        com=component))
             return component
 
+    def reset(self, requestid=None):
+        """重置请求状态,复用对象处理下一个请求
+
+        :parameter:
+          - `requestid`:请求id,为空时重新生成
+        """
+
+        self.requestid = requestid or self.gen_requestid()
+        self.spans = SpanTree()
+        self._components.clear()
+
     @staticmethod
     def gen_requestid():
         """生成requestid"""
 
         return str(uniqueid())
 
+    def span(self, name, sink=None, unit='ms', precision=3):
+        """记录请求中的一段耗时,可以嵌套,释放组件时输出请求的耗时分布
+
+        with self.span('load user'):
+            user = self.mysql.query(sql)
+
+        :parameter:
+          - `name`:名称
+          - `sink`:接收耗时(秒)的对象,如指标直方图
+        """
+
+        return self.spans.span(name, unit, precision, sink)
+
     def load_executor(self, size):
         """加载当前handler级别的线程池"""
 
@@ -107,17 +136,63 @@ class Components(object):
           - `msg`:记录信息
         """
 
-        record(level, msg, app.application_recorder, extra={'requestid': self.requestid})
+        record(level, msg, app.application_recorder, requestid=self.requestid)
 
     def release(self):
         """释放组件"""
 
         for name, component in list(self._components.items()):
             fastweb.manager.Manager.return_component(name, component)
-            self.recorder('DEBUG', '{com} return manager'.format(com=component))
+            self.recorder('DEBUG', lazy('{com} return manager', com=component))
 
         self._components.clear()
         self.recorder('INFO', 'release all used components')
+        if self.spans:
+            self.recorder('DEBUG', lazy('{obj} spans\n{spans}', obj=self, spans=self.spans))
+
+
+class PendingComponent(object):
+    """异步连接池中尚未获取的组件
+
+    调用组件方法时先通过owner.acquire按先来先得的顺序等待空闲连接,获取后组件放入组件缓冲池,
+    之后访问该属性直接返回组件,所以连接池为空时请求会排队等待而不是直接失败
+    组件的同步方法需要先等待获取组件
+    yield self.mysql.query(sql)
+    redis = yield self.redis.acquire()
+
+    :parameter:
+      - `owner`:宿主,AsynComponents对象
+      - `name`:组件名称
+    """
+
+    __slots__ = ('owner', 'name')
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def acquire(self, timeout=None):
+        """等待获取组件"""
+
+        return self.owner.acquire(self.name, timeout)
+
+    def __await__(self):
+        return self.acquire().__await__()
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+
+        @coroutine
+        def call(*args, **kwargs):
+            component = yield self.acquire()
+            ret = yield maybe_future(getattr(component, attr)(*args, **kwargs))
+            raise Return(ret)
+
+        return call
+
+    def __str__(self):
+        return '<PendingComponent|{name}>'.format(name=self.name)
 
 
 class SyncComponents(Components):
@@ -145,14 +220,15 @@ class SyncComponents(Components):
 
         _recorder('INFO', 'http request start {request}'.format(request=request))
 
-        with timing('ms', 10) as t:
+        with self.span(('http', request.method), COMPONENT_CALL.labels('http', request.method), 'ms', 10) as t:
             try:
                 response = HttpClient().fetch(request)
             except RequestHTTPError as ex:
                 _recorder('ERROR', 'http request error {request} {e}'.format(request=request, e=ex))
                 raise retry
 
-        _recorder('INFO', 'http request successful\n{response} -- {time}'.format(response=response.status_code, time=t))
+        _recorder('INFO', log_fields('http request successful\n{response} -- {time}'.format(
+            response=response.status_code, time=t), 'http', request.method, t))
         return response
 
     def call_subprocess(self, command, stdin_data=None, timeout=None):
@@ -5,6 +5,7 @@
 所有工作都是在启动前完成,外部导入全部使用全路径引用,防止错误的引入
 """
 
+import copy
 import json
 
 from .accesspoint import ioloop
@@ -13,7 +14,8 @@ import fastweb.manager
 from fastweb.util.tool import timing
 from fastweb.accesspoint import AsyncHTTPClient
 from fastweb.util.configuration import ConfigurationParser
-from fastweb.util.log import setup_logging, getLogger, recorder, check_logging_level, set_record_color
+from fastweb.util.log import (setup_logging, getLogger, recorder, check_logging_level, set_record_color,
+                              AsynLogHandler, LOG_DROP, DEFAULT_LOG_CAPACITY)
 
 
 __all__ = ['app']
@@ -40,12 +42,17 @@ class Loader(object):
 
         # 日志是否被设置过
         self.bRecorder = False
+        # 异步日志设置,None时web和service层自动开启
+        self.asyn_recorder = None
+        self.asyn_recorder_setting = {}
+        self.asyn_handlers = []
 
         # 增加最大数据量
         AsyncHTTPClient.configure(None, max_body_size=1000000000)
 
     def load_recorder(self, application_log_path=DEFAULT_APP_LOG_PATH, system_log_path=DEFAULT_SYS_LOG_PATH,
-                      logging_setting=None, application_level='DEBUG', system_level='DEBUG', logging_colormap=None):
+                      logging_setting=None, application_level='DEBUG', system_level='DEBUG', logging_colormap=None,
+                      asyn=None, capacity=DEFAULT_LOG_CAPACITY, policy=LOG_DROP, structured=False):
         """加载日志对象
 
         需要最先加载,因为其他加载都需要使用recorder
@@ -60,15 +67,25 @@ class Loader(object):
           - `application_level`: 应用日志输出级别
           - `system_level`: 系统日志输出级别
           - `logging_colormap`: 输出日志颜色
+          - `asyn`: 是否使用异步日志,文件和终端IO在后台线程中完成,为None时加载web和service层组件时自动开启
+          - `capacity`: 异步日志队列容量
+          - `policy`: 异步日志队列满时的处理方式,drop丢弃或block阻塞
+          - `structured`: 文件日志是否使用结构化格式,每条日志一行json,可以用fastlog按requestid建立索引和查询
         """
 
         if not logging_setting:
             from fastweb.setting.default_logging import DEFAULT_LOGGING_SETTING
-            logging_setting = DEFAULT_LOGGING_SETTING
+            # 不修改默认配置,重新加载时不受上一次设置的影响
+            logging_setting = copy.deepcopy(DEFAULT_LOGGING_SETTING)
 
         logging_setting['handlers']['application_file_time_handler']['filename'] = application_log_path
         logging_setting['handlers']['system_file_size_handler']['filename'] = system_log_path
 
+        if structured:
+            logging_setting['formatters'].setdefault('json_formatter', {'()': 'fastweb.util.log.JsonFormatter'})
+            logging_setting['handlers']['application_file_time_handler']['formatter'] = 'json_formatter'
+            logging_setting['handlers']['system_file_size_handler']['formatter'] = 'json_formatter'
+
         if application_level:
             check_logging_level(application_level)
             logging_setting['loggers']['application_recorder']['level'] = application_level
@@ -81,6 +98,12 @@ class Loader(object):
 
         self.system_recorder = getLogger('system_recorder')
         self.application_recorder = getLogger('application_recorder')
+        self.asyn_recorder = asyn
+        self.asyn_recorder_setting = {'capacity': capacity, 'policy': policy}
+        # 重新加载时dictConfig已经关闭了之前的目标handler
+        self.asyn_handlers = []
+        if asyn:
+            self.load_asyn_recorder()
 
         if logging_colormap:
             set_record_color(logging_colormap)
@@ -95,6 +118,24 @@ class Loader(object):
                                                                sys_path=system_log_path,
                                                                sys_level=system_level))
 
+    def load_asyn_recorder(self):
+        """把application_recorder和system_recorder的handler替换为AsynLogHandler
+
+        load_recorder时asyn为False则不替换,已经替换过不会重复替换
+        """
+
+        if self.asyn_recorder is False or self.asyn_handlers:
+            return
+
+        for logger in (self.application_recorder, self.system_recorder):
+            if logger is None or not logger.handlers:
+                continue
+            handler = AsynLogHandler(logger.handlers, **self.asyn_recorder_setting)
+            logger.handlers = [handler]
+            self.asyn_handlers.append(handler)
+
+        recorder('INFO', 'load asynchronous recorder {setting}'.format(setting=self.asyn_recorder_setting))
+
     def load_configuration(self, backend='ini', **setting):
         """加载配置文件
 
@@ -125,6 +166,9 @@ class Loader(object):
         layout = layout.lower()
         configer = ConfigurationParser(backend, **setting)
 
+        if layout in ['web', 'service']:
+            self.load_asyn_recorder()
+
         # 加载需要管理连接池的组件
         recorder('INFO', 'load connection component start')
         with timing('ms', 10) as t:
@@ -2,12 +2,14 @@
 
 """组件管理模块"""
 
+import os
 import json
 from collections import defaultdict
 
 import fastweb.loader
 from fastweb.util.log import recorder
-from .accesspoint import coroutine
+from fastweb.util.metrics import registry, GAUGE
+from .accesspoint import coroutine, Return, ioloop
 from fastweb.exception import ManagerError
 from fastweb.pool import ConnectionPool, SyncConnectionPool, AsynConnectionPool
 
@@ -27,8 +29,11 @@ class Manager(object):
 
     # 组件池 _pools: {component_name: component_pool}
     # 被分类的组件池 _classified_pools: {cpre: [obj, obj, ..]}
+    # 已安装的不需要连接池的组件 _setups: [(layout, configer), ..],fork之后在子进程中重新创建
     _pools = {}
     _classified_pools = defaultdict(list)
+    _setups = []
+    _setup_pid = None
 
     @staticmethod
     def setup(layout, configer):
@@ -48,6 +53,8 @@ class Manager(object):
             raise ManagerError
 
         if configer:
+            Manager._setups.append((layout, configer))
+            Manager._setup_pid = os.getpid()
             for (cpre, cls) in components:
                 components = configer.get_components(cpre)
 
@@ -61,6 +68,22 @@ class Manager(object):
 
         recorder('DEBUG', 'manager setup successful\n{pool}'.format(pool=Manager._pools))
 
+    @staticmethod
+    def get_pool_options(config):
+        """从组件配置中获取连接池参数
+
+        :parameter:
+          - `config`:组件配置
+        """
+
+        return {'awake': config.get('awake'),
+                'maxconnections': config.get('maxconnections'),
+                'timeout': config.get('acquire_timeout'),
+                'idle': config.get('idle_timeout'),
+                'validate_idle': config.get('validate_idle'),
+                'max_lifetime': config.get('max_lifetime'),
+                'max_idle': config.get('max_idle')}
+
     @staticmethod
     def get_classified_components(cpre):
         """获取被分类的组件"""
@@ -90,6 +113,41 @@ class Manager(object):
                      'get component ({name}) error,please check configuration\n{conf}'.format(conf=json.dumps(fastweb.loader.app.configs), name=name))
             raise ManagerError
 
+    @staticmethod
+    def is_asyn_pool(name):
+        """组件是否来自异步连接池,异步连接池的组件需要通过acquire_component等待获取"""
+
+        return isinstance(Manager._pools.get(name), AsynConnectionPool)
+
+    @staticmethod
+    @coroutine
+    def acquire_component(name, owner, timeout=None):
+        """通过manager异步获取组件
+
+        异步连接池为空时等待空闲连接,不会阻塞IOLoop
+
+        :parameter:
+          - `name`:组件名称
+          - `owner`:宿主
+          - `timeout`:最大等待时间(秒),默认使用连接池配置
+        """
+
+        pool = Manager._pools.get(name)
+
+        if pool:
+            if isinstance(pool, AsynConnectionPool):
+                component = yield pool.acquire(timeout)
+            elif isinstance(pool, ConnectionPool):
+                component = pool.get_connection()
+            else:
+                component = pool
+            component.set_used(owner)
+            raise Return(component)
+        else:
+            recorder('CRITICAL',
+                     'get component ({name}) error,please check configuration\n{conf}'.format(conf=json.dumps(fastweb.loader.app.configs), name=name))
+            raise ManagerError
+
     @staticmethod
     def return_component(name, component):
         """归还组件
@@ -101,16 +159,69 @@ class Manager(object):
 
         pool = Manager._pools.get(name)
 
+        if pool and getattr(component, 'streaming', False):
+            # 流式查询未结束,结束后再归还
+            component.on_stream_end(lambda: Manager.return_component(name, component))
+            return
+
         if pool:
             if isinstance(pool, ConnectionPool):
-                pool.return_connection(component)
+                # 先重置状态再归还,归还后连接可能立即被其他线程获取
                 component.set_idle()
+                pool.return_connection(component)
         else:
             recorder('CRITICAL',
                      'please check configuration\n{conf}\n{name}'.format(conf=json.dumps(fastweb.loader.app.configs),
                                                                          name=name))
             raise ManagerError
 
+    @staticmethod
+    def pool_metrics():
+        """连接池的连接数,导出指标时读取"""
+
+        samples = []
+        for name, pool in sorted(Manager._pools.items()):
+            if isinstance(pool, ConnectionPool):
+                stats = pool.stats()
+                for state in ('total', 'idle', 'used'):
+                    if state in stats:
+                        samples.append(({'pool': name, 'state': state}, stats[state]))
+        return [('fastweb_pool_connections', GAUGE, 'Pooled connections by state', samples)]
+
+    @staticmethod
+    def reset_connection_pools(asyn=False):
+        """按已加载的配置重新创建连接池和不需要连接池的组件
+
+        fork之后子进程不能继续使用父进程建立的连接,丢弃(不关闭)继承的连接池,在当前进程中重新创建
+        任务producer等不需要连接池的组件同样持有连接,在fork出的子进程中重新创建
+        异步服务需要异步连接池,asyn为True时创建AsynConnectionPool
+
+        :parameter:
+          - `asyn`:是否创建异步连接池
+        """
+
+        recorder('INFO', 'reset connection pools (asyn={asyn})'.format(asyn=asyn))
+
+        for configer in fastweb.loader.app.component_configers:
+            if asyn:
+                AsynConnManager.configer = configer
+                ioloop.IOLoop.current().run_sync(AsynConnManager.setup)
+            else:
+                SyncConnManager.setup(configer)
+
+        Manager.reset_components()
+
+    @staticmethod
+    def reset_components():
+        """在fork出的子进程中按安装时的layout重新创建不需要连接池的组件,同一进程中不重复创建"""
+
+        if Manager._setups and Manager._setup_pid != os.getpid():
+            setups = list(Manager._setups)
+            del Manager._setups[:]
+            Manager._classified_pools.clear()
+            for layout, configer in setups:
+                Manager.setup(layout, configer)
+
 
 class SyncConnManager(Manager):
     @staticmethod
@@ -130,9 +241,7 @@ class SyncConnManager(Manager):
                 for name, value in list(components.items()):
                     config = configer.configs[name]
                     size = config.get('size', default_size)
-                    awake = config.get('awake')
-                    maxconnections = config.get('maxconnections')
-                    pool = SyncConnectionPool(cls, config, size, name, awake=awake, maxconnections=maxconnections)
+                    pool = SyncConnectionPool(cls, config, size, name, **Manager.get_pool_options(config))
                     pool.create()
                     Manager._pools[value['object']] = pool
 
@@ -160,14 +269,11 @@ class AsynConnManager(Manager):
                 for name, value in list(components.items()):
                     config = AsynConnManager.configer.configs[name]
                     size = config.get('size', default_size)
-                    awake = config.get('awake')
-                    maxconnections = config.get('maxconnections')
-                    pool = AsynConnectionPool(cls, config, size, name, awake=awake, maxconnections=maxconnections)
+                    pool = AsynConnectionPool(cls, config, size, name, **Manager.get_pool_options(config))
                     yield pool.create()
                     Manager._pools[value['object']] = pool
 
         recorder('DEBUG', 'asynchronous manager setup successful')
 
 
-
-
+registry.register_collector(Manager.pool_metrics)
@@ -2,23 +2,55 @@
 
 """连接池模块"""
 
+import time
 import json
-from threading import Lock
+from collections import deque
+from datetime import timedelta
+from threading import Lock, Event, Thread
 
-from fastweb.util.log import recorder
+from fastweb.util.log import recorder, lazy
+from fastweb.util.metrics import POOL_ACQUIRE, POOL_TIMEOUT
 from fastweb.exception import PoolError
 from fastweb.util.thread import FThread
 from fastweb.accesspoint import coroutine, ioloop, Return
-from fastweb.accesspoint import Queue, Empty, Full
+from fastweb.accesspoint import AsynLifoQueue, AsynQueueEmpty, AsynTimeoutError
 
-DEFAULT_TIMEOUT = 50000
+DEFAULT_TIMEOUT = 60
 DEFAULT_MAXCONN = 100
+# 获取连接的默认等待时间(秒)
+DEFAULT_ACQUIRE_TIMEOUT = 5
+# 多余空闲连接的默认回收时间(秒)
+DEFAULT_IDLE_TIMEOUT = 300
+# 空闲超过该时间的连接在借出前需要检查(秒)
+DEFAULT_VALIDATE_IDLE = 30
+
+
+class ConnectionMeta(object):
+    """连接的使用记录"""
+
+    __slots__ = ('created', 'used', 'validated')
+
+    def __init__(self, now):
+        # 连接建立时间
+        self.created = now
+        # 最后一次归还时间
+        self.used = now
+        # 最后一次检查可用时间
+        self.validated = now
 
 
 class ConnectionPool(object):
-    """连接池"""
+    """连接池
 
-    def __init__(self, cls, setting, size, name, awake=DEFAULT_TIMEOUT, maxconnections=DEFAULT_MAXCONN):
+    每个连接记录建立时间、最后使用时间和最后检查时间,不再定时ping所有连接:
+      - 借出时只检查空闲超过validate_idle的连接,检查失败的连接被丢弃并在后台重建
+      - 后台回收超过max_lifetime或空闲超过max_idle的连接,以及空闲超过idle_timeout的多余连接
+      - 连接数低于size时在后台补充,借用者不需要等待重连
+    """
+
+    def __init__(self, cls, setting, size, name, awake=DEFAULT_TIMEOUT, maxconnections=DEFAULT_MAXCONN,
+                 timeout=DEFAULT_ACQUIRE_TIMEOUT, idle=DEFAULT_IDLE_TIMEOUT, validate_idle=DEFAULT_VALIDATE_IDLE,
+                 max_lifetime=None, max_idle=None):
         """设置连接池
 
         连接池创建时尽量早的报错,运行过程中尽量去修复错误
@@ -26,9 +58,15 @@ class ConnectionPool(object):
         :parameter:
           - `cls`:连接池中实例化的类
           -`setting`:参数
-          -`size`:连接池大小
+          -`size`:连接池大小,也是连接池收缩后保留的最小连接数
           -`name`:连接池名字
-          -`timeout`:连接最大超时时间,尝试重连时间
+          -`awake`:后台回收连接的最大间隔时间
+          -`maxconnections`:连接池最大连接数
+          -`timeout`:获取连接的最大等待时间
+          -`idle`:超过最小连接数的空闲连接的回收时间
+          -`validate_idle`:空闲超过该时间的连接借出前需要检查,0为不检查
+          -`max_lifetime`:连接最长存活时间,超过后回收重建,默认不限制
+          -`max_idle`:连接最长空闲时间,超过后回收重建,默认不限制
         """
 
         self._cls = cls
@@ -37,14 +75,90 @@ class ConnectionPool(object):
         self._timeout = int(awake) if awake else DEFAULT_TIMEOUT
         self._setting = setting
         self._maxconnections = int(maxconnections) if maxconnections else DEFAULT_MAXCONN
-        self._pool = Queue(self._maxconnections)
-        self._unused_pool = []
-        self._rescue_thread = None
-        self._tlock = Lock()
+        self._acquire_timeout = float(timeout) if timeout else DEFAULT_ACQUIRE_TIMEOUT
+        self._idle_timeout = float(idle) if idle else DEFAULT_IDLE_TIMEOUT
+        self._validate_idle = float(validate_idle) if validate_idle is not None else DEFAULT_VALIDATE_IDLE
+        self._max_lifetime = float(max_lifetime) if max_lifetime else 0
+        self._max_idle = float(max_idle) if max_idle else 0
+
+        # 回收间隔不能大于任何一个回收时间
+        self._reap_interval = min(t for t in (self._timeout, self._idle_timeout, self._max_lifetime, self._max_idle)
+                                  if t)
+
+        # 连接使用记录 {connection: ConnectionMeta}
+        self._meta = {}
+
+        # 获取连接的统计信息
+        self._stats = {'acquire': 0, 'wait': 0, 'timeout': 0, 'wait_time': 0.0, 'max_wait_time': 0.0,
+                       'validate': 0, 'invalid': 0, 'reap': 0}
+
+    def _record_wait(self, wait_time):
+        """记录获取连接的等待时间
+
+        :parameter:
+          - `wait_time`:等待时间(秒)
+        """
+
+        self._stats['acquire'] += 1
+        POOL_ACQUIRE.labels(self._name).observe(wait_time)
+        if wait_time > 0:
+            self._stats['wait'] += 1
+            self._stats['wait_time'] += wait_time
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+
+    def _need_validate(self, connection, now):
+        """连接借出前是否需要检查"""
+
+        meta = self._meta.get(connection)
+        return bool(self._validate_idle and meta and now - meta.used > self._validate_idle)
+
+    def _expired(self, connection, now):
+        """连接是否超过最长存活时间或最长空闲时间"""
+
+        meta = self._meta.get(connection)
+
+        if not meta:
+            return False
+
+        return bool((self._max_lifetime and now - meta.created > self._max_lifetime) or
+                    (self._max_idle and now - meta.used > self._max_idle))
+
+    def _select_reap(self, idle, now, total):
+        """挑选需要回收的空闲连接
+
+        :parameter:
+          - `idle`:空闲连接,按归还时间从早到晚排列
+          - `now`:当前时间
+          - `total`:当前连接总数
+
+        :return:
+          (保留的连接, 回收的连接)
+        """
+
+        keep, reap = [], []
+
+        for connection in idle:
+            meta = self._meta.get(connection)
+            surplus = total > self._size and meta and now - meta.used > self._idle_timeout
+            if surplus or self._expired(connection, now):
+                reap.append(connection)
+                total -= 1
+            else:
+                keep.append(connection)
+
+        return keep, reap
+
+    def stats(self):
+        """连接池统计信息"""
+
+        stats = dict(self._stats)
+        stats['avg_wait_time'] = stats['wait_time'] / stats['wait'] if stats['wait'] else 0.0
+        return stats
 
     def remove_connection(self, connection):
-        """移除连接"""
-        pass
+        """移除借出的不可用连接,关闭后在后台补充连接"""
+
+        self._discard(connection)
 
     def lend_connection(self, timeout):
         """租用连接
@@ -60,47 +174,150 @@ class ConnectionPool(object):
         :parameter:
           - `connection`:连接"""
 
-        self._pool.put_nowait(connection)
-        self._unused_pool.append(connection)
-        recorder('DEBUG',
-                 '<{name}> return connection {conn}, total connections {count}'.format(name=self._name,
-                                                                                       conn=connection,
-                                                                                       count=self._pool.qsize()))
+        raise NotImplementedError
 
     def rescue(self):
-        """独立线程进行连接恢复"""
+        """启动后台连接回收"""
 
         raise NotImplementedError
 
 
 class SyncConnectionPool(ConnectionPool):
     """支持多线程，不支持多进程
-       多进程需要为每个进程单独创建自己的连接池"""
-
-    def __init__(self, cls, setting, size, name, awake, maxconnections):
-        super(SyncConnectionPool, self).__init__(cls, setting, size, name,
-                                                 awake=awake, maxconnections=maxconnections)
+       多进程需要为每个进程单独创建自己的连接池
+
+    连接总数不会超过maxconnections,连接在建立之前就会占用名额
+    没有空闲连接且达到上限时阻塞等待,等待者按先来先得(FIFO)的顺序获取归还的连接,超过timeout抛出PoolError
+    空闲连接使用deque,借出连接使用set,获取和归还都是O(1)操作
+    """
+
+    def __init__(self, cls, setting, size, name, awake=DEFAULT_TIMEOUT, maxconnections=DEFAULT_MAXCONN,
+                 timeout=DEFAULT_ACQUIRE_TIMEOUT, **kwargs):
+        super(SyncConnectionPool, self).__init__(cls, setting, size, name, awake=awake,
+                                                 maxconnections=maxconnections, timeout=timeout, **kwargs)
+
+        # 空闲连接,后进先出
+        self._idle = deque()
+        # 借出的连接
+        self._used = set()
+        # 等待连接的线程,先进先出
+        self._waiters = deque()
+        # 正在创建中的连接数
+        self._creating = 0
+        self._rescue_thread = None
+        self._tlock = Lock()
+        self._stats['peak'] = 0
 
     def __str__(self):
         return '<{name}|SyncConnectionPool>'.format(name=self._name)
 
+    @property
+    def total(self):
+        """已建立和正在建立的连接总数"""
+
+        return len(self._idle) + len(self._used) + self._creating
+
     def _create_connection(self):
         """创建连接"""
 
         return self._cls(self._setting).set_name(self._name).connect()
 
+    def _reserve(self):
+        """占用一个创建连接的名额,需要在锁内调用"""
+
+        if self.total >= self._maxconnections:
+            return False
+
+        self._creating += 1
+        return True
+
+    def _build(self):
+        """创建连接,调用前需要先占用名额
+
+        创建成功后名额继续保留,直到连接被借出或者放入空闲连接"""
+
+        try:
+            connection = self._create_connection()
+        except Exception:
+            with self._tlock:
+                self._creating -= 1
+                self._wake_creator()
+            raise
+
+        with self._tlock:
+            self._meta[connection] = ConnectionMeta(time.time())
+        return connection
+
+    def _wake_creator(self):
+        """让出名额后,让最早的等待者尝试自己创建连接,需要在锁内调用"""
+
+        if self._waiters and self._reserve():
+            waiter = self._waiters.popleft()
+            waiter.reserved = True
+            waiter.event.set()
+
+    def _checkout(self, connection):
+        """登记借出连接,需要在锁内调用"""
+
+        self._used.add(connection)
+        self._stats['peak'] = max(self._stats['peak'], len(self._used))
+
+    def _close_connection(self, connection):
+        """关闭连接"""
+
+        close = getattr(connection, 'close', None)
+
+        try:
+            close and close()
+        except Exception as e:
+            recorder('WARN', '{obj} close connection {conn} error ({e})'.format(obj=self, conn=connection, e=e))
+
+    def _discard(self, connection):
+        """丢弃借出的连接,并在后台补充连接"""
+
+        with self._tlock:
+            self._used.discard(connection)
+            self._meta.pop(connection, None)
+            self._wake_creator()
+
+        self._close_connection(connection)
+        self.replenish()
+
+    def _replenish(self):
+        """补充连接到最小连接数"""
+
+        while True:
+            with self._tlock:
+                if self.total >= self._size or not self._reserve():
+                    return
+
+            try:
+                connection = self._build()
+            except Exception as e:
+                recorder('ERROR', '{obj} replenish connection error ({e})'.format(obj=self, e=e))
+                return
+
+            self.release(connection, checkout=False)
+            recorder('WARN', '{obj} replenish connection {conn}'.format(obj=self, conn=connection))
+
+    def replenish(self):
+        """在后台线程中补充连接,借用者不需要等待重连"""
+
+        if self.total < self._size:
+            thread = Thread(name='replenish', target=self._replenish)
+            thread.daemon = True
+            thread.start()
+
     def add_connection(self):
         """同步增加连接"""
 
-        connection = self._create_connection()
-        try:
-            self._tlock.acquire()
-            self._pool.put_nowait(connection)
-            self._unused_pool.append(connection)
-            self._tlock.release()
-        except Full:
-            recorder('ERROR', '<{name}> connection pool is full'.format(name=self._name))
-            raise PoolError
+        with self._tlock:
+            if not self._reserve():
+                recorder('ERROR', '<{name}> connection pool is full'.format(name=self._name))
+                raise PoolError
+
+        connection = self._build()
+        self.release(connection, checkout=False)
         return connection
 
     def create(self):
@@ -116,50 +333,257 @@ class SyncConnectionPool(ConnectionPool):
         recorder('DEBUG', 'synchronize connection pool create successful <{name}>'.format(name=self._name))
 
     def rescue(self):
-        self._rescue_thread = FThread(name='rescue', task=self._rescue, period=self._timeout, frequency=-1)
-        self._rescue_thread.start()
+        """启动后台连接回收线程"""
+
+        if not self._rescue_thread:
+            self._rescue_thread = FThread(name='rescue', task=self._rescue, period=self._reap_interval,
+                                          frequency=-1)
+            self._rescue_thread.start()
 
     def _rescue(self, thread):
-        """同步恢复连接
-        目前先全量恢复
+        """同步回收连接
+
+        只检查空闲连接的使用记录,不ping连接
+        """
+
+        now = time.time()
+
+        with self._tlock:
+            keep, reap = self._select_reap(self._idle, now, self.total)
+            if reap:
+                self._idle = deque(keep)
+                for connection in reap:
+                    self._meta.pop(connection, None)
+                self._stats['reap'] += len(reap)
+
+        for connection in reap:
+            self._close_connection(connection)
+            recorder('INFO', '{thread} {obj} reap connection {conn}'.format(thread=thread, obj=self, conn=connection))
+
+        self._replenish()
+
+    def _validate(self, connection):
+        """借出前检查空闲较久的连接"""
+
+        now = time.time()
+
+        if not self._need_validate(connection, now):
+            return True
+
+        try:
+            connection.ping()
+        except Exception as e:
+            with self._tlock:
+                self._stats['validate'] += 1
+                self._stats['invalid'] += 1
+            recorder('WARN', '{obj} connection {conn} invalid ({e})'.format(obj=self, conn=connection, e=e))
+            return False
+
+        with self._tlock:
+            self._stats['validate'] += 1
+            self._meta[connection].validated = now
+        return True
+
+    def acquire(self, timeout=None):
+        """获取连接,没有空闲连接且达到上限时阻塞等待
+
+        :parameter:
+          - `timeout`:最大等待时间(秒),默认为连接池的timeout
+        """
+
+        timeout = self._acquire_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+
+        while True:
+            connection = self._acquire(max(deadline - time.time(), 0))
+            if self._validate(connection):
+                return connection
+            self._discard(connection)
+
+    def _acquire(self, timeout):
+        """获取连接,不检查连接是否可用"""
+
+        waiter = None
+
+        with self._tlock:
+            if self._idle:
+                connection = self._idle.pop()
+                self._checkout(connection)
+                self._record_wait(0)
+                return connection
+            elif not self._reserve():
+                waiter = _SyncWaiter()
+                self._waiters.append(waiter)
+
+        start = time.time()
+        if waiter:
+            waiter.event.wait(timeout)
+
+            with self._tlock:
+                if waiter.connection is None and not waiter.reserved:
+                    self._waiters.remove(waiter)
+                    self._stats['timeout'] += 1
+                    POOL_TIMEOUT.labels(self._name).inc()
+                    recorder('CRITICAL', '{obj} acquire connection timeout [{timeout}s], '
+                                         'total connections {count}'.format(obj=self, timeout=timeout,
+                                                                            count=self.total))
+                    raise PoolError
+
+                if waiter.connection is not None:
+                    self._record_wait(time.time() - start)
+                    return waiter.connection
+
+        # 获得了创建名额,在锁外建立连接
+        connection = self._build()
+        recorder('WARN', '<{name}> connection pool is empty,create a new connection {conn}'.format(name=self._name,
+                                                                                                   conn=connection))
+        with self._tlock:
+            self._creating -= 1
+            self._checkout(connection)
+            # 建立连接的时间不计入等待时间
+            self._record_wait(time.time() - start if waiter else 0)
+        return connection
+
+    def release(self, connection, checkout=True):
+        """归还连接,有等待者时直接交给最早的等待者
+
+        :parameter:
+          - `connection`:连接
+          - `checkout`:连接是否是借出的连接,否则为新建立的连接
+        """
+
+        now = time.time()
+
+        with self._tlock:
+            if checkout:
+                if connection not in self._used:
+                    recorder('WARN', '{obj} release unknown connection {conn}'.format(obj=self, conn=connection))
+                    return
+                self._used.discard(connection)
+            else:
+                self._creating -= 1
+
+            meta = self._meta.get(connection)
+            if meta:
+                meta.used = now
+
+            if self._max_lifetime and self._expired(connection, now):
+                # 超过最长存活时间的连接不再放回
+                self._used.add(connection)
+                self._stats['reap'] += 1
+                expired = True
+            elif self._waiters:
+                expired = False
+                waiter = self._waiters.popleft()
+                waiter.connection = connection
+                self._checkout(connection)
+                waiter.event.set()
+            else:
+                expired = False
+                self._idle.append(connection)
+
+        if expired:
+            self._discard(connection)
+
+    def return_connection(self, connection):
+        """归还连接
+
+        :parameter:
+          - `connection`:连接"""
+
+        self.release(connection)
+        recorder('DEBUG',
+                 lazy('<{name}> return connection {conn}, total connections {count}', name=self._name,
+                      conn=connection,
+                      count=len(self._idle)))
+
+    def connection(self, timeout=None):
+        """获取连接的上下文管理器
+
+        with pool.connection() as conn:
+            ...
         """
 
-        recorder('INFO', '{thread} <{name}> rescue connection start'.format(thread=thread, name=self._name))
-        for conn in self._unused_pool:
-            if conn:
-                conn.ping()
-        recorder('INFO', '{thread} <{name}> rescue connection successful'.format(thread=thread, name=self._name))
+        return _SyncConnectionContext(self, timeout)
 
     def get_connection(self):
         """获取连接"""
 
-        try:
-            self._tlock.acquire()
-            connection = self._pool.get_nowait()
-            self._unused_pool.remove(connection)
-            self._tlock.release()
-        except Empty:
-            connection = self.add_connection()
-            recorder('WARN', '<{name}> connection pool is empty,create a new connection {conn}'.format(name=self._name,
-                                                                                                       conn=connection))
-            return self.get_connection()
-
-        recorder('DEBUG', '{obj} get connection {conn} {id}, left connections {count}'.format(obj=self, conn=connection,
-                                                                                              id=id(connection),
-                                                                                              count=self._pool.qsize()))
+        connection = self.acquire()
+        recorder('DEBUG', lazy('{obj} get connection {conn} {id}, left connections {count}', obj=self, conn=connection,
+                               id=id(connection),
+                               count=len(self._idle)))
         return connection
 
+    def stats(self):
+        """连接池统计信息"""
 
-class AsynConnectionPool(ConnectionPool):
-    """tornado使用，不支持多线程，不支持多进程"""
+        with self._tlock:
+            stats = super(SyncConnectionPool, self).stats()
+            stats.update(total=self.total, idle=len(self._idle), used=len(self._used), waiters=len(self._waiters))
+        return stats
+
+
+class _SyncWaiter(object):
+    """等待连接的线程"""
+
+    __slots__ = ('event', 'connection', 'reserved')
+
+    def __init__(self):
+        self.event = Event()
+        self.connection = None
+        # 获得了创建新连接的名额
+        self.reserved = False
+
+
+class _SyncConnectionContext(object):
+    """连接池上下文管理器,退出时自动归还连接"""
+
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._connection = None
+
+    def __enter__(self):
+        self._connection = self._pool.acquire(self._timeout)
+        return self._connection
 
-    def __init__(self, cls, setting, size, name, awake, maxconnections):
-        super(AsynConnectionPool, self).__init__(cls, setting, size, name,
-                                                 awake=awake, maxconnections=maxconnections)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._pool.release(self._connection)
+        self._connection = None
+
+
+class AsynConnectionPool(ConnectionPool):
+    """tornado使用，不支持多线程，不支持多进程
+
+    空闲连接存放在tornado.queues中,获取连接时不会阻塞IOLoop:
+    没有空闲连接时按照先来先得(FIFO)的顺序等待,直到有连接归还、后台扩容完成或者等待超时
+    连接数不足时在当前IOLoop上后台扩容,最多扩容到maxconnections
+    空闲超过idle时间的多余连接会被回收,至少保留size个连接
+    """
+
+    def __init__(self, cls, setting, size, name, awake=DEFAULT_TIMEOUT, maxconnections=DEFAULT_MAXCONN,
+                 timeout=DEFAULT_ACQUIRE_TIMEOUT, idle=DEFAULT_IDLE_TIMEOUT, **kwargs):
+        super(AsynConnectionPool, self).__init__(cls, setting, size, name, awake=awake,
+                                                 maxconnections=maxconnections, timeout=timeout, idle=idle, **kwargs)
+
+        # 空闲连接,后进先出,使不常用的连接沉在底部等待回收
+        self._pool = AsynLifoQueue()
+        # 所有已建立的连接
+        self._connections = set()
+        # 正在创建中的连接数
+        self._creating = 0
+        self._reaping = False
 
     def __str__(self):
         return '<{name}|AsynConnectionPool>'.format(name=self._name)
 
+    @property
+    def total(self):
+        """已建立和正在建立的连接总数"""
+
+        return len(self._connections) + self._creating
+
     @coroutine
     def _create_connection(self):
         """创建连接"""
@@ -182,65 +606,277 @@ class AsynConnectionPool(ConnectionPool):
 
     @coroutine
     def add_connection(self):
-        """同步增加连接"""
+        """异步增加连接"""
 
-        connection = yield self._create_connection()
-        try:
-            self._pool.put_nowait(connection)
-            self._unused_pool.append(connection)
-        except Full:
+        if self.total >= self._maxconnections:
             recorder('ERROR', '<{name}> connection pool is full'.format(name=self._name))
             raise PoolError
 
-    def rescue(self):
-        """异步恢复连接
-        目前全量恢复
+        self._creating += 1
+        connection = yield self._add_connection()
+        raise Return(connection)
+
+    @coroutine
+    def _add_connection(self):
+        """创建连接并放入空闲连接,调用前需要先增加创建中的连接数"""
+
+        try:
+            connection = yield self._create_connection()
+        finally:
+            self._creating -= 1
+
+        self._connections.add(connection)
+        self._meta[connection] = ConnectionMeta(ioloop.IOLoop.current().time())
+        self._pool.put_nowait(connection)
+        raise Return(connection)
+
+    def _scale(self):
+        """在当前IOLoop上后台扩容一个连接"""
+
+        @coroutine
+        def _add():
+            try:
+                connection = yield self._add_connection()
+                recorder('WARN', '{obj} scale connection {conn}, total connections {count}'.format(obj=self,
+                                                                                                  conn=connection,
+                                                                                                  count=self.total))
+            except Exception as e:
+                recorder('ERROR', '{obj} scale connection error ({e})'.format(obj=self, e=e))
+
+        if self.total < self._maxconnections:
+            self._creating += 1
+            ioloop.IOLoop.current().spawn_callback(_add)
+            return True
+        return False
+
+    def replenish(self):
+        """在后台补充连接到最小连接数,借用者不需要等待重连"""
+
+        while self.total < self._size and self._scale():
+            pass
+
+    @coroutine
+    def _validate(self, connection):
+        """借出前检查空闲较久的连接"""
+
+        now = ioloop.IOLoop.current().time()
+
+        if not self._need_validate(connection, now):
+            raise Return(True)
+
+        try:
+            self._stats['validate'] += 1
+            yield connection.ping()
+        except Exception as e:
+            self._stats['invalid'] += 1
+            recorder('WARN', '{obj} connection {conn} invalid ({e})'.format(obj=self, conn=connection, e=e))
+            raise Return(False)
+
+        self._meta[connection].validated = now
+        raise Return(True)
+
+    @coroutine
+    def acquire(self, timeout=None):
+        """获取连接,连接池为空时等待但不阻塞IOLoop
+
+        :parameter:
+          - `timeout`:最大等待时间(秒),默认为连接池的timeout
         """
 
-        def on_reconnect(future):
-            if future.exception:
-                print(future)
+        timeout = self._acquire_timeout if timeout is None else timeout
+        deadline = ioloop.IOLoop.current().time() + timeout
 
-        def on_rescue():
-            recorder('INFO', '<{name}> rescue connection start'.format(name=self._name))
-            for conn in self._unused_pool:
-                if conn:
-                    future = conn.ping()
-                    ioloop.IOLoop.current().add_future(future, on_reconnect)
+        while True:
+            connection = yield self._acquire(max(deadline - ioloop.IOLoop.current().time(), 0))
+            valid = yield self._validate(connection)
+            if valid:
+                raise Return(connection)
+            self._discard(connection)
 
-            recorder('INFO', '<{name}> rescue connection successful'.format(name=self._name))
-            self.rescue()
+    @coroutine
+    def _acquire(self, timeout):
+        """获取连接,不检查连接是否可用"""
 
-        ioloop.IOLoop.current().add_timeout(ioloop.IOLoop.current().time() + self._timeout, on_rescue)
+        wait_time = 0
 
-    def _scale(self, thread):
-        recorder('WARN', '{thread} {obj} scale connection pool start'.format(thread=thread, obj=self))
-        scale_loop = ioloop.IOLoop(make_current=True)
-        scale_loop.run_sync(self.create)
-        recorder('WARN', '{thread} {obj} scale connection pool successful'.format(thread=thread, obj=self))
-        scale_loop.start()
+        try:
+            connection = self._pool.get_nowait()
+        except AsynQueueEmpty:
+            start = ioloop.IOLoop.current().time()
+            self._scale()
+            try:
+                connection = yield self._pool.get(timeout=timedelta(seconds=timeout))
+            except AsynTimeoutError:
+                self._stats['timeout'] += 1
+                POOL_TIMEOUT.labels(self._name).inc()
+                recorder('CRITICAL', '{obj} acquire connection timeout [{timeout}s], '
+                                     'total connections {count}'.format(obj=self, timeout=timeout, count=self.total))
+                raise PoolError
+            wait_time = ioloop.IOLoop.current().time() - start
+
+        # 空闲连接用尽时提前扩容,减少后续的等待
+        if not self._pool.qsize():
+            self._scale()
+
+        self._record_wait(wait_time)
+        recorder('DEBUG', lazy('{obj} acquire connection {conn} {id}, left connections {count} '
+                               '[wait {wait}s]', obj=self, conn=connection, id=id(connection),
+                               count=self._pool.qsize(), wait=round(wait_time, 6)))
+        raise Return(connection)
 
-    def scale_connections(self):
-        scale_thread = FThread(name='scale', task=self._scale, frequency=-1)
-        scale_thread.start()
-        scale_thread.join()
+    def release(self, connection):
+        """归还连接
+
+        :parameter:
+          - `connection`:连接
+        """
+
+        if connection not in self._connections:
+            recorder('WARN', '{obj} release unknown connection {conn}'.format(obj=self, conn=connection))
+            return
+
+        now = ioloop.IOLoop.current().time()
+        self._meta[connection].used = now
+
+        if self._max_lifetime and self._expired(connection, now):
+            # 超过最长存活时间的连接不再放回
+            self._stats['reap'] += 1
+            self._discard(connection)
+            return
+
+        self._pool.put_nowait(connection)
+        recorder('DEBUG',
+                 lazy('<{name}> return connection {conn}, total connections {count}', name=self._name,
+                      conn=connection,
+                      count=self._pool.qsize()))
+
+    def return_connection(self, connection):
+        """归还连接"""
+
+        self.release(connection)
+
+    def connection(self, timeout=None):
+        """获取连接的异步上下文管理器
+
+        async with pool.connection() as conn:
+            ...
+        """
+
+        return _AsynConnectionContext(self, timeout)
 
     def get_connection(self):
-        """获取连接"""
+        """获取连接
+
+        同步接口,只获取当前空闲的连接,没有空闲连接时在后台扩容并抛出PoolError
+        需要等待连接或者检查连接可用时请使用acquire"""
 
-        # TODO:连接池扩展机制问题
         try:
-            connection = self._pool.get(block=True)
-            self._unused_pool.remove(connection)
-            if self._pool.qsize() < 2:
-                self.scale_connections()
-        except Empty:
+            connection = self._pool.get_nowait()
+        except AsynQueueEmpty:
+            self._scale()
             recorder('CRITICAL',
-                     '<{name}> connection pool is empty,please use service to separate your database operation'.format(
+                     '<{name}> connection pool is empty,please use acquire to wait for connection'.format(
                          name=self._name))
             raise PoolError
 
-        recorder('DEBUG', '{obj} get connection {conn} {id}, left connections {count}'.format(obj=self, conn=connection,
-                                                                                              id=id(connection),
-                                                                                              count=self._pool.qsize()))
+        if not self._pool.qsize():
+            self._scale()
+
+        self._record_wait(0)
+        recorder('DEBUG', lazy('{obj} get connection {conn} {id}, left connections {count}', obj=self, conn=connection,
+                               id=id(connection),
+                               count=self._pool.qsize()))
         return connection
+
+    def _close_connection(self, connection):
+        """关闭连接"""
+
+        def on_close(future):
+            if future.exception():
+                recorder('WARN', '{obj} close connection {conn} error ({e})'.format(obj=self, conn=connection,
+                                                                                    e=future.exception()))
+
+        self._connections.discard(connection)
+        self._meta.pop(connection, None)
+        close = getattr(connection, 'close', None)
+
+        try:
+            future = close() if close else None
+        except Exception as e:
+            recorder('WARN', '{obj} close connection {conn} error ({e})'.format(obj=self, conn=connection, e=e))
+        else:
+            if future is not None and hasattr(future, 'add_done_callback'):
+                ioloop.IOLoop.current().add_future(future, on_close)
+
+    def _discard(self, connection):
+        """丢弃借出的连接,并在后台补充连接"""
+
+        self._close_connection(connection)
+        self.replenish()
+
+    def _reap(self, now):
+        """回收空闲连接,只检查空闲连接的使用记录,不ping连接
+
+        :parameter:
+          - `now`:当前时间
+        """
+
+        idle = []
+        while True:
+            try:
+                idle.append(self._pool.get_nowait())
+            except AsynQueueEmpty:
+                break
+
+        # LifoQueue先取出最近归还的连接,反转后按归还时间从早到晚排列
+        idle.reverse()
+        keep, reap = self._select_reap(idle, now, self.total)
+        # 按从早到晚的顺序放回,最近归还的连接仍在栈顶
+        for connection in keep:
+            self._pool.put_nowait(connection)
+
+        for connection in reap:
+            self._close_connection(connection)
+            recorder('INFO', '{obj} reap connection {conn}, total connections {count}'.format(
+                obj=self, conn=connection, count=self.total))
+
+        self._stats['reap'] += len(reap)
+        self.replenish()
+
+    def rescue(self):
+        """启动后台连接回收"""
+
+        def on_rescue():
+            now = ioloop.IOLoop.current().time()
+            self._reap(now)
+            ioloop.IOLoop.current().add_timeout(now + self._reap_interval, on_rescue)
+
+        if not self._reaping:
+            self._reaping = True
+            ioloop.IOLoop.current().add_timeout(ioloop.IOLoop.current().time() + self._reap_interval, on_rescue)
+
+    def stats(self):
+        """连接池统计信息"""
+
+        stats = super(AsynConnectionPool, self).stats()
+        stats.update(total=self.total, idle=self._pool.qsize(), used=len(self._connections) - self._pool.qsize())
+        return stats
+
+
+class _AsynConnectionContext(object):
+    """连接池异步上下文管理器,退出时自动归还连接"""
+
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._connection = None
+
+    @coroutine
+    def __aenter__(self):
+        self._connection = yield self._pool.acquire(self._timeout)
+        raise Return(self._connection)
+
+    @coroutine
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._pool.release(self._connection)
+        self._connection = None
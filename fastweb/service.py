@@ -2,22 +2,41 @@
 
 """服务层模块"""
 
+import os
 import inspect
+import signal
+import socket
+import threading
+from collections import deque
+from functools import partial
 
-from .accesspoint import TServer, TSocket, TTransport, TCompactProtocol
+from .accesspoint import (TServer, TSocket, TTransport, TCompactProtocol, TNonblockingServer, TTornado,
+                          ioloop, coroutine, fork_processes)
 
 from fastweb import app
 from fastweb.manager import Manager
-from fastweb.util.tool import timing
-from fastweb.util.log import recorder
+from fastweb.util.log import recorder, lazy, log_fields
+from fastweb.util.metrics import registry, RPC_CALL, RPC_ERROR
 from fastweb.component import Component
+from fastweb.util.thread import FThread
 from fastweb.util.process import FProcess
+from fastweb.web import AsynComponents
+from fastweb.exception import ConfigurationError
 from fastweb.components import SyncComponents
 from fastweb.util.python import load_module, to_iter, load_object
 
 
-__all__ = ['start_service_server', 'ABLogic']
+__all__ = ['start_service_server', 'ABLogic', 'AsynABLogic']
 DEFAULT_THREADPOOL_SIZE = 1000
+DEFAULT_NONBLOCKING_SIZE = 10
+DEFAULT_BACKLOG = 128
+DEFAULT_METRICS_INTERVAL = 15
+
+# 服务端模式
+SERVER_THREADPOOL = 'threadpool'
+SERVER_NONBLOCKING = 'nonblocking'
+SERVER_TORNADO = 'tornado'
+SERVERS = (SERVER_THREADPOOL, SERVER_NONBLOCKING, SERVER_TORNADO)
 
 
 class Service(Component):
@@ -47,11 +66,26 @@ class Service(Component):
       - `handlers`: 处理具体业务的handler类,可以为列表或单个类
       - `daemon`: 是否以守护进程的形式启动
       - `active`: 是否可用
-      - `size`: 线程池大小
+      - `size`: 线程池大小,nonblocking模式下为工作线程数
+      - `server`: 服务端模式
+                  threadpool(默认): TThreadPoolServer,每个连接占用一个线程
+                  nonblocking: TNonblockingServer,一个线程处理网络IO,size个工作线程执行调用
+                  tornado: 基于IOLoop的异步服务,thrift_module需要以py:tornado生成,handler方法可以是协程,
+                           handler继承AsynABLogic,使用异步连接池
+      - `processes`: 进程数,大于1时预先fork多个进程共享一个监听socket(SO_REUSEPORT),-1为CPU核数
+                     每个进程在fork之后重新创建自己的连接池
+      - `metrics`: 指标文件路径,每隔metrics_interval秒以prometheus文本格式写入,可以交给node_exporter的textfile collector
+                   路径中的{pid}替换为进程号,多进程时每个进程写自己的文件;收到SIGUSR1时立即写入
+      - `metrics_interval`: 写入指标文件的间隔(秒),默认为15
+
+    每个线程只创建一次Processor和handler,每次调用前重置requestid和组件缓冲池
+    handler对象会被同一线程的后续调用复用,请求相关的状态不要保存在handler属性中
+    tornado模式下同一线程有多个并发调用,Processor和handler放在空闲列表中,调用结束后归还
     """
 
     eattr = {'port': int, 'thrift_module': str, 'handlers': str}
-    oattr = {'size': int, 'daemon': bool, 'active': bool}
+    oattr = {'size': int, 'daemon': bool, 'active': bool, 'server': str, 'processes': int, 'metrics': str,
+             'metrics_interval': float}
 
     def __init__(self, setting):
         super(Service, self).__init__(setting)
@@ -63,13 +97,30 @@ class Service(Component):
         handlers = to_iter(self._handlers)
         self._daemon = self.setting.get('daemon', True)
         self._active = self.setting.get('active', True)
-        self.size = self.setting.get('size', DEFAULT_THREADPOOL_SIZE)
+        self.server = self.setting.get('server', SERVER_THREADPOOL)
+        self.processes = self.setting.get('processes', 1)
+        self.metrics = self.setting.get('metrics')
+        self.metrics_interval = self.setting.get('metrics_interval', DEFAULT_METRICS_INTERVAL)
+
+        if self.server not in SERVERS:
+            recorder('ERROR', '<server> should be one of {servers}'.format(servers=SERVERS))
+            raise ConfigurationError
+
+        default_size = DEFAULT_NONBLOCKING_SIZE if self.server == SERVER_NONBLOCKING else DEFAULT_THREADPOOL_SIZE
+        self.size = self.setting.get('size', default_size)
+
+        # 线程内复用的Processor
+        self._local = threading.local()
+        # tornado模式下空闲的Processor
+        self._idle = deque()
+        self._module = None
 
         # 合并多个handler为一个,并自动集成ABLogic
         handlers = tuple(load_object(handler) for handler in handlers)
+        logic = AsynABLogic if self.server == SERVER_TORNADO else ABLogic
 
         try:
-            self._handlers = type('Handler', handlers + (ABLogic, ), {})
+            self._handlers = type('Handler', handlers + (logic, ), {})
         except TypeError as e:
             self.recorder('CRITICAL', 'handler conflict ({e})'.format(e=e))
 
@@ -79,46 +130,198 @@ class Service(Component):
                                                                     module=self._thrift_module,
                                                                     handler=self._handlers)
 
-    def start(self):
-        """微服务开始
+    def _processor(self):
+        """获取当前线程的Processor,第一次调用时创建"""
 
-        生成一个微服务
+        processor = getattr(self._local, 'processor', None)
+
+        if processor is None:
+            processor = self._local.processor = getattr(self._module, 'Processor')(handler=self._handlers())
+        return processor
+
+    def _dispatch(self, name):
+        """生成远程调用入口
 
         :parameter:
-         - `handler`:AbLogic列表
+          - `name`:远程调用方法名称
         """
 
-        def process_proxy(processor):
-            for _func_name, _func in list(processor._processMap.items()):
-                def anonymous(p, seq, ipo, opo):
-                    oproc = getattr(module, 'Processor')(handler=self._handlers())
-                    oproc._handler.requestid = seq if len(str(seq)) > 8 else oproc._handler.requestid
-                    oproc._handler.recorder('IMPORTANT', '{obj}\nremote call [{name}]'.format(obj=self, name=_func_name))
-                    with timing('ms', 8) as t:
-                        _func(oproc, seq, ipo, opo)
-                    oproc._handler.release()
-                    oproc._handler.recorder('IMPORTANT', '{obj}\nremote call [{name}] success -- {t}'.format(obj=self,
-                                                                                                             name=_func_name,
-                                                                                                             t=t))
-                processor._processMap[_func_name] = anonymous
-
-        # 将所有的handlers合并成一个handler
-        module = load_module(self._thrift_module)
-        processor = getattr(module, 'Processor')(handler=None)
-        process_proxy(processor)
-        transport = TSocket.TServerSocket(port=self._port)
-        tfactory = TTransport.TFramedTransportFactory()
+        def anonymous(p, seq, ipo, opo):
+            oproc = self._processor()
+            handler = oproc._handler
+            handler.reset(seq if len(str(seq)) > 8 else None)
+            handler.recorder('IMPORTANT', lazy('{obj}\nremote call [{name}]', obj=self, name=name))
+
+            try:
+                with handler.span(name, RPC_CALL.labels('server', self.name, name), 'ms', 8) as t:
+                    oproc._processMap[name](oproc, seq, ipo, opo)
+            except Exception:
+                RPC_ERROR.labels('server', self.name, name).inc()
+                raise
+            finally:
+                handler.release()
+
+            handler.recorder('IMPORTANT', log_fields(lazy('{obj}\nremote call [{name}] success -- {t}', obj=self,
+                                                          name=name, t=t), self.name, name, t))
+
+        return anonymous
+
+    def _dispatch_asyn(self, name):
+        """生成tornado模式的远程调用入口,并发调用使用不同的Processor"""
+
+        @coroutine
+        def anonymous(p, seq, ipo, opo):
+            oproc = self._idle.pop() if self._idle else getattr(self._module, 'Processor')(handler=self._handlers())
+            handler = oproc._handler
+            handler.reset(seq if len(str(seq)) > 8 else None)
+            handler.recorder('IMPORTANT', lazy('{obj}\nremote call [{name}]', obj=self, name=name))
+
+            try:
+                with handler.span(name, RPC_CALL.labels('server', self.name, name), 'ms', 8) as t:
+                    yield oproc._processMap[name](oproc, seq, ipo, opo)
+            except Exception:
+                RPC_ERROR.labels('server', self.name, name).inc()
+                raise
+            finally:
+                handler.release()
+                self._idle.append(oproc)
+
+            handler.recorder('IMPORTANT', log_fields(lazy('{obj}\nremote call [{name}] success -- {t}', obj=self,
+                                                          name=name, t=t), self.name, name, t))
+
+        return anonymous
+
+    def build_processor(self):
+        """生成服务端Processor,远程调用分发到复用的Processor"""
+
+        self._module = load_module(self._thrift_module)
+        processor = getattr(self._module, 'Processor')(handler=None)
+        dispatch = self._dispatch_asyn if self.server == SERVER_TORNADO else self._dispatch
+
+        for name in list(processor._processMap):
+            processor._processMap[name] = dispatch(name)
+        return processor
+
+    def bind(self):
+        """创建监听socket,多进程时在fork之前创建,所有子进程共享
+
+        与TServerSocket一致,优先监听IPv6双栈地址
+        """
+
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        except socket.error:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.processes != 1 and hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self._port))
+        sock.listen(DEFAULT_BACKLOG)
+        return sock
+
+    def build_server(self, sock):
+        """在已经监听的socket上创建服务端
+
+        :parameter:
+          - `sock`:监听socket
+        """
+
+        processor = self.build_processor()
         pfactory = TCompactProtocol.TCompactProtocolFactory()
+
+        if self.server == SERVER_TORNADO:
+            server = TTornado.TTornadoServer(processor, pfactory)
+            # TTornadoServer依赖tornado5中已经移除的io_loop属性
+            server.io_loop = ioloop.IOLoop.current()
+            sock.setblocking(False)
+            server.add_sockets([sock])
+            return server
+
+        transport = BoundServerSocket(sock)
+        if self.server == SERVER_NONBLOCKING:
+            return TNonblockingServer.TNonblockingServer(processor, transport, pfactory, pfactory, threads=self.size)
+
+        tfactory = TTransport.TFramedTransportFactory()
         server = TServer.TThreadPoolServer(processor, transport, tfactory, pfactory, daemon=self._daemon)
         server.setNumThreads(self.size)
+        return server
+
+    def dump_metrics(self, *args):
+        """把本进程的指标写入metrics文件,也作为FThread任务和SIGUSR1的处理函数"""
+
+        if not self.metrics:
+            return
+
+        path = self.metrics.format(pid=os.getpid())
+        try:
+            registry.dump(path)
+        except (IOError, OSError) as e:
+            recorder('ERROR', '{svr} dump metrics to {path} error ({e})'.format(svr=self, path=path, e=e))
+
+    def start_metrics(self):
+        """启动定期写入指标文件的线程,在fork之后调用"""
+
+        if not self.metrics:
+            return
+
+        thread = FThread(name='metrics', task=self.dump_metrics, period=self.metrics_interval)
+        thread.daemon = True
+        thread.start()
+        signal.signal(signal.SIGUSR1, self.dump_metrics)
+
+    def start(self, forked=False):
+        """微服务开始
+
+        生成一个微服务
+
+        :parameter:
+          - `forked`:是否在fork出的子进程中启动,子进程需要重新创建连接池
+        """
+
+        if not self._active:
+            return
+
+        sock = self.bind()
+
+        if self.processes != 1:
+            # 父进程在这里等待并重启异常退出的子进程
+            fork_processes(self.processes if self.processes > 0 else None)
+            forked = True
+
+        if forked:
+            # 子进程不能继续使用fork之前创建的IOLoop
+            ioloop.IOLoop().make_current()
+
+        if forked or self.server == SERVER_TORNADO:
+            Manager.reset_connection_pools(asyn=self.server == SERVER_TORNADO)
+
+        server = self.build_server(sock)
+        self.start_metrics()
 
         try:
-            if self._active:
-                recorder('INFO', '{svr} start at <{port}> threadpool size <{size}>'.format(svr=self, port=self._port,
-                                                                                           size=self.size))
+            recorder('INFO', '{svr} start at <{port}> server <{server}> size <{size}>'.format(svr=self, port=self._port,
+                                                                                             server=self.server,
+                                                                                             size=self.size))
+            if self.server == SERVER_TORNADO:
+                ioloop.IOLoop.current().start()
+            else:
                 server.serve()
         except KeyboardInterrupt:
             recorder('INFO', '{svr} stop at <{port}>'.format(svr=self, port=self._port))
+        finally:
+            self.dump_metrics()
+
+
+class BoundServerSocket(TSocket.TServerSocket):
+    """使用已经绑定并监听的socket的TServerSocket"""
+
+    def __init__(self, sock):
+        super(BoundServerSocket, self).__init__(port=sock.getsockname()[1])
+        self.handle = sock
+
+    def listen(self):
+        pass
 
 
 class ABLogic(SyncComponents):
@@ -128,6 +331,13 @@ class ABLogic(SyncComponents):
         super(ABLogic, self).__init__()
 
 
+class AsynABLogic(AsynComponents):
+    """tornado模式的基础逻辑类,通过acquire异步获取组件"""
+
+    def __init__(self):
+        super(AsynABLogic, self).__init__()
+
+
 def start_service_server():
     """强制使用config的方式来配置微服务
 
@@ -137,6 +347,10 @@ def start_service_server():
     daemon: 是否以守护进程的形式启动
     active: 是否可用
     size: 线程池大小
+    server: 服务端模式 threadpool/nonblocking/tornado
+    processes: 进程数
+    metrics: 指标文件路径,{pid}替换为进程号
+    metrics_interval: 写入指标文件的间隔(秒)
 
     :parameter:
       - `config_path`:配置文件路径
@@ -144,6 +358,7 @@ def start_service_server():
 
     if not app.bRecorder:
         app.load_recorder()
+    app.load_asyn_recorder()
 
     # 将调用者路径加入到包查找路径中
     import sys
@@ -159,5 +374,5 @@ def start_service_server():
         # 有多个service会启动多进程
         # 多进程模式下不能使用pdb.set_trace的方式调试
         for service in services:
-            process = FProcess(name='ServiceProcess', task=service.start)
+            process = FProcess(name='ServiceProcess', task=partial(service.start, forked=True))
             process.start()
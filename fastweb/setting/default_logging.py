@@ -24,13 +24,20 @@ DEFAULT_LOGGING_SETTING =\
         },
         "system_formatter": {
             "format": "[%(levelname)s] [%(asctime)s] [%(process)d:%(thread)d]\n%(message)s"
+        },
+        "json_formatter": {
+            "()": "fastweb.util.log.JsonFormatter"
+        },
+        "console_formatter": {
+            "()": "fastweb.util.log.ColoredFormatter",
+            "fmt": "[%(levelname)s] [%(asctime)s] [%(process)d:%(thread)d]\n%(message)s"
         }
     },
     "disable_existing_loggers": False,
     "handlers": {
         "console_handler": {
-            "formatter": "system_formatter",
-            "class": "logging.StreamHandler",
+            "formatter": "console_formatter",
+            "class": "fastweb.util.log.BatchStreamHandler",
             "stream": "ext://sys.stdout"
         },
         "application_file_time_handler": {
@@ -39,14 +46,14 @@ DEFAULT_LOGGING_SETTING =\
             "encoding": "utf8",
             "interval": 1,
             "when": "D",
-            "class": "logging.handlers.TimedRotatingFileHandler",
+            "class": "fastweb.util.log.BatchTimedRotatingFileHandler",
         },
         "system_file_size_handler": {
             "formatter": "system_formatter",
             "backupCount": 20,
             "encoding": "utf8",
             "maxBytes": 10485760,
-            "class": "logging.handlers.RotatingFileHandler",
+            "class": "fastweb.util.log.BatchRotatingFileHandler",
         }
     }
 }
\ No newline at end of file
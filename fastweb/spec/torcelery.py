@@ -2,21 +2,34 @@
 
 """tornado调用celery模块"""
 
-from fastweb.accesspoint import states, IOLoop, Future
+from fastweb.util.log import recorder
+from fastweb.util.thread import FThread
+from fastweb.accesspoint import states, IOLoop, Future, gen
 
 
-def async(task, *args, **kwargs):
+# 批量查询任务状态的最小和最大间隔(秒),没有任务状态变化时间隔指数增长
+POLL_MIN = 0.01
+POLL_MAX = 1.0
+# 订阅线程等待消息的超时时间(秒),也是线程退出的最长等待时间
+SUBSCRIBE_POLL = 0.1
+STARTED_STATES = frozenset([states.STARTED]) | states.READY_STATES
+
+
+def asyn(task, timeout, *args, **kwargs):
     """celery异步任务
 
-    异步给celery发送命令时，任务的状态为PENDING则视为成功，将任务的taskid返回"""
+    异步给celery发送命令时，任务已经开始执行(STARTED)或已经结束则视为成功，将任务的taskid返回
+
+    :parameter:
+      - `timeout`: 超时时间,超时后返回None
+    """
 
-    future = Future()
     callback = kwargs.pop("callback", None)
-    if callback:
-        IOLoop.instance().add_future(future, lambda f: callback(f.result()))
     result = task.apply_async(*args, **kwargs)
-    result.start = IOLoop.instance().time()
-    IOLoop.instance().add_callback(_on_async_result, result, future)
+    future = ResultWaiter.get(result.backend).wait(result.id, STARTED_STATES, timeout)
+    future = _chain(future, lambda meta: result.id if meta else None)
+    if callback:
+        IOLoop.current().add_future(future, lambda f: callback(f.result()))
     return future
 
 
@@ -26,30 +39,252 @@ def sync(task, timeout, *args, **kwargs):
     同步给celery发送命令时，任务状态为READY则视为成功，将任务执行的结果返回
 
     :parameter:
-      - `timeout`: 超时时间
+      - `timeout`: 超时时间,超时后返回None
     """
 
-    future = Future()
     callback = kwargs.pop("callback", None)
-    if callback:
-        IOLoop.instance().add_future(future, lambda f: callback(f.result()))
     result = task.apply_async(*args, **kwargs)
-    IOLoop.instance().add_callback(_on_sync_result, result, future, IOLoop.instance().time(), timeout)
+    future = ResultWaiter.get(result.backend).wait(result.id, states.READY_STATES, timeout)
+    future = _chain(future, lambda meta: meta['result'] if meta else None)
+    if callback:
+        IOLoop.current().add_future(future, lambda f: callback(f.result()))
     return future
 
 
-def _on_async_result(result, future):
-    if result.state == states.STARTED:
-        future.set_result(result.task_id)
-    else:
-        IOLoop.instance().add_callback(_on_async_result, result, future)
+def publish_many(task, args_list, kwargs_list=None, task_ids=None, **options):
+    """通过同一个producer批量发送任务
+
+    :parameter:
+      - `args_list`:每个任务的位置参数
+      - `kwargs_list`:每个任务的关键字参数,为None时都为空
+      - `task_ids`:每个任务的taskid,为None时由celery生成
+      - `options`:apply_async的其他参数(queue/exchange/routing_key...)
+
+    :return: AsyncResult列表
+    """
+
+    kwargs_list = kwargs_list or [None] * len(args_list)
+    task_ids = task_ids or [None] * len(args_list)
+    with task.app.producer_or_acquire() as producer:
+        return [task.apply_async(args, kwargs, task_id=task_id, producer=producer, **options)
+                for args, kwargs, task_id in zip(args_list, kwargs_list, task_ids)]
+
+
+def gather(backend, task_ids, timeout=None):
+    """并发等待多个任务结束,所有任务共用同一个截止时间
 
+    :parameter:
+      - `timeout`:超时时间,超时后未结束的任务meta为None
+
+    :return: future,结果为与task_ids顺序一致的meta列表
+    """
+
+    waiter = ResultWaiter.get(backend)
+    return gen.multi([waiter.wait(task_id, states.READY_STATES, timeout) for task_id in task_ids])
 
-def _on_sync_result(result, future, start_time, timeout):
-    if IOLoop.instance().time()-start_time < timeout:
-        if result.ready():
-            future.set_result(result.result)
+
+def _chain(future, convert):
+    """将future的结果转换后放入新的future"""
+
+    chained = Future()
+
+    def done(f):
+        if f.exception():
+            chained.set_exception(f.exception())
         else:
-            IOLoop.instance().add_callback(_on_sync_result, result, future, start_time, timeout)
-    else:
-        future.set_result(None)
+            chained.set_result(convert(f.result()))
+
+    IOLoop.current().add_future(future, done)
+    return chained
+
+
+class ResultWaiter(object):
+    """事件驱动的任务结果等待
+
+    同一个结果后端的所有等待中的任务共用一个poller,每次用一条mget批量查询状态,
+    没有任务状态变化时查询间隔从POLL_MIN指数增长到POLL_MAX,有新任务加入时重置
+    redis结果后端写入状态时会发布到任务key同名的频道,后台线程订阅后收到消息立即完成等待,
+    poller只作为丢失消息时的兜底
+
+    :parameter:
+      - `backend`:celery结果后端
+      - `subscribe`:是否订阅redis结果后端的发布,为None时redis后端自动订阅
+    """
+
+    _waiters = {}
+
+    def __init__(self, backend, subscribe=None):
+        self.backend = backend
+        self.io_loop = IOLoop.current()
+        self.stats = {'polls': 0, 'published': 0, 'completed': 0, 'timeouts': 0}
+        self._waiting = {}
+        self._interval = POLL_MIN
+        self._poller = None
+        self._pubsub = None
+        self._thread = None
+
+        if subscribe is None:
+            subscribe = hasattr(backend, 'client') and hasattr(backend.client, 'pubsub')
+        if subscribe:
+            self._subscribe()
+
+    @classmethod
+    def get(cls, backend):
+        """获取结果后端在当前IOLoop上的共享实例"""
+
+        key = (id(backend), IOLoop.current())
+        waiter = cls._waiters.get(key)
+        if waiter is None:
+            waiter = cls._waiters[key] = cls(backend)
+        return waiter
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def wait(self, task_id, done_states=states.READY_STATES, timeout=None):
+        """等待任务进入done_states中的状态
+
+        :parameter:
+          - `task_id`:任务id
+          - `done_states`:视为完成的状态集合
+          - `timeout`:超时时间(秒),超时后结果为None
+
+        :return: future,结果为任务的meta(status/result/traceback...)
+        """
+
+        future = Future()
+        handle = None
+        if timeout is not None:
+            handle = self.io_loop.call_later(timeout, self._expire, task_id, future)
+        self._waiting.setdefault(task_id, []).append((done_states, future, handle))
+
+        # 新任务加入时尽快查询一次
+        self._interval = POLL_MIN
+        if self._poller is not None:
+            self.io_loop.remove_timeout(self._poller)
+        self._poller = self.io_loop.call_later(POLL_MIN, self._poll)
+        return future
+
+    def _expire(self, task_id, future):
+        waiters = self._waiting.get(task_id, [])
+        for waiter in waiters:
+            if waiter[1] is future:
+                waiters.remove(waiter)
+                break
+        if not waiters:
+            self._waiting.pop(task_id, None)
+
+        if not future.done():
+            self.stats['timeouts'] += 1
+            recorder('WARN', '{obj} wait task <{id}> timeout'.format(obj=self, id=task_id))
+            future.set_result(None)
+
+    def _fetch(self, task_ids):
+        """批量查询任务的meta,支持mget的后端(redis/memcache...)一次查询,其余逐个查询"""
+
+        try:
+            keys = [self.backend.get_key_for_task(task_id) for task_id in task_ids]
+            values = self.backend.mget(keys)
+        except (AttributeError, NotImplementedError):
+            return [self.backend.get_task_meta(task_id) for task_id in task_ids]
+        # memcache类后端返回以key为键的字典,redis返回与keys顺序一致的列表
+        if hasattr(values, 'get'):
+            values = [values.get(key) for key in keys]
+        return [self.backend.decode_result(value) if value is not None else None for value in values]
+
+    def _poll(self):
+        self._poller = None
+        if not self._waiting:
+            return
+
+        task_ids = list(self._waiting)
+        self.stats['polls'] += 1
+        try:
+            metas = self._fetch(task_ids)
+        except Exception as e:
+            recorder('ERROR', '{obj} poll task state error ({e})'.format(obj=self, e=e))
+            metas = []
+
+        changed = False
+        for task_id, meta in zip(task_ids, metas):
+            if meta is not None:
+                changed = self._complete(task_id, meta) or changed
+
+        if self._waiting:
+            self._interval = POLL_MIN if changed else min(self._interval * 2, POLL_MAX)
+            self._poller = self.io_loop.call_later(self._interval, self._poll)
+
+    def _complete(self, task_id, meta):
+        """任务状态变化,完成等待该状态的future"""
+
+        waiters = self._waiting.get(task_id)
+        if not waiters:
+            return False
+
+        remain = []
+        for done_states, future, handle in waiters:
+            if meta.get('status') in done_states:
+                if handle is not None:
+                    self.io_loop.remove_timeout(handle)
+                if not future.done():
+                    self.stats['completed'] += 1
+                    future.set_result(meta)
+            else:
+                remain.append((done_states, future, handle))
+
+        if remain:
+            self._waiting[task_id] = remain
+        else:
+            del self._waiting[task_id]
+        return len(remain) != len(waiters)
+
+    def _subscribe(self):
+        self._pubsub = self.backend.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.psubscribe(self.backend.get_key_for_task('*'))
+        self._thread = FThread(name='celery-result-subscriber', task=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _listen(self, thread):
+        try:
+            message = self._pubsub.get_message(timeout=SUBSCRIBE_POLL)
+        except Exception as e:
+            recorder('WARN', '{obj} subscribe error ({e})'.format(obj=self, e=e))
+            thread._event.wait(1)
+            return
+
+        if message and message['type'] == 'pmessage':
+            task_id = self.backend._strip_prefix(message['channel'])
+            if task_id in self._waiting:
+                self.stats['published'] += 1
+                meta = self.backend.decode_result(message['data'])
+                self.io_loop.add_callback(self._complete, task_id, meta)
+
+    def close(self):
+        """停止订阅并让所有等待中的任务超时"""
+
+        if self._thread is not None:
+            # 等待订阅线程退出后再关闭连接,避免两个线程同时操作连接
+            self._thread.join(SUBSCRIBE_POLL * 10)
+            self._pubsub.close()
+            self._thread = None
+
+        if self._poller is not None:
+            self.io_loop.remove_timeout(self._poller)
+            self._poller = None
+
+        for task_id, waiters in list(self._waiting.items()):
+            for _, future, handle in waiters:
+                if handle is not None:
+                    self.io_loop.remove_timeout(handle)
+                if not future.done():
+                    future.set_result(None)
+        self._waiting.clear()
+
+        for key, waiter in list(self._waiters.items()):
+            if waiter is self:
+                del self._waiters[key]
+
+    def __str__(self):
+        return '<ResultWaiter {backend} waiting {count}>'.format(backend=self.backend.__class__.__name__,
+                                                                count=len(self._waiting))
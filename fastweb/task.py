@@ -4,7 +4,7 @@
 
 import os
 import sys
-import json
+import threading
 from multiprocessing import Process
 
 from fastweb import app
@@ -15,7 +15,7 @@ from fastweb.component.task import Task
 from fastweb.util.python import load_object
 from fastweb.components import SyncComponents
 from fastweb.accesspoint import CeleryTask
-from fastweb.util.log import recorder
+from fastweb.util.log import recorder, lazy, log_fields
 
 __all__ = ['start_task_worker']
 DEFAULT_TIMEOUT = 5
@@ -41,7 +41,11 @@ class IFaceWorker(CeleryTask):
 
 
 class Worker(Task):
-    """工作者类"""
+    """工作者类
+
+    执行对象保存请求状态,每个线程使用自己的执行对象,threads/eventlet/gevent并发池中的任务互不影响
+    eventlet/gevent替换threading后为每个协程一个执行对象
+    """
 
     eattr = {'task_class': str, 'broker': str, 'queue': str, 'exchange': str, 'routing_key': str, 'backend': str}
     oattr = {'timeout': int, 'rate_limit': str, 'acks_late': bool}
@@ -58,32 +62,51 @@ class Worker(Task):
         # 设置执行任务的类
         self._task_cls = load_object(self.task_class)
         self._setting = setting
-        self._worker_obj = None
+        # 每个线程的执行对象
+        self._local = threading.local()
+
+        # 执行对象的类只组合一次,request属性转发到当前任务的请求上下文
+        worker = self
+        self._worker_cls = type('Worker', (self._task_cls, SyncComponents, IFaceWorker),
+                                {'request': property(lambda obj: worker.request)})
 
     def __str__(self):
         return '<Task: {name} of queue({queue}) exchange({exchange}) routing_key({routing_key})>'.\
             format(name=self.name, queue=self.queue, exchange=self.exchange, routing_key=self.routing_key)
 
+    @property
+    def _worker_obj(self):
+        """当前线程的执行对象"""
+
+        return getattr(self._local, 'worker', None)
+
+    def _worker(self):
+        """获取当前线程的执行对象,线程第一次执行任务时创建,之后每次执行前重置请求状态"""
+
+        worker = self._worker_obj
+        if worker is None:
+            # Components中生成requestid
+            worker = self._local.worker = self._worker_cls()
+            worker.setting = self._setting
+        worker.reset(self.request.id)
+        return worker
+
     def run(self, *args, **kwargs):
         """任务处理
         转发给具体执行对象的run方法"""
 
-        # Components中生成requestid
-        self._worker_obj = type('Worker', (self._task_cls, SyncComponents, IFaceWorker), {'request': self.request})()
-        self._worker_obj.setting = self._setting
-        self._worker_obj.requestid = self.request.id
+        worker = self._worker()
 
-        if hasattr(self._worker_obj, 'run'):
-            self._worker_obj.recorder('IMPORTANT', '{obj} start\nRequest:\n{request}\nArgument: {args}\t{kwargs}'.format(obj=self,
-                                                                                                                         request=json.dumps(self.request.as_execution_options(), indent=4),
-                                                                                                                         args=args,
-                                                                                                                         kwargs=kwargs))
-            with timing('ms', 10) as t:
-                ret = self._worker_obj.run(*args, **kwargs)
-            self._worker_obj.recorder('IMPORTANT', '{obj} end\nReturn: {r} -- {t}'.format(obj=self, r=ret, t=t))
+        if hasattr(worker, 'run'):
+            worker.recorder('IMPORTANT', lazy('{obj} start\nRequest: {request}\nArgument: {args}\t{kwargs}',
+                                              obj=self, request=self.request, args=args, kwargs=kwargs))
+            with worker.span('run', unit='ms', precision=10) as t:
+                ret = worker.run(*args, **kwargs)
+            worker.recorder('IMPORTANT', log_fields(lazy('{obj} end\nReturn: {r} -- {t}', obj=self, r=ret, t=t),
+                                                    self.name, 'run', t))
             return ret
         else:
-            self._worker_obj.recorder('CRITICAL', '{obj} must have run function!'.format(obj=self))
+            worker.recorder('CRITICAL', '{obj} must have run function!'.format(obj=self))
             raise TaskError
 
     def on_success(self, retval, task_id, args, kwargs):
@@ -103,10 +126,10 @@ class Worker(Task):
         """
 
         if hasattr(self._worker_obj, 'on_success'):
-            self._worker_obj.recorder('INFO', '{obj} success callback start'.format(obj=self))
+            self._worker_obj.recorder('INFO', lazy('{obj} success callback start', obj=self))
             with timing('ms', 10) as t:
                 r = self._worker_obj.on_success(retval, task_id, args, kwargs)
-            self._worker_obj.recorder('INFO', '{obj} success callback end -- {t}'.format(obj=self, t=t))
+            self._worker_obj.recorder('INFO', lazy('{obj} success callback end -- {t}', obj=self, t=t))
             return r
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
@@ -179,10 +202,10 @@ class Worker(Task):
         """
 
         if hasattr(self._worker_obj, 'after_return'):
-            self._worker_obj.recorder('DEBUG', '{obj} after return callback start'.format(obj=self))
+            self._worker_obj.recorder('DEBUG', lazy('{obj} after return callback start', obj=self))
             with timing('ms', 10) as t:
                 self._worker_obj.after_return(status, retval, task_id, args, kwargs, einfo)
-            self._worker_obj.recorder('DEBUG', '{obj} after return callback end -- {t}'.format(obj=self, t=t))
+            self._worker_obj.recorder('DEBUG', lazy('{obj} after return callback end -- {t}', obj=self, t=t))
 
         self._worker_obj.release()
 
@@ -0,0 +1,53 @@
+# coding:utf8
+
+"""批量插入性能对比: 逐条query提交 vs bulk_insert"""
+
+import time
+
+from fastweb.component.db.mysql import SyncMysql
+
+
+setting = {'host': 'localhost', 'port': 3306, 'user': 'root', 'password': ''}
+ROWS = 10000
+BATCH_SIZES = (100, 1000, 5000)
+
+
+def prepare(mysql):
+    mysql.query('CREATE DATABASE IF NOT EXISTS fastweb_bench')
+    mysql.query('CREATE TABLE IF NOT EXISTS fastweb_bench.bulk '
+                '(id INT PRIMARY KEY, name VARCHAR(64), score DOUBLE)')
+    mysql.query('TRUNCATE TABLE fastweb_bench.bulk')
+
+
+def report(name, rows, total):
+    print('{name:<24}{rows} rows\t{total:.3f}s\t{speed:.0f} rows/s'.format(name=name, rows=rows, total=total,
+                                                                          speed=rows / total))
+
+
+def main():
+    mysql = SyncMysql(setting).set_name('bulk_insert_bench')
+    mysql.connect()
+    rows = [{'id': i, 'name': 'name-{}'.format(i), 'score': i * 0.5} for i in range(ROWS)]
+
+    prepare(mysql)
+    start = time.time()
+    for row in rows:
+        mysql.query('INSERT INTO fastweb_bench.bulk (id, name, score) VALUES (%(id)s, %(name)s, %(score)s)', row)
+    report('query loop', ROWS, time.time() - start)
+
+    for batch_size in BATCH_SIZES:
+        prepare(mysql)
+        start = time.time()
+        mysql.bulk_insert('fastweb_bench.bulk', rows, batch_size=batch_size)
+        report('bulk_insert {}'.format(batch_size), ROWS, time.time() - start)
+
+    prepare(mysql)
+    start = time.time()
+    mysql.executemany('INSERT INTO fastweb_bench.bulk (id, name, score) VALUES (%(id)s, %(name)s, %(score)s)', rows)
+    report('executemany', ROWS, time.time() - start)
+
+    mysql.query('DROP DATABASE fastweb_bench')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# coding:utf8
+
+"""指标记录开销: HDR直方图,以及按标签查找后记录
+
+单线程记录随机耗时,输出每次记录的耗时和百分位数
+计时开销: 原来读取IOLoop时钟的timing vs 单调时钟的timing/span
+"""
+
+import time
+import random
+
+from fastweb.accesspoint import ioloop
+from fastweb.util.tool import SpanTree, timing
+from fastweb.util.metrics import Registry, LatencyHistogram
+
+
+CALLS = 200000
+
+
+class IOLoopTiming(object):
+    """原来的实现: 每次进入和退出时读取当前线程IOLoop的时钟
+
+    tornado5的工作线程中没有IOLoop时IOLoop.current()会抛出异常,需要先为线程创建IOLoop
+    """
+
+    def __init__(self, unit='s', precision=4):
+        self.unit = unit
+        self.precision = precision
+
+    def __enter__(self):
+        self.start = ioloop.IOLoop.current().time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = ioloop.IOLoop.current().time()
+        self.total = round((self.end - self.start) * 1000, self.precision)
+        return False
+
+
+def run(name, observe, values):
+    start = time.time()
+    for value in values:
+        observe(value)
+    total = time.time() - start
+    print('{name:<24}{calls} observes\t{total:.3f}s\t{speed:.2f}us/observe'.format(
+        name=name, calls=len(values), total=total, speed=total / len(values) * 1000000))
+
+
+def run_timing(name, factory):
+    start = time.time()
+    for _ in range(CALLS):
+        with factory():
+            pass
+    total = time.time() - start
+    print('{name:<24}{calls} blocks\t{total:.3f}s\t{speed:.2f}us/block'.format(
+        name=name, calls=CALLS, total=total, speed=total / CALLS * 1000000))
+
+
+def timing_main():
+    histogram = LatencyHistogram()
+    run_timing('ioloop timing', lambda: IOLoopTiming('ms', 10))
+    run_timing('timing', lambda: timing('ms', 10))
+    run_timing('timing + sink', lambda: timing('ms', 10, sink=histogram))
+    # 每个请求一个调用树
+    run_timing('span', lambda: SpanTree().span('bench'))
+
+
+def main():
+    # 对数正态分布的耗时,中位数约5ms
+    values = [random.lognormvariate(-5.3, 1) for _ in range(CALLS)]
+
+    hdr = LatencyHistogram()
+    run('hdr', hdr.observe, values)
+
+    family = Registry().histogram('bench_seconds', 'Bench', ('component', 'op'))
+    run('labels + hdr', lambda value: family.labels('mysql', 'query').observe(value), values)
+
+    values.sort()
+    for percent in (50, 90, 99, 99.9):
+        exact = values[min(int(percent / 100.0 * CALLS), CALLS - 1)]
+        print('p{percent:<6}exact {exact:.6f}s\thdr {hdr:.6f}s'.format(percent=percent, exact=exact,
+                                                                       hdr=hdr.percentile(percent)))
+
+
+if __name__ == '__main__':
+    main()
+    timing_main()
@@ -0,0 +1,117 @@
+# coding:utf8
+
+"""Api请求的日志开销: 关闭DEBUG/INFO时,以及开启DEBUG时同步/异步写日志时一次Api请求的处理耗时
+
+不经过网络,直接构造请求并调用handler,只包含Api初始化/返回和日志的开销
+slow模拟慢磁盘,每次flush额外等待FLUSH_DELAY秒
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+from tornado.web import Application
+from tornado.concurrent import Future
+from tornado.httputil import HTTPServerRequest, HTTPHeaders, HTTPConnection
+
+from fastweb.loader import app
+from fastweb.web import Api
+
+
+REQUESTS = 20000
+FLUSH_DELAY = 0.001
+
+
+class SlowStream(object):
+    """flush变慢的文件流"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def flush(self):
+        time.sleep(FLUSH_DELAY)
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class NullConnection(HTTPConnection):
+    """丢弃所有输出的连接"""
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        return self._done()
+
+    def write(self, chunk, callback=None):
+        return self._done()
+
+    def finish(self):
+        pass
+
+    @staticmethod
+    def _done():
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class BenchApi(Api):
+    def get(self):
+        self.recorder('DEBUG', 'handle request {uri}'.format(uri=self.uri))
+        self.end('SUC', data={'id': 1})
+
+
+def run(level, asyn=False, slow=False):
+    log = os.path.join(tempfile.gettempdir(), 'fastweb_recorder_bench.log')
+    # 只比较文件日志的开销,关闭终端输出
+    app.load_recorder(log, log, application_level=level, system_level=level, asyn=False)
+    for name in ('application_recorder', 'system_recorder'):
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            if not isinstance(handler, logging.FileHandler):
+                logger.removeHandler(handler)
+            elif slow:
+                handler.stream = SlowStream(handler.stream)
+    if asyn:
+        app.asyn_recorder = True
+        app.load_asyn_recorder()
+    app.load_errcode()
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    application = Application([(r'/', BenchApi)])
+    connection = NullConnection()
+    headers = HTTPHeaders({'User-Agent': 'bench'})
+
+    requests = REQUESTS // 10 if slow else REQUESTS
+    worst = 0
+    start = time.time()
+    for _ in range(requests):
+        begin = time.time()
+        request = HTTPServerRequest(method='GET', uri='/?requestid=bench', headers=headers, connection=connection)
+        handler = BenchApi(application, request)
+        handler._transforms = []
+        handler.get()
+        worst = max(worst, time.time() - begin)
+    total = time.time() - start
+    dropped = sum(handler.stats['dropped'] for handler in app.asyn_handlers)
+    for handler in app.asyn_handlers:
+        handler.close()
+    print('level {level:<8}{mode:<12}{requests} requests\t{total:.3f}s\t{per:.1f}us/request\t'
+          'max {worst:.1f}ms\tdropped {dropped}'.format(level=level, mode=('asyn' if asyn else 'sync') + (' slow' if slow else ''),
+                                                        requests=requests, total=total, per=total / requests * 1000000,
+                                                        worst=worst * 1000, dropped=dropped))
+
+
+def main():
+    run('WARN')
+    run('DEBUG')
+    run('DEBUG', asyn=True)
+    run('DEBUG', slow=True)
+    run('DEBUG', asyn=True, slow=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# coding:utf8
+
+"""服务端单次调用开销对比: 每次调用创建Processor和handler vs 线程内复用"""
+
+import time
+import logging
+
+from thrift.Thrift import TMessageType
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+
+from fastweb.loader import app
+from fastweb.service import Service
+from fastweb.util.tool import timing
+from fastweb.util.python import load_module
+from fastweb.test.fastweb_thrift_sync.HelloService.HelloService import sayHello_args
+
+
+MODULE = 'fastweb.test.fastweb_thrift_sync.HelloService.HelloService'
+CALLS = 20000
+
+
+class HelloHandler(object):
+    def sayHello(self):
+        return 'hello'
+
+
+def request():
+    buf = TTransport.TMemoryBuffer()
+    oprot = TCompactProtocol.TCompactProtocol(buf)
+    oprot.writeMessageBegin('sayHello', TMessageType.CALL, 1)
+    sayHello_args().write(oprot)
+    oprot.writeMessageEnd()
+    return buf.getvalue()
+
+
+def run(name, processor, frame):
+    start = time.time()
+    for _ in range(CALLS):
+        iprot = TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(frame))
+        oprot = TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer())
+        processor.process(iprot, oprot)
+    total = time.time() - start
+    print('{name:<16}{calls} calls\t{total:.3f}s\t{per:.1f}us/call'.format(name=name, calls=CALLS, total=total,
+                                                                          per=total / CALLS * 1000000))
+
+
+def per_call_processor(service):
+    """每次调用都创建Processor和handler"""
+
+    module = load_module(MODULE)
+    processor = getattr(module, 'Processor')(handler=None)
+
+    def dispatch(name):
+        def anonymous(p, seq, ipo, opo):
+            oproc = getattr(module, 'Processor')(handler=service._handlers())
+            oproc._handler.requestid = seq if len(str(seq)) > 8 else oproc._handler.requestid
+            oproc._handler.recorder('IMPORTANT', '{obj}\nremote call [{name}]'.format(obj=service, name=name))
+            with timing('ms', 8) as t:
+                oproc._processMap[name](oproc, seq, ipo, opo)
+            oproc._handler.release()
+            oproc._handler.recorder('IMPORTANT', '{obj}\nremote call [{name}] success -- {t}'.format(obj=service,
+                                                                                                   name=name, t=t))
+        return anonymous
+
+    for name in list(processor._processMap):
+        processor._processMap[name] = dispatch(name)
+    return processor
+
+
+def main():
+    # 只比较分发开销,关闭日志输出
+    app.application_recorder = logging.getLogger('service_processor_bench')
+    app.application_recorder.setLevel(logging.CRITICAL)
+
+    service = Service({'port': 9090, 'thrift_module': MODULE, 'handlers': '__main__.HelloHandler'})
+    frame = request()
+
+    run('per call', per_call_processor(service), frame)
+    run('thread reuse', service.build_processor(), frame)
+
+
+if __name__ == '__main__':
+    main()
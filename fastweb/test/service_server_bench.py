@@ -0,0 +1,115 @@
+# coding:utf8
+
+"""Thrift服务端模式对比: threadpool / nonblocking / tornado / 多进程
+
+每种模式在独立的进程中启动HelloService,CLIENTS个客户端进程各自使用一个连接顺序调用DURATION秒
+输出吞吐量和p50/p99延迟
+"""
+
+import os
+import time
+import signal
+import socket
+import tempfile
+from multiprocessing import Process, Queue
+
+from fastweb.loader import app
+from fastweb.service import Service
+from fastweb.component.rpc.tft import SyncTftRpc
+
+
+SYNC_MODULE = 'fastweb.test.fastweb_thrift_sync.HelloService.HelloService'
+ASYN_MODULE = 'fastweb.test.fastweb_thrift_async.HelloService.HelloService'
+HANDLER = 'fastweb.test.service_server_bench.BenchHandler'
+CLIENTS = 8
+DURATION = 5
+MODES = [('threadpool', {'server': 'threadpool', 'size': 64}),
+         ('nonblocking', {'server': 'nonblocking', 'size': 8}),
+         ('tornado', {'server': 'tornado', 'thrift_module': ASYN_MODULE}),
+         ('threadpool x4', {'server': 'threadpool', 'size': 64, 'processes': 4}),
+         ('tornado x4', {'server': 'tornado', 'thrift_module': ASYN_MODULE, 'processes': 4})]
+
+
+class BenchHandler(object):
+    def sayHello(self):
+        return 'hello'
+
+
+def quiet():
+    log = os.path.join(tempfile.gettempdir(), 'fastweb_service_bench.log')
+    app.load_recorder(log, log, application_level='ERROR', system_level='ERROR')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(setting):
+    # 多进程模式下父进程和子进程在同一个进程组中,结束时一起退出
+    os.setpgrp()
+    quiet()
+    Service(setting).set_name('bench').start()
+
+
+def client(port, queue):
+    quiet()
+    rpc = SyncTftRpc({'host': 'localhost', 'port': port, 'thrift_module': SYNC_MODULE}).set_name('bench').connect()
+    latencies = []
+    deadline = time.time() + DURATION
+
+    while time.time() < deadline:
+        start = time.time()
+        rpc.sayHello()
+        latencies.append(time.time() - start)
+
+    rpc.close()
+    queue.put(latencies)
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('server not ready on {}'.format(port))
+
+
+def bench(name, options):
+    port = free_port()
+    setting = dict({'port': port, 'thrift_module': SYNC_MODULE, 'handlers': HANDLER}, **options)
+    server = Process(target=serve, args=(setting, ))
+    server.start()
+    wait_port(port)
+    # 等待所有子进程开始监听
+    time.sleep(0.5)
+
+    queue = Queue()
+    clients = [Process(target=client, args=(port, queue)) for _ in range(CLIENTS)]
+    for process in clients:
+        process.start()
+    latencies = sorted(latency for _ in clients for latency in queue.get())
+    for process in clients:
+        process.join()
+
+    os.killpg(server.pid, signal.SIGKILL)
+    server.join()
+
+    print('{name:<16}{qps:>10.0f} calls/s\tp50 {p50:.3f}ms\tp99 {p99:.3f}ms'.format(
+        name=name, qps=len(latencies) / float(DURATION),
+        p50=latencies[len(latencies) // 2] * 1000, p99=latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def main():
+    for name, options in MODES:
+        bench(name, options)
+
+
+if __name__ == '__main__':
+    main()
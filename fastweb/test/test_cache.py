@@ -0,0 +1,330 @@
+# coding:utf8
+
+import os
+import time
+import threading
+
+from fastweb.accesspoint import ioloop, coroutine, sleep, Return
+from fastweb.cache import cache, PickleCodec, LocalCache, LocalInvalidator, RedisInvalidator, QueryCache
+from fastweb.manager import Manager
+from fastweb.web import AsynComponents
+from fastweb.pool import AsynConnectionPool
+from fastweb.component.db.rds import SyncRedis, AsynRedis
+
+
+setting = {'host': 'localhost'}
+
+
+class SyncUser(object):
+
+    def __init__(self):
+        self.redis = SyncRedis(setting).connect()
+        self.calls = 0
+
+    @cache('redis', 'test:cache:user:{}', expire=60)
+    def get(self, uid):
+        self.calls += 1
+        time.sleep(0.05)
+        return {'uid': uid, 'name': 'jackson'}
+
+    @cache('redis', 'test:cache:user:pickle:{}', expire=60, codec=PickleCodec)
+    def get_pickle(self, uid):
+        self.calls += 1
+        return {'uid': uid, 'tags': {'a', 'b'}}
+
+
+invalidator = LocalInvalidator()
+
+
+class SyncWorker(object):
+    """模拟两个进程的一级缓存,通过invalidator同步失效"""
+
+    def __init__(self):
+        self.redis = SyncRedis(setting).connect()
+        self.calls = 0
+
+    def get(self, uid):
+        self.calls += 1
+        return {'uid': uid}
+
+
+class SyncWorkerA(SyncWorker):
+    get = cache('redis', 'test:cache:worker:{}', expire=60, local=LocalCache(), invalidator=invalidator)(SyncWorker.get)
+
+
+class SyncWorkerB(SyncWorker):
+    get = cache('redis', 'test:cache:worker:{}', expire=60, local=LocalCache(), invalidator=invalidator)(SyncWorker.get)
+
+
+class AsynUser(object):
+
+    def __init__(self):
+        self.redis = AsynRedis(setting)
+        self.calls = 0
+
+    @cache('redis', 'test:cache:auser:{}', expire=60, beta=0)
+    @coroutine
+    def get(self, uid):
+        self.calls += 1
+        yield sleep(0.05)
+        raise Return([uid, 'jackson'])
+
+    @cache('redis', 'test:cache:auser:local:{}', expire=60, local=True)
+    @coroutine
+    def get_local(self, uid):
+        self.calls += 1
+        raise Return(uid)
+
+    @cache('redis', 'test:cache:auser:refresh:{}', expire=60, beta=1e9)
+    @coroutine
+    def get_refresh(self, uid):
+        self.calls += 1
+        raise Return(self.calls)
+
+
+class TestSyncCache(object):
+
+    def test_read_through(self):
+        user = SyncUser()
+        SyncUser.get.invalidate(user, 1)
+        assert user.get(1) == {'uid': 1, 'name': 'jackson'}
+        assert user.get(1) == {'uid': 1, 'name': 'jackson'}
+        assert user.calls == 1
+        assert 0 < user.redis.execute('TTL', 'test:cache:user:1') <= 60
+
+    def test_singleflight(self):
+        user = SyncUser()
+        SyncUser.get.invalidate(user, 2)
+
+        def _get():
+            user.get(2)
+
+        threads = [threading.Thread(target=_get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert user.calls == 1
+
+    def test_update_codec(self):
+        user = SyncUser()
+        SyncUser.get_pickle.invalidate(user, 3)
+        assert user.get_pickle(3) == {'uid': 3, 'tags': {'a', 'b'}}
+        SyncUser.get_pickle.update(user, 'updated', 3)
+        assert user.get_pickle(3) == 'updated'
+        assert user.calls == 1
+
+
+class TestAsynCache(object):
+
+    def test_read_through(self):
+        user = AsynUser()
+        ioloop.IOLoop.current().run_sync(user.redis.connect)
+
+        @coroutine
+        def _read():
+            yield AsynUser.get.invalidate(user, 1)
+            results = yield [user.get(1) for _ in range(5)]
+            assert results == [[1, 'jackson']] * 5
+            assert user.calls == 1
+            r = yield user.get(1)
+            assert r == [1, 'jackson']
+            assert user.calls == 1
+        ioloop.IOLoop.current().run_sync(_read)
+
+    def test_early_refresh(self):
+        user = AsynUser()
+        ioloop.IOLoop.current().run_sync(user.redis.connect)
+
+        @coroutine
+        def _refresh():
+            yield AsynUser.get_refresh.invalidate(user, 1)
+            yield user.get_refresh(1)
+            r = yield user.get_refresh(1)
+            assert r == 2
+        ioloop.IOLoop.current().run_sync(_refresh)
+
+    def test_local(self):
+        user = AsynUser()
+        ioloop.IOLoop.current().run_sync(user.redis.connect)
+        local = AsynUser.get_local.cache.local
+
+        @coroutine
+        def _local():
+            yield AsynUser.get_local.invalidate(user, 1)
+            r = yield user.get_local(1)
+            assert r == 1
+            r = yield user.get_local(1)
+            assert r == 1
+            assert local.stats()['hit'] == 1
+            yield AsynUser.get_local.update(user, 'updated', 1)
+            assert 'test:cache:auser:local:1' not in local
+            r = yield user.get_local(1)
+            assert r == 'updated'
+            assert user.calls == 1
+        ioloop.IOLoop.current().run_sync(_local)
+
+
+    def test_pending_storage(self):
+        """storage来自异步连接池时,先等待获取组件再读取缓存"""
+        pool = AsynConnectionPool(AsynRedis, setting, name='cache_redis', size=1, maxconnections=1)
+        ioloop.IOLoop.current().run_sync(pool.create)
+        Manager._pools['cache_redis'] = pool
+
+        class PoolUser(AsynComponents):
+            @cache('cache_redis', 'test:cache:pooluser:{}', expire=60)
+            @coroutine
+            def get(self, uid):
+                raise Return(uid)
+
+        @coroutine
+        def _read():
+            user = PoolUser()
+            yield PoolUser.get.invalidate(user, 1)
+            r = yield user.get(1)
+            assert r == 1
+            user.release()
+            assert pool.stats()['idle'] == 1
+
+        try:
+            ioloop.IOLoop.current().run_sync(_read)
+        finally:
+            del Manager._pools['cache_redis']
+
+
+class TestLocalCache(object):
+
+    def test_lru(self):
+        local = LocalCache(maxsize=2)
+        local.set('a', 1)
+        local.set('b', 2)
+        assert local.get('a') == (True, 1)
+        local.set('c', 3)
+        assert 'b' not in local
+        assert local.get('c') == (True, 3)
+        assert local.get('b') == (False, None)
+        stats = local.stats()
+        assert (stats['hit'], stats['miss'], stats['evict'], stats['size']) == (2, 1, 1, 2)
+
+    def test_memory(self):
+        local = LocalCache(maxmemory=10)
+        local.set('a', 'a', size=6)
+        local.set('b', 'b', size=4)
+        assert local.memory == 10
+        local.set('c', 'c', size=3)
+        assert 'a' not in local and local.memory == 7
+        local.set('d', 'd', size=11)
+        assert 'd' not in local
+        local.delete('b')
+        assert local.memory == 3
+
+    def test_ttl(self):
+        local = LocalCache(ttl=0.05)
+        local.set('a', 1)
+        local.set('b', 2, ttl=60)
+        time.sleep(0.1)
+        assert local.get('a') == (False, None)
+        assert local.get('b') == (False, None)
+        assert local.stats()['expire'] == 2
+
+
+class TestInvalidator(object):
+
+    def test_local_invalidator(self):
+        a, b = SyncWorkerA(), SyncWorkerB()
+        SyncWorkerA.get.invalidate(a, 1)
+        assert a.get(1) == b.get(1) == {'uid': 1}
+        assert a.calls + b.calls == 1
+        assert 'test:cache:worker:1' in SyncWorkerB.get.cache.local
+        SyncWorkerA.get.update(a, {'uid': 2}, 1)
+        assert 'test:cache:worker:1' not in SyncWorkerB.get.cache.local
+        assert b.get(1) == {'uid': 2}
+
+    def test_redis_invalidator(self):
+        local = LocalCache()
+        local.set('test:cache:remote', 1)
+        remote = RedisInvalidator(setting)
+        remote.subscribe(local.delete)
+        storage = SyncRedis(setting).connect()
+        # 订阅线程启动前发布的消息会丢失,重复发布直到收到
+        for _ in range(50):
+            remote.publish(storage, 'test:cache:remote')
+            time.sleep(0.05)
+            if 'test:cache:remote' not in local:
+                break
+        remote.close()
+        assert 'test:cache:remote' not in local
+
+
+    def test_redis_invalidator_fork(self):
+        local = LocalCache()
+        remote = RedisInvalidator(setting)
+        remote.subscribe(local.delete)
+        thread = remote._thread
+
+        pid = os.fork()
+        if pid == 0:
+            # 子进程中重新订阅后才能收到失效消息
+            ok = False
+            try:
+                storage = SyncRedis(setting).connect()
+                local.set('test:cache:fork', 1)
+                for _ in range(50):
+                    remote.publish(storage, 'test:cache:fork')
+                    time.sleep(0.05)
+                    if 'test:cache:fork' not in local:
+                        ok = remote._thread is not thread
+                        break
+            finally:
+                os._exit(0 if ok else 1)
+        try:
+            assert os.waitpid(pid, 0)[1] == 0
+        finally:
+            remote.close()
+
+
+class TestQueryCache(object):
+
+    def test_parse(self):
+        assert QueryCache.parse_tables('SELECT * FROM `db`.`users` u JOIN orders o ON u.id = o.uid') == {'users', 'orders'}
+        assert QueryCache.parse_tables('select * from a, b as c where a.id = c.id') == {'a', 'b'}
+        assert QueryCache.parse_tables('UPDATE users SET name = %s') == {'users'}
+        assert QueryCache.parse_tables('insert into logs (msg) values (%s)') == {'logs'}
+        assert QueryCache.is_cacheable('  select 1')
+        assert not QueryCache.is_cacheable('select * from users for update')
+        assert QueryCache.is_write('DELETE FROM users') and not QueryCache.is_write('select 1')
+
+        query_cache = QueryCache(None)
+        assert query_cache.make_key('select *\n  from users;', {'b': 1, 'a': 2}) == \
+            query_cache.make_key('select * from users', {'a': 2, 'b': 1})
+        assert query_cache.make_key('select * from users', (1, )) != query_cache.make_key('select * from users', (2, ))
+
+    def test_sync(self):
+        query_cache = QueryCache(SyncRedis(setting).connect(), prefix='test:sql:')
+        sql = 'select * from users where id = %s'
+        query_cache.invalidate_sync(None, {'users'})
+        assert query_cache.get_sync(None, sql, (1, )) == (False, None)
+        query_cache.set_sync(None, sql, (1, ), [{'id': 1}], 0.5)
+        assert query_cache.get_sync(None, sql, (1, )) == (True, [{'id': 1}])
+        query_cache.invalidate_sync(None, QueryCache.parse_tables('update users set name = %s'))
+        assert query_cache.get_sync(None, sql, (1, )) == (False, None)
+        stats = query_cache.stats()
+        assert (stats['hit'], stats['miss'], stats['saved_time'], stats['hit_ratio']) == (1, 2, 0.5, 1.0 / 3)
+
+    def test_asyn(self):
+        query_cache = QueryCache(AsynRedis(setting), prefix='test:sql:')
+        ioloop.IOLoop.current().run_sync(query_cache.storage.connect)
+        sql = 'select * from orders'
+
+        @coroutine
+        def _query():
+            yield query_cache.invalidate_asyn(None, {'orders'})
+            r = yield query_cache.get_asyn(None, sql)
+            assert r == (False, None)
+            yield query_cache.set_asyn(None, sql, None, [{'id': 1}], 0.5)
+            r = yield query_cache.get_asyn(None, sql)
+            assert r == (True, [{'id': 1}])
+            yield query_cache.invalidate_asyn(None, {'orders'})
+            r = yield query_cache.get_asyn(None, sql)
+            assert r == (False, None)
+        ioloop.IOLoop.current().run_sync(_query)
@@ -0,0 +1,238 @@
+# coding:utf8
+
+import io
+import os
+import json
+import time
+import logging
+import threading
+
+from fastweb.util.logindex import build_index, index_path, trace
+from fastweb.util.log import (record, lazy, ColoredFormatter, LEVEL_TABLE, set_record_color, AsynLogHandler,
+                              LOG_BLOCK, JsonFormatter, log_fields, BatchStreamHandler)
+
+
+class Rendered(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'rendered'
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+        self.records = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.records.append(record)
+
+
+class FlushCounter(BatchStreamHandler):
+
+    def __init__(self):
+        super(FlushCounter, self).__init__(io.StringIO())
+        self.flushes = 0
+
+    def flush(self):
+        if not self._handling:
+            self.flushes += 1
+        super(FlushCounter, self).flush()
+
+
+class BlockingHandler(ListHandler):
+
+    def __init__(self):
+        super(BlockingHandler, self).__init__()
+        self.event = threading.Event()
+
+    def emit(self, record):
+        self.event.wait()
+        super(BlockingHandler, self).emit(record)
+
+
+class TestRecord(object):
+
+    def setup_method(self, method):
+        self.logger = logging.getLogger('fastweb.test.log')
+        self.logger.propagate = False
+        self.handler = ListHandler()
+        self.logger.handlers = [self.handler]
+
+    def test_disabled_level(self):
+        self.logger.setLevel(logging.WARNING)
+        rendered = Rendered()
+        record('INFO', lazy('{obj} query start', obj=rendered), self.logger)
+        assert rendered.count == 0
+        assert not self.handler.messages
+
+    def test_lazy_render(self):
+        self.logger.setLevel(logging.DEBUG)
+        rendered = Rendered()
+        msg = lazy('{obj} query start', obj=rendered)
+        record('INFO', msg, self.logger)
+        # 记录时不格式化,handler输出时才格式化
+        assert self.handler.records[0].msg is msg
+        assert self.handler.messages == ['rendered query start']
+
+    def test_color_only_in_console(self):
+        self.logger.setLevel(logging.DEBUG)
+        record('important', 'request end', self.logger, requestid='abc')
+        assert self.handler.messages == ['request end']
+
+        log = self.handler.records[0]
+        assert log.levelno == logging.INFO and log.requestid == 'abc' and log.color == 'cyan'
+        assert ColoredFormatter('%(message)s').format(log) == '\x1b[1m\x1b[36mrequest end\x1b[0m'
+
+    def test_error_traceback(self):
+        self.logger.setLevel(logging.DEBUG)
+        record('ERROR', 'no exception', self.logger)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record('ERROR', 'with exception', self.logger)
+        assert self.handler.messages[0] == 'no exception'
+        assert self.handler.messages[1].startswith('with exception') and 'ValueError: boom' in self.handler.messages[1]
+
+    def test_set_record_color(self):
+        set_record_color({'DEBUG': 'blue'})
+        try:
+            assert LEVEL_TABLE['debug'][1]['color'] == 'blue'
+        finally:
+            set_record_color({'DEBUG': 'green'})
+
+    def test_asyn_handler(self):
+        self.logger.setLevel(logging.DEBUG)
+        handler = AsynLogHandler([self.handler], batch=16)
+        self.logger.handlers = [handler]
+
+        rendered = Rendered()
+        record('INFO', lazy('{obj} query start', obj=rendered), self.logger, requestid='abc')
+        # 在调用线程中格式化
+        assert rendered.count == 1
+        for i in range(100):
+            record('DEBUG', lazy('message {i}', i=i), self.logger)
+        handler.close()
+
+        assert self.handler.messages == ['rendered query start'] + ['message {}'.format(i) for i in range(100)]
+        assert self.handler.records[0].requestid == 'abc'
+        assert handler.stats['written'] == 101 and handler.stats['dropped'] == 0
+        assert handler.stats['batches'] < 101
+
+    def test_asyn_flush(self):
+        self.logger.setLevel(logging.DEBUG)
+        target = FlushCounter()
+        # 同步写入时每条日志flush
+        self.logger.handlers = [target]
+        record('INFO', 'sync', self.logger)
+        assert target.flushes == 1
+
+        handler = AsynLogHandler([target], batch=256)
+        self.logger.handlers = [handler]
+        target.acquire()
+        for i in range(100):
+            record('INFO', 'message {}'.format(i), self.logger)
+        # 目标handler被锁住时日志都在队列中,释放后一批写入
+        target.release()
+        handler.close()
+
+        assert target.stream.getvalue().splitlines() == ['sync'] + ['message {}'.format(i) for i in range(100)]
+        assert target.flushes == 1 + handler.stats['batches'] and handler.stats['batches'] < 100
+
+    def test_asyn_drop(self):
+        self.logger.setLevel(logging.DEBUG)
+        target = BlockingHandler()
+        handler = AsynLogHandler([target], capacity=2)
+        self.logger.handlers = [handler]
+
+        for i in range(10):
+            record('INFO', 'message {}'.format(i), self.logger)
+        target.event.set()
+        handler.close()
+
+        assert handler.stats['dropped'] > 0
+        assert handler.stats['queued'] + handler.stats['dropped'] == 10
+        assert target.messages[-1] == 'log queue full, dropped {} records'.format(handler.stats['dropped'])
+
+    def test_asyn_block(self):
+        self.logger.setLevel(logging.DEBUG)
+        target = BlockingHandler()
+        handler = AsynLogHandler([target], capacity=2, policy=LOG_BLOCK)
+        self.logger.handlers = [handler]
+        threading.Timer(0.1, target.event.set).start()
+
+        for i in range(10):
+            record('INFO', 'message {}'.format(i), self.logger)
+        handler.close()
+
+        assert handler.stats['dropped'] == 0
+        assert target.messages == ['message {}'.format(i) for i in range(10)]
+
+    def test_json_formatter(self):
+        self.logger.setLevel(logging.DEBUG)
+        record('IMPORTANT', log_fields(lazy('query {sql}', sql='select 1'), 'mysql', 'query', 1.5), self.logger,
+               requestid='abc')
+        record('INFO', 'no fields', self.logger)
+
+        line = JsonFormatter().format(self.handler.records[0])
+        assert line.startswith('{"requestid": "abc"') and '\n' not in line
+        log = json.loads(line)
+        assert (log['level'], log['component'], log['op'], log['latency'], log['msg']) == \
+            ('INFO', 'mysql', 'query', 1.5, 'query select 1')
+
+        log = json.loads(JsonFormatter().format(self.handler.records[1]))
+        assert log['requestid'] is None and log['component'] is None and log['msg'] == 'no fields'
+
+
+class TestLogIndex(object):
+
+    def setup_method(self, method):
+        self.logger = logging.getLogger('fastweb.test.logindex')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def write(self, path, records):
+        handler = logging.FileHandler(path, encoding='utf8')
+        handler.setFormatter(JsonFormatter())
+        self.logger.handlers = [handler]
+        for requestid, msg in records:
+            record('INFO', log_fields(msg, 'web', 'GET', 1), self.logger, requestid=requestid)
+        handler.close()
+
+    def test_trace(self, tmpdir):
+        path = str(tmpdir.join('app.log'))
+        # 轮转后的日志
+        self.write(path + '.1', [('abc', 'web start'), ('abcd', 'other'), ('abc-task-0', u'任务')])
+        self.write(path, [('xyz', 'other'), ('abc-task-1', 'task'), ('abc', 'web end'), (None, 'system')])
+
+        assert [log['msg'] for log in trace(path, 'abc')] == ['web start', u'任务', 'task', 'web end']
+        assert [log['msg'] for log in trace(path, 'abc', exact=True)] == ['web start', 'web end']
+        assert [log['msg'] for log in trace(path, 'abcd')] == ['other']
+        assert trace(path, 'missing') == []
+        assert os.path.exists(index_path(path)) and os.path.exists(index_path(path + '.1'))
+
+    def test_incremental(self, tmpdir):
+        path = str(tmpdir.join('app.log'))
+        self.write(path, [('id{}'.format(i), 'first {}'.format(i)) for i in range(50)])
+        build_index(path)
+
+        self.write(path, [('id7', 'second')])
+        # 还没有写完的行不建立索引
+        with open(path, 'ab') as f:
+            f.write(b'{"requestid": "id7", "ts": ')
+        assert [log['msg'] for log in trace(path, 'id7')] == ['first 7', 'second']
+
+        with open(path, 'ab') as f:
+            f.write('{ts}, "msg": "third"}}\n'.format(ts=time.time()).encode())
+        assert [log['msg'] for log in trace(path, 'id7')] == ['first 7', 'second', 'third']
+
+        # 日志轮转后同名文件重建索引
+        os.rename(path, path + '.1')
+        self.write(path, [('id7', 'new')])
+        assert [log['msg'] for log in trace(path, 'id7')] == ['first 7', 'second', 'third', 'new']
@@ -1,6 +1,13 @@
 # coding:utf8
 
+import os
+
 from fastweb import app
+from fastweb.web import AsynComponents
+from fastweb.pool import AsynConnectionPool
+from fastweb.components import PendingComponent
+from fastweb.test.test_pool import AsynFakeConnection
+from fastweb.accesspoint import ioloop, coroutine, sleep
 from fastweb.manager import Manager, SyncConnManager, AsynConnManager
 
 
@@ -11,6 +18,26 @@ class TestManager(object):
         Manager.setup('web', configer)
 
 
+    def test_reset_components(self):
+        configer = app.load_component('service', backend='ini', path='fastweb/test/config/service.ini')
+        service = Manager._pools['test_service']
+        # 同一进程中不重新创建
+        Manager.reset_components()
+        assert Manager._pools['test_service'] is service
+
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                Manager.reset_components()
+                ok = Manager._pools['test_service'] is not service and \
+                    service not in Manager.get_classified_components('service') and \
+                    (('service', configer) in Manager._setups)
+            finally:
+                os._exit(0 if ok else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+
+
 class TestSyncManager(object):
 
     def test_setup(self):
@@ -25,3 +52,56 @@ class TestAsynManager(object):
         AsynConnManager.setup(configer)
 
 
+
+
+class TestAsynComponents(object):
+
+    def test_pending_component(self):
+        """异步连接池为空时,通过属性调用组件方法的请求排队等待而不是失败"""
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='pending', size=1, maxconnections=1)
+        ioloop.IOLoop.current().run_sync(pool.create)
+        Manager._pools['pending'] = pool
+        first, second = AsynComponents(), AsynComponents()
+        order = []
+
+        @coroutine
+        def _first():
+            assert isinstance(first.pending, PendingComponent)
+            yield first.pending.ping()
+            conn = first.pending
+            assert not isinstance(conn, PendingComponent)
+            order.append('first')
+            yield sleep(0.05)
+            first.release()
+
+        @coroutine
+        def _second():
+            conn = yield second.pending.acquire()
+            assert second.pending is conn
+            order.append('second')
+            second.release()
+
+        try:
+            ioloop.IOLoop.current().run_sync(lambda: [_first(), _second()])
+        finally:
+            del Manager._pools['pending']
+        assert order == ['first', 'second']
+        assert pool.stats()['wait'] == 1 and pool.stats()['timeout'] == 0
+
+    def test_concurrent_first_use(self):
+        """同一宿主并发第一次使用同一组件时只获取一个连接"""
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='concurrent', size=0, maxconnections=2)
+        Manager._pools['concurrent'] = pool
+        owner = AsynComponents()
+
+        @coroutine
+        def run():
+            yield [owner.concurrent.ping(), owner.concurrent.ping()]
+            assert pool.stats()['used'] == 1
+            owner.release()
+
+        try:
+            ioloop.IOLoop.current().run_sync(run)
+        finally:
+            del Manager._pools['concurrent']
+        assert pool.stats()['used'] == 0 and not owner._pending
@@ -0,0 +1,219 @@
+# coding:utf8
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+import pytest
+
+from fastweb.web import MetricsHandler
+from fastweb.component import Component
+from fastweb.util.tool import Retry, RetryPolicy, SpanTree, timing
+from fastweb.util.metrics import (Registry, LatencyHistogram, RETRY, PROMETHEUS_CONTENT_TYPE, _bucket, _bounds,
+                                  registry)
+from fastweb.accesspoint import (web, httpserver, ioloop, coroutine, Return, AsyncHTTPClient,
+                                  bind_sockets)
+
+
+class Flaky(object):
+    name = 'flaky'
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def recorder(self, level, msg):
+        pass
+
+    def call(self, policy):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise policy
+        return self.calls
+
+
+class TestHistogram(object):
+    def test_bucket_bounds(self):
+        previous = 0
+        for value in list(range(1000)) + [2 ** n + d for n in range(10, 40) for d in (-1, 0, 1)]:
+            lower, upper = _bounds(_bucket(value))
+            assert lower <= value < upper
+            assert (upper - lower) <= max(1, value / 64.0)
+        for index in range(_bucket(2 ** 30)):
+            lower, upper = _bounds(index)
+            assert lower == previous
+            previous = upper
+
+    def test_percentile(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.observe(ms / 1000.0)
+
+        assert abs(histogram.percentile(50) - 0.5) <= 0.5 / 64
+        assert abs(histogram.percentile(99) - 0.99) <= 0.99 / 64
+        assert histogram.percentile(100) == 1.0
+
+        snapshot = histogram.snapshot()
+        assert snapshot['count'] == 1000 and snapshot['max'] == 1.0
+        assert abs(snapshot['sum'] - 500.5) < 1e-6
+        assert histogram.buckets((0.01, 0.1, 1)) == [10, 100, 1000, 1000]
+        assert LatencyHistogram().percentile(99) == 0.0
+
+
+class TestTiming(object):
+    def test_timing(self):
+        histogram = LatencyHistogram()
+        results = []
+
+        def run():
+            # 没有IOLoop的线程中也可以计时
+            with timing('ms', 3, sink=histogram) as t:
+                time.sleep(0.01)
+            results.append(t)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        t = results[0]
+        assert 0.01 <= t.seconds < 1 and abs(t.milliseconds - t.seconds * 1000) < 1e-6
+        assert str(t) == '{0}ms'.format(round(t.milliseconds, 3))
+        assert histogram.count == 1 and histogram.total == t.seconds
+
+        with pytest.raises(ValueError):
+            with histogram.time():
+                raise ValueError
+        assert histogram.count == 2
+
+        with pytest.raises(KeyError):
+            timing('min')
+
+    def test_span(self):
+        tree = SpanTree()
+        with tree.span('request'):
+            with tree.span(('mysql', 'query')):
+                time.sleep(0.005)
+            with tree.span('render'):
+                pass
+        with tree.span('after'):
+            pass
+
+        request, after = tree.breakdown()
+        assert [child['name'] for child in request['children']] == ['mysql.query', 'render']
+        assert after['children'] == [] and tree.current is None
+        assert request['ms'] >= request['children'][0]['ms'] >= 5
+        assert abs(request['self_ms'] + sum(child['ms'] for child in request['children']) - request['ms']) < 1e-6
+        assert str(tree).splitlines()[1].startswith('  mysql.query ')
+
+    def test_interleaved_span(self):
+        tree = SpanTree()
+        first, second = tree.span('first'), tree.span('second')
+        first.__enter__()
+        second.__enter__()
+        # 并发的协程先结束外层span
+        first.__exit__(None, None, None)
+        assert tree.current is second
+        second.__exit__(None, None, None)
+        assert tree.current is None
+        assert tree.breakdown()[0]['children'][0]['name'] == 'second'
+
+    def test_component_span(self):
+        component = Component({}).set_name('db')
+        with component.span('query') as t:
+            pass
+        assert not hasattr(t, 'tree')
+
+        component.owner = type('Owner', (object, ), {'spans': SpanTree()})()
+        with component.span('query'):
+            pass
+        assert component.owner.spans.breakdown()[0]['name'] == 'db.query'
+
+
+class TestRegistry(object):
+    def test_exposition(self):
+        metrics = Registry()
+        requests = metrics.counter('test_requests_total', 'Requests', ('path', ))
+        latency = metrics.histogram('test_latency_seconds', 'Latency', ('path', ))
+        metrics.register_collector(lambda: [('test_connections', 'gauge', 'Connections', [({'pool': 'db'}, 3)])])
+
+        requests.labels('/a"b\n').inc(2)
+        with latency.labels('/a').time():
+            pass
+        latency.labels('/a').observe(2)
+
+        lines = metrics.exposition().splitlines()
+        assert '# TYPE test_requests_total counter' in lines
+        assert 'test_requests_total{path="/a\\"b\\n"} 2' in lines
+        assert '# TYPE test_latency_seconds histogram' in lines
+        assert 'test_latency_seconds_bucket{path="/a",le="1.0"} 1' in lines
+        assert 'test_latency_seconds_bucket{path="/a",le="+Inf"} 2' in lines
+        assert 'test_latency_seconds_count{path="/a"} 2' in lines
+        assert 'test_connections{pool="db"} 3' in lines
+
+        snapshot = metrics.snapshot()
+        assert snapshot['test_latency_seconds'][0]['value']['count'] == 2
+        assert snapshot['test_connections'] == [{'labels': {'pool': 'db'}, 'value': 3}]
+
+        metrics.reset()
+        assert 'test_requests_total' not in metrics.exposition()
+
+    def test_conflict(self):
+        metrics = Registry()
+        counter = metrics.counter('test_total', 'Total', ('name', ))
+        assert metrics.counter('test_total', 'Total', ('name', )) is counter
+        with pytest.raises(ValueError):
+            metrics.histogram('test_total', 'Total', ('name', ))
+        with pytest.raises(ValueError):
+            counter.labels('a', 'b')
+
+    def test_dump(self):
+        metrics = Registry()
+        metrics.counter('test_dump_total', 'Dump').labels().inc()
+        path = os.path.join(tempfile.mkdtemp(), 'fastweb.prom')
+        metrics.dump(path)
+        with open(path) as f:
+            assert 'test_dump_total 1' in f.read().splitlines()
+        assert os.listdir(os.path.dirname(path)) == ['fastweb.prom']
+
+    def test_retry(self):
+        retry, exhausted = RETRY.labels('flaky', 'retry'), RETRY.labels('flaky', 'exhausted')
+        before = retry.value, exhausted.value
+
+        flaky = Flaky(1)
+        assert Retry(flaky, 'call', flaky.call, RetryPolicy(2, ValueError())).run_sync() == 2
+        assert (retry.value, exhausted.value) == (before[0] + 1, before[1])
+
+        flaky = Flaky(3)
+        with pytest.raises(ValueError):
+            Retry(flaky, 'call', flaky.call, RetryPolicy(2, ValueError())).run_sync()
+        assert (retry.value, exhausted.value) == (before[0] + 3, before[1] + 1)
+
+
+class TestMetricsHandler(object):
+    def fetch(self, path='/metrics'):
+        sockets = bind_sockets(0, '127.0.0.1')
+        port = sockets[0].getsockname()[1]
+        server = httpserver.HTTPServer(web.Application([(r'/metrics', MetricsHandler)]))
+        server.add_sockets(sockets)
+
+        @coroutine
+        def run():
+            response = yield AsyncHTTPClient().fetch('http://127.0.0.1:{port}{path}'.format(port=port, path=path),
+                                                     raise_error=False)
+            server.stop()
+            raise Return(response)
+
+        return ioloop.IOLoop.current().run_sync(run)
+
+    def test_metrics(self):
+        registry.counter('fastweb_test_handler_total', 'Handler test').labels().inc()
+
+        response = self.fetch()
+        assert response.code == 200
+        assert response.headers['Content-Type'] == PROMETHEUS_CONTENT_TYPE
+        assert 'fastweb_test_handler_total 1' in response.body.decode().splitlines()
+
+        response = self.fetch('/metrics?format=json')
+        assert json.loads(response.body.decode())['fastweb_test_handler_total'][0]['value'] == 1
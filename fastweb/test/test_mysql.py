@@ -1,13 +1,87 @@
 # coding;utf8
 
 
-from fastweb.accesspoint import ioloop, coroutine
-from fastweb.component.db.mysql import SyncMysql, AsynMysql
+import pytest
+from pymysql.converters import escape_item
+
+from fastweb.exception import MysqlError
+from fastweb.util.thread import FThread
+from fastweb.util.metrics import MYSQL_STATEMENT, MYSQL_SLOW
+from fastweb.accesspoint import ioloop, coroutine, Return
+from fastweb.cache import QueryCache
+from fastweb.component.db.rds import SyncRedis
+from fastweb.accesspoint import pymysql
+from fastweb.component.db.mysql import SyncMysql, AsynMysql, fingerprint, PreparedStatement, ReplicaSet
 
 
 setting = {'host': 'localhost', 'port': 3306, 'user': 'root', 'password': ''}
 
 
+class FakeStreamCursor(object):
+    """模拟无缓冲游标"""
+
+    def __init__(self, rows, asyn=False):
+        self._rows = list(rows)
+        self._asyn = asyn
+        self.closed = False
+        self.executed = []
+
+    def _result(self, value):
+        if self._asyn:
+            @coroutine
+            def _future():
+                raise Return(value)
+            return _future()
+        return value
+
+    @property
+    def rowcount(self):
+        return len(self._rows)
+
+    def execute(self, sql, args=None):
+        self.executed.append((sql, args))
+        return self._result(len(self._rows))
+
+    def fetchall(self):
+        return self._result(self._rows)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return self._result(rows)
+
+    def close(self):
+        self.closed = True
+        return self._result(None)
+
+
+class FakeLiteralConnection(object):
+
+    @staticmethod
+    def literal(value):
+        return escape_item(value, 'utf8')
+
+
+class FakeStreamConnection(FakeLiteralConnection):
+
+    server_thread_id = (1, )
+
+    def __init__(self, rows, asyn=False):
+        self.cur = FakeStreamCursor(rows, asyn)
+
+    def cursor(self, cls):
+        return self.cur
+
+    def commit(self):
+        return self.cur._result(None)
+
+    def close(self):
+        pass
+
+
+class Session(object):
+    """组件的宿主"""
+
+
 class TestSyncMysql(object):
     def test_connect(self):
         mysql = SyncMysql(setting).set_name('sync_mysql_test')
@@ -19,6 +93,205 @@ class TestSyncMysql(object):
         assert mysql.query('select * from mysql.user;')
         assert mysql.fetch()
 
+    def test_query_cache(self):
+        mysql = SyncMysql(setting).set_name('sync_mysql_test')
+        mysql.connect()
+        mysql.query_cache = QueryCache(SyncRedis({'host': 'localhost'}).connect(), prefix='test:sql:')
+        mysql.query_cache.invalidate_sync(mysql, {'user'})
+        assert mysql.query('select * from mysql.user', cache=True)
+        rows = mysql.fetchall()
+        assert mysql.query('select * from mysql.user', cache=True) == len(rows)
+        assert mysql.fetchall() == rows
+        assert mysql.query_cache.stats()['hit'] == 1
+
+    def test_stream(self):
+        mysql = SyncMysql(setting).set_name('sync_mysql_test')
+        mysql.connect()
+        count = sum(1 for _ in mysql.stream('select * from mysql.user', batch_size=1))
+        mysql.query('select * from mysql.user')
+        assert count == len(mysql.fetchall())
+
+    def test_fake_stream(self):
+        mysql = SyncMysql(setting).set_name('sync_mysql_test')
+        mysql._conn = FakeStreamConnection([{'id': i} for i in range(5)])
+        returned = []
+
+        stream = mysql.stream('select * from t', batch_size=2)
+        mysql.on_stream_end(lambda: returned.append(True))
+        assert mysql.streaming and not returned
+        with pytest.raises(MysqlError):
+            mysql.query('select 1')
+        assert [row['id'] for row in stream] == [0, 1, 2, 3, 4]
+        assert not mysql.streaming and returned and mysql._conn.cur.closed
+
+        mysql._conn = FakeStreamConnection([{'id': i} for i in range(5)])
+        with mysql.stream('select * from t', batch_size=2, batches=True) as stream:
+            assert next(iter(stream)) == [{'id': 0}, {'id': 1}]
+        assert not mysql.streaming and stream.rownumber == 2
+
+
+    def test_bulk_insert(self):
+        mysql = SyncMysql(setting).set_name('sync_mysql_test')
+        mysql.connect()
+        mysql.query('CREATE DATABASE IF NOT EXISTS fastweb_test')
+        mysql.query('CREATE TABLE IF NOT EXISTS fastweb_test.bulk (id INT PRIMARY KEY, name VARCHAR(32))')
+        mysql.query('DELETE FROM fastweb_test.bulk')
+        rows = [{'id': i, 'name': 'name{}'.format(i)} for i in range(2500)]
+        assert mysql.bulk_insert('fastweb_test.bulk', rows, batch_size=1000) == 2500
+        assert mysql.executemany('UPDATE fastweb_test.bulk SET name = %s WHERE id = %s', [('x', 1), ('y', 2)]) == 2
+        mysql.query('SELECT COUNT(*) AS total FROM fastweb_test.bulk')
+        assert mysql.fetch()['total'] == 2500
+
+    def test_bulk_statements(self):
+        mysql = SyncMysql(setting).set_name('sync_mysql_test')
+        mysql._conn = FakeLiteralConnection()
+        mysql._max_packet = 1000
+        statements = []
+        mysql.query = lambda sql, args=None: statements.append(sql) or sql.count('),(') + 1
+
+        rows = [{'id': i, 'name': "it's"} for i in range(5)]
+        assert mysql.bulk_insert('db.t', rows, batch_size=2) == 5
+        assert statements[0] == "INSERT INTO `db`.`t` (`id`,`name`) VALUES (0,'it\\'s'),(1,'it\\'s')"
+        assert len(statements) == 3
+
+        # 列名中的反引号不能闭合标识符
+        del statements[:]
+        mysql.bulk_insert('t', [{'a` = 1; DROP TABLE t; --': 1}])
+        assert statements == ["INSERT INTO `t` (`a`` = 1; DROP TABLE t; --`) VALUES (1)"]
+
+        del statements[:]
+        mysql._max_packet = 70
+        assert mysql.executemany('INSERT INTO t (a) VALUES (%s) ON DUPLICATE KEY UPDATE a = a', range(10)) == 10
+        assert all(len(statement) <= 70 for statement in statements) and len(statements) == 4
+        assert statements[0] == 'INSERT INTO t (a) VALUES (0),(1),(2) ON DUPLICATE KEY UPDATE a = a'
+
+
+    def test_statement_metrics(self):
+        mysql = SyncMysql(dict(setting, slow_query='0.000000001', slow_sample='1')).set_name('sync_mysql_test')
+        mysql._conn = FakeStreamConnection([{'id': 1}])
+        logs = []
+        mysql.recorder = lambda level, msg: logs.append((level, msg))
+        MYSQL_STATEMENT.reset()
+        MYSQL_SLOW.reset()
+
+        for uid in range(3):
+            mysql.query('select * from users where id = %s', (uid, ))
+        assert MYSQL_STATEMENT.labels('select * from users where id = ?').count == 3
+        assert MYSQL_SLOW.labels('select * from users where id = ?').value == 3
+
+        slow = [msg for level, msg in logs if level == 'WARN']
+        assert len(slow) == 3 and str(slow[-1]).endswith('select * from users where id = 2')
+
+    def test_prepare_cache(self):
+        mysql = SyncMysql(dict(setting, prepare_cache='2')).set_name('sync_mysql_test')
+        mysql._conn = FakeStreamConnection([{'id': 1}])
+
+        for uid in range(3):
+            mysql.query("select * from users where id = %s and name like 'a%%'", (uid, ))
+        mysql.query('select * from users where name = %(name)s', {'name': "o'k"})
+        mysql.query('select 1')
+        assert mysql._conn.cur.executed[2] == ("select * from users where id = 2 and name like 'a%'", None)
+        assert mysql._conn.cur.executed[3] == ("select * from users where name = 'o\\'k'", None)
+        assert mysql.prepared_stats == {'hit': 2, 'miss': 3, 'evict': 1}
+        assert list(mysql._prepared) == ['select * from users where name = %(name)s', 'select 1']
+
+        with pytest.raises(MysqlError):
+            mysql.query('select * from users where id = %s', (1, 2))
+
+        statement = PreparedStatement('select %(a)s, %(b)s, %(a)s')
+        assert statement.keys == ['a', 'b', 'a']
+        assert statement.fingerprint == 'select ?, ?, ?'
+        assert statement.render({'a': None, 'b': 1.5}, FakeLiteralConnection.literal) == 'select NULL, 1.5, NULL'
+
+    def test_prepared_percent(self):
+        mysql = SyncMysql(dict(setting, prepare_cache='2')).set_name('sync_mysql_test')
+        mysql._conn = FakeStreamConnection([{'id': 1}])
+
+        # 与pymysql一样,没有参数时不做%格式化,有参数时不支持的%抛出ValueError
+        sql = "select * from users where name like 'a%' and id = %s"
+        mysql.query(sql)
+        assert mysql._conn.cur.executed[-1] == (sql, None)
+        with pytest.raises(ValueError) as expected:
+            sql % ('1', )
+        with pytest.raises(ValueError) as raised:
+            mysql.query(sql, (1, ))
+        assert str(raised.value) == str(expected.value)
+
+        with pytest.raises(ValueError) as raised:
+            PreparedStatement('select %(a)s, 100%').render({'a': 1}, FakeLiteralConnection.literal)
+        assert str(raised.value) == 'incomplete format'
+        statement = PreparedStatement("select %s, '100%%'")
+        assert statement.render((1, ), FakeLiteralConnection.literal) == "select 1, '100%'"
+
+    def test_replicas(self, monkeypatch):
+        replicas = {}
+
+        def connect(**kwargs):
+            assert kwargs['autocommit'] and kwargs['user'] == 'root'
+            replicas[kwargs['host']] = FakeStreamConnection([{'id': kwargs['port']}])
+            return replicas[kwargs['host']]
+
+        monkeypatch.setattr(pymysql, 'connect', connect)
+        try:
+            mysql = SyncMysql(dict(setting, replicas='r1*2, r2:3307', replica_balance='weighted', replica_failures='1',
+                                   sticky_primary='60')).set_name('sync_mysql_test')
+            mysql._conn = FakeStreamConnection([{'id': 0}])
+
+            ports = []
+            for _ in range(3):
+                mysql.query('select id from users')
+                ports.append(mysql.fetchall()[0]['id'])
+            assert ports == [3306, 3307, 3306]
+            mysql.owner = Session()
+            mysql.query('select last_insert_id()')
+            mysql.query('update users set name = %s', ('a', ))
+            mysql.query('select id from users')
+            assert len(mysql._conn.cur.executed) == 3
+
+            # 粘滞期限属于写入的session,同一session使用其他主库连接时也读主库,新的session读从库
+            other = SyncMysql(dict(setting, replicas='r1*2, r2:3307', replica_balance='weighted', replica_failures='1',
+                                   sticky_primary='60')).set_name('sync_mysql_test')
+            other._conn = FakeStreamConnection([{'id': 0}])
+            other.owner = mysql.owner
+            other.query('select id from users')
+            assert len(other._conn.cur.executed) == 1
+            mysql.owner = Session()
+
+            # 从库出错时改由主库执行并摘除,出错的连接从连接池中移除
+            def gone_away(sql, args=None):
+                raise pymysql.OperationalError(2006, 'gone away')
+
+            monkeypatch.setattr(replicas['r2'].cur, 'execute', gone_away)
+            mysql.query('select id from users')
+            mysql.query('select id from users')
+            assert len(mysql._conn.cur.executed) == 4
+            stats = mysql.replica_set.stats()
+            assert stats['r2:3307']['ejected'] and stats['r2:3307']['errors'] == 1 and stats['r1:3306']['requests'] == 3
+            assert stats['r1:3306']['outstanding'] == stats['r2:3307']['outstanding'] == 0
+
+            # 所有组件共享每个从库的连接池
+            pools = mysql._replica_pools
+            assert other._replica_pools == {} and len(pools) == 2
+            assert other._replica_pool(mysql.replica_set.replicas[0]) is pools['r1:3306']
+            assert pools['r1:3306'].stats()['total'] == 1 and pools['r2:3307'].stats()['total'] == 0
+        finally:
+            # 停止从库连接池的回收线程
+            FThread.stop(0)
+
+    def test_least_outstanding(self):
+        replica_set = ReplicaSet(ReplicaSet.parse('a, b*2, c'))
+        chosen = [replica_set.choose().host for _ in range(4)]
+        assert sorted(chosen) == ['a', 'b', 'b', 'c']
+        replica_set.release(replica_set.replicas[1])
+        replica_set.release(replica_set.replicas[1])
+        assert replica_set.choose().host == 'b'
+
+    def test_fingerprint(self):
+        assert fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'a\\'b' AND x IN (1, 2,3)") == \
+            'SELECT * FROM t WHERE id = ? AND name = ? AND x IN (?+)'
+        assert fingerprint("INSERT INTO `t2` (`a`,`b`) VALUES (0,'x'),(1,NULL);") == 'INSERT INTO `t2` (`a`,`b`) VALUES (?,?)...'
+        assert fingerprint('select a from t where b = %(b)s') == fingerprint('select a  from t where b = 5')
+
 
 class TestAsynMysql(object):
     def test_connect(self):
@@ -35,3 +308,21 @@ class TestAsynMysql(object):
             assert ret
 
         ioloop.IOLoop.instance().run_sync(_query)
+
+    def test_fake_stream(self):
+        mysql = AsynMysql(setting).set_name('asyn_mysql_test')
+        mysql._conn = FakeStreamConnection([{'id': i} for i in range(5)], asyn=True)
+
+        @coroutine
+        def _stream():
+            stream = mysql.stream('select * from t', batch_size=2, batches=True)
+            batches = []
+            while True:
+                rows = yield stream.fetch()
+                if not rows:
+                    break
+                batches.append(len(rows))
+            assert batches == [2, 2, 1]
+            assert not mysql.streaming and mysql._conn.cur.closed
+
+        ioloop.IOLoop.instance().run_sync(_stream)
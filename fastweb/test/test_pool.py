@@ -1,6 +1,12 @@
 # coding:utf8
 
-from fastweb.accesspoint import ioloop
+import time
+import pytest
+from threading import Thread
+
+from fastweb.exception import PoolError
+from fastweb.component import Component
+from fastweb.accesspoint import ioloop, coroutine, Return, sleep
 from fastweb.component.db.mysql import SyncMysql, AsynMysql
 from fastweb.pool import SyncConnectionPool, AsynConnectionPool
 
@@ -8,6 +14,47 @@ from fastweb.pool import SyncConnectionPool, AsynConnectionPool
 setting = {'host': 'localhost', 'port': 3306, 'user': 'root', 'password': ''}
 
 
+class SyncFakeConnection(Component):
+    """不依赖外部服务的同步连接"""
+
+    def __init__(self, setting):
+        super(SyncFakeConnection, self).__init__(setting)
+        self.broken = False
+        self.closed = False
+        self.pings = 0
+
+    def connect(self):
+        return self
+
+    def ping(self):
+        self.pings += 1
+        if self.broken:
+            raise PoolError
+
+    def close(self):
+        self.closed = True
+
+
+class AsynFakeConnection(Component):
+    """不依赖外部服务的异步连接"""
+
+    def __init__(self, setting):
+        super(AsynFakeConnection, self).__init__(setting)
+        self.closed = False
+
+    @coroutine
+    def connect(self):
+        yield sleep(0)
+        raise Return(self)
+
+    @coroutine
+    def ping(self):
+        yield sleep(0)
+
+    def close(self):
+        self.closed = True
+
+
 class TestSyncPool(object):
     def test_create(self):
         pool = SyncConnectionPool(SyncMysql, setting, name='test sync mysql pool', size=5, awake=10)
@@ -29,12 +76,84 @@ class TestSyncPool(object):
         pool.rescue()
 
     def test_concurrency_get_connection(self):
-        """大并发下的获取连接"""
-        pass
+        """大并发下的获取连接,连接数不超过上限,等待者按先来先得的顺序获取归还的连接"""
+        pool = SyncConnectionPool(SyncFakeConnection, {}, name='test sync pool', size=1, maxconnections=2)
+        pool.add_connection()
+        held = [pool.acquire(), pool.acquire()]
+        order = []
+
+        def _borrow(idx):
+            conn = pool.acquire(timeout=5)
+            order.append(idx)
+            pool.release(conn)
+
+        threads = []
+        for idx in range(5):
+            thread = Thread(target=_borrow, args=(idx,))
+            thread.start()
+            threads.append(thread)
+            while pool.stats()['waiters'] <= idx:
+                time.sleep(0.001)
+
+        # 只归还一个连接,连接依次在等待者之间传递
+        pool.release(held[0])
+        for thread in threads:
+            thread.join()
+        pool.release(held[1])
+
+        stats = pool.stats()
+        assert order == list(range(5))
+        assert stats['total'] == 2
+        assert stats['peak'] == 2
+        assert stats['wait'] == 5
+
+    def test_acquire_timeout(self):
+        pool = SyncConnectionPool(SyncFakeConnection, {}, name='test sync pool', size=1, maxconnections=1)
+        pool.add_connection()
+        with pool.connection():
+            with pytest.raises(PoolError):
+                pool.acquire(timeout=0.01)
+        assert pool.stats()['timeout'] == 1
+        assert pool.stats()['idle'] == 1
 
     def test_maxconn_rescue(self):
         """动态扩展到最大连接数"""
-        pass
+        pool = SyncConnectionPool(SyncFakeConnection, {}, name='test sync pool', size=1, maxconnections=3)
+        pool.add_connection()
+        conns = [pool.get_connection() for _ in range(3)]
+        assert len(set(conns)) == 3
+        with pytest.raises(PoolError):
+            pool.add_connection()
+
+    def test_validate_on_borrow(self):
+        """只检查空闲较久的连接,失效连接被丢弃并在后台补充"""
+        pool = SyncConnectionPool(SyncFakeConnection, {}, name='test sync pool', size=1, maxconnections=1,
+                                  validate_idle=0.01)
+        broken = pool.add_connection()
+        with pool.connection() as conn:
+            assert conn is broken
+        assert broken.pings == 0
+
+        time.sleep(0.02)
+        broken.broken = True
+        with pool.connection() as conn:
+            assert conn is not broken
+        assert broken.closed
+        assert pool.stats()['invalid'] == 1
+        assert pool.stats()['total'] == 1
+
+    def test_reap(self):
+        """后台回收超过最长存活时间的连接并补充到最小连接数"""
+        pool = SyncConnectionPool(SyncFakeConnection, {}, name='test sync pool', size=1, maxconnections=2,
+                                  max_lifetime=0.01)
+        old = pool.add_connection()
+        time.sleep(0.02)
+        pool._rescue('test')
+        stats = pool.stats()
+        assert old.closed
+        assert stats['reap'] == 1
+        assert stats['total'] == 1
+        assert pool.acquire() is not old
 
 
 class TestAsynPool(object):
@@ -58,11 +177,107 @@ class TestAsynPool(object):
         ioloop.IOLoop.current().run_sync(pool.rescue)
 
     def test_concurrency_get_connection(self):
-        """大并发下的获取连接"""
-        pass
+        """大并发下的获取连接,等待者按先来先得的顺序获取归还的连接"""
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='test asyn pool', size=1, maxconnections=1)
+        ioloop.IOLoop.current().run_sync(pool.create)
+        order = []
+
+        @coroutine
+        def _borrow(idx):
+            conn = yield pool.acquire(timeout=1)
+            order.append(idx)
+            yield sleep(0.01)
+            pool.release(conn)
+
+        @coroutine
+        def _run():
+            yield [_borrow(idx) for idx in range(5)]
+
+        ioloop.IOLoop.current().run_sync(_run)
+        assert order == list(range(5))
+        assert pool.stats()['acquire'] == 5
+        assert pool.stats()['wait'] == 4
+        assert pool.total == 1
+
+    def test_acquire_timeout(self):
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='test asyn pool', size=1, maxconnections=1)
+        ioloop.IOLoop.current().run_sync(pool.create)
+
+        @coroutine
+        def _run():
+            yield pool.acquire()
+            yield pool.acquire(timeout=0.01)
+
+        with pytest.raises(PoolError):
+            ioloop.IOLoop.current().run_sync(_run)
+        assert pool.stats()['timeout'] == 1
 
     def test_maxconn_rescue(self):
         """动态扩展到最大连接数"""
-        pass
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='test asyn pool', size=1, maxconnections=3)
+        ioloop.IOLoop.current().run_sync(pool.create)
+
+        @coroutine
+        def _run():
+            conns = yield [pool.acquire(timeout=1) for _ in range(3)]
+            raise Return(conns)
+
+        conns = ioloop.IOLoop.current().run_sync(_run)
+        assert len(set(conns)) == 3
+        assert pool.total == 3
+        with pytest.raises(PoolError):
+            pool.get_connection()
+
+    def test_shrink(self):
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='test asyn pool', size=1, maxconnections=3, idle=0.01)
+        ioloop.IOLoop.current().run_sync(pool.create)
+
+        @coroutine
+        def _run():
+            conns = yield [pool.acquire(timeout=1) for _ in range(3)]
+            for conn in conns:
+                pool.release(conn)
+            yield sleep(0.05)
+            raise Return(conns)
+
+        conns = ioloop.IOLoop.current().run_sync(_run)
+        assert pool.total == 1
+        assert len([conn for conn in conns if conn.closed]) == 2
+
+    def test_reap_order(self):
+        """回收最久未使用的连接,保留的连接仍按后进先出借出"""
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='test asyn pool', size=2, maxconnections=3, idle=10)
+        ioloop.IOLoop.current().run_sync(pool.create)
+
+        @coroutine
+        def _run():
+            conns = yield [pool.acquire(timeout=1) for _ in range(3)]
+            for conn in conns:
+                pool.release(conn)
+            raise Return(conns)
+
+        oldest, middle, newest = ioloop.IOLoop.current().run_sync(_run)
+        pool._meta[oldest].used -= 60
+        now = ioloop.IOLoop.current().time()
+        pool._reap(now)
+        assert oldest.closed and pool.total == 2
+        # 多次回收不会反转空闲连接的顺序
+        pool._reap(now)
+        pool._reap(now)
+        assert pool.get_connection() is newest
+        assert pool.get_connection() is middle
+
+    def test_connection_context(self):
+        pool = AsynConnectionPool(AsynFakeConnection, {}, name='test asyn pool', size=1, maxconnections=1)
+        ioloop.IOLoop.current().run_sync(pool.create)
+        context = pool.connection()
 
+        @coroutine
+        def _run():
+            conn = yield context.__aenter__()
+            assert pool.stats()['idle'] == 0
+            yield context.__aexit__(None, None, None)
+            raise Return(conn)
 
+        assert isinstance(ioloop.IOLoop.current().run_sync(_run), AsynFakeConnection)
+        assert pool.stats()['idle'] == 1
@@ -19,6 +19,44 @@ class TestSyncRedis(object):
         redis.connect()
         assert redis.query('set name jackson')
 
+    def test_pipeline(self):
+        redis = SyncRedis(setting)
+        redis.connect()
+        pipeline = redis.pipeline()
+        pipeline.query('set name jackson').query('get name').query('hgetall nothing')
+        assert pipeline.execute() == [True, 'jackson', {}]
+
+    def test_transaction(self):
+        redis = SyncRedis(setting)
+        redis.connect()
+        assert redis.batch(['set counter 0', 'incr counter', 'incr counter'], transaction=True) == [True, 1, 2]
+
+    def test_execute(self):
+        redis = SyncRedis(setting)
+        redis.connect()
+        redis.execute('DEL', 'profile')
+        assert redis.execute('SET', 'name', "jackson 'lee'") is True
+        assert redis.query('GET', 'name') == "jackson 'lee'"
+        assert redis.execute('SET', 'binary', b'\xff\x00') is True
+        assert redis.execute('GET', 'binary') == b'\xff\x00'
+        redis.execute('HMSET', 'profile', 'name', 'jackson', 'age', 18)
+        assert redis.execute('HGETALL', 'profile') == {'name': 'jackson', 'age': 18}
+        assert redis.query('hgetall profile') == {'name': 'jackson', 'age': 18}
+        assert redis.batch([('GET', 'name'), 'get name']) == ["jackson 'lee'", "jackson 'lee'"]
+
+    def test_response_types(self):
+        redis = SyncRedis(setting)
+        redis.connect()
+        redis.execute('DEL', 'members', 'sequence')
+        assert redis.execute('EXISTS', 'name') is True
+        assert redis.execute('EXISTS', 'nothing') is False
+        assert redis.execute('SMEMBERS', 'members') == set()
+        redis.execute('SADD', 'members', 'jackson')
+        assert redis.execute('SMEMBERS', 'members') == {'jackson'}
+        # 无法解码的元素原样返回bytes
+        redis.execute('RPUSH', 'sequence', b'\xff\xfe', "name 'jackson'")
+        assert redis.execute('LRANGE', 'sequence', 0, -1) == [b'\xff\xfe', {'name': 'jackson'}]
+
 
 class TestAsynRedis(object):
 
@@ -35,3 +73,59 @@ class TestAsynRedis(object):
             r = yield redis.query('set name jackson')
             assert r
         ioloop.IOLoop.current().run_sync(_query)
+
+    def test_pipeline(self):
+        redis = AsynRedis(setting)
+        ioloop.IOLoop.current().run_sync(redis.connect)
+
+        @coroutine
+        def _pipeline():
+            pipeline = redis.pipeline()
+            pipeline.query('set name jackson').query('get name').query('hgetall nothing')
+            r = yield pipeline.execute()
+            assert r == [True, 'jackson', {}]
+        ioloop.IOLoop.current().run_sync(_pipeline)
+
+    def test_transaction(self):
+        redis = AsynRedis(setting)
+        ioloop.IOLoop.current().run_sync(redis.connect)
+
+        @coroutine
+        def _transaction():
+            r = yield redis.batch(['set counter 0', 'incr counter', 'incr counter'], transaction=True)
+            assert r == [True, 1, 2]
+        ioloop.IOLoop.current().run_sync(_transaction)
+
+    def test_execute(self):
+        redis = AsynRedis(setting)
+        ioloop.IOLoop.current().run_sync(redis.connect)
+
+        @coroutine
+        def _execute():
+            yield redis.execute('DEL', 'profile')
+            r = yield redis.execute('SET', 'name', "jackson 'lee'")
+            assert r is True
+            r = yield redis.query('GET', 'name')
+            assert r == "jackson 'lee'"
+            yield redis.execute('SET', 'binary', b'\xff\x00')
+            r = yield redis.execute('GET', 'binary')
+            assert r == b'\xff\x00'
+            yield redis.execute('HMSET', 'profile', 'name', 'jackson', 'age', 18)
+            r = yield redis.execute('HGETALL', 'profile')
+            assert r == {'name': 'jackson', 'age': 18}
+        ioloop.IOLoop.current().run_sync(_execute)
+
+    def test_response_types(self):
+        redis = AsynRedis(setting)
+        ioloop.IOLoop.current().run_sync(redis.connect)
+
+        @coroutine
+        def _types():
+            yield redis.execute('DEL', 'members', 'sequence')
+            yield redis.execute('SET', 'name', 'jackson')
+            r = yield redis.batch([('EXISTS', 'name'), ('EXISTS', 'nothing'), ('SMEMBERS', 'members')])
+            assert r == [True, False, set()]
+            yield redis.execute('RPUSH', 'sequence', b'\xff\xfe', "name 'jackson'")
+            r = yield redis.execute('LRANGE', 'sequence', 0, -1)
+            assert r == [b'\xff\xfe', {'name': 'jackson'}]
+        ioloop.IOLoop.current().run_sync(_types)
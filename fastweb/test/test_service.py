@@ -0,0 +1,91 @@
+# coding:utf8
+
+import threading
+
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+from thrift.Thrift import TMessageType
+
+from fastweb.service import Service, AsynABLogic
+from fastweb.accesspoint import ioloop, coroutine, Return, sleep
+from fastweb.component.rpc.tft import SyncTftRpc, AsynTftRpc
+from fastweb.test.fastweb_thrift_sync.HelloService.HelloService import sayHello_args, sayHello_result
+
+
+setting = {'port': 9090, 'thrift_module': 'fastweb.test.fastweb_thrift_sync.HelloService.HelloService',
+           'handlers': 'fastweb.test.service_handlers.hello.HelloServiceHandler'}
+ASYN_MODULE = 'fastweb.test.fastweb_thrift_async.HelloService.HelloService'
+
+
+class AsynHelloHandler(object):
+
+    @coroutine
+    def sayHello(self):
+        yield sleep(0.01)
+        raise Return('hello')
+
+
+def call(processor, seqid):
+    request = TTransport.TMemoryBuffer()
+    oprot = TCompactProtocol.TCompactProtocol(request)
+    oprot.writeMessageBegin('sayHello', TMessageType.CALL, seqid)
+    sayHello_args().write(oprot)
+    oprot.writeMessageEnd()
+
+    response = TTransport.TMemoryBuffer()
+    processor.process(TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(request.getvalue())),
+                      TCompactProtocol.TCompactProtocol(response))
+
+    iprot = TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(response.getvalue()))
+    iprot.readMessageBegin()
+    result = sayHello_result()
+    result.read(iprot)
+    return result.success
+
+
+class TestService(object):
+    def test_processor_reuse(self):
+        service = Service(setting).set_name('test_service')
+        processor = service.build_processor()
+
+        assert call(processor, 1) == 'hello'
+        handler = service._processor()._handler
+        requestid = handler.requestid
+
+        assert call(processor, 123456789012) == 'hello'
+        assert service._processor()._handler is handler
+        assert handler.requestid == 123456789012 and handler.requestid != requestid
+        assert not handler._components
+
+    def test_nonblocking(self):
+        service = Service(dict(setting, server='nonblocking', size=2)).set_name('test_nonblocking_service')
+        sock = service.bind()
+        server = service.build_server(sock)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+
+        rpc = SyncTftRpc({'host': 'localhost', 'port': sock.getsockname()[1],
+                          'thrift_module': setting['thrift_module']}).set_name('test_nonblocking_rpc').connect()
+        assert [rpc.sayHello() for _ in range(3)] == ['hello'] * 3
+        rpc.close()
+        server.stop()
+        thread.join()
+        server.close()
+
+    def test_tornado(self):
+        service = Service(dict(setting, server='tornado', thrift_module=ASYN_MODULE,
+                               handlers='fastweb.test.test_service.AsynHelloHandler')).set_name('test_tornado_service')
+        sock = service.bind()
+        server = service.build_server(sock)
+
+        @coroutine
+        def calls():
+            rpc = yield AsynTftRpc({'host': 'localhost', 'port': sock.getsockname()[1], 'thrift_module': ASYN_MODULE,
+                                    'multiplex': 10}).set_name('test_tornado_rpc').connect()
+            ret = yield [rpc.sayHello() for _ in range(5)]
+            rpc.multiplexer.close()
+            raise Return(ret)
+
+        assert ioloop.IOLoop.current().run_sync(calls) == ['hello'] * 5
+        assert isinstance(service._idle[0]._handler, AsynABLogic)
+        server.stop()
@@ -0,0 +1,133 @@
+# coding:utf8
+
+import time
+import threading
+
+from fastweb.task import Worker
+from fastweb.accesspoint import ioloop, coroutine, states
+from fastweb.component.task import AsynTask, SyncTask
+
+
+setting = {'_name': 'fastweb_test_task',
+           'broker': 'memory://',
+           'backend': 'cache+memory://',
+           'queue': 'fastweb_test_task_queue',
+           'exchange': 'fastweb_test_task_exchange',
+           'routing_key': 'fastweb_test_task_routing_key'}
+
+
+class Owner(object):
+    def __init__(self, requestid):
+        self.requestid = requestid
+
+
+class Echo(object):
+    def run(self, x, y):
+        return self.requestid, self.request.id, x + y
+
+
+class Sleepy(object):
+    def run(self, delay):
+        time.sleep(delay)
+        return self.requestid, self.request.id
+
+
+def build(cls, requestid):
+    task = cls(setting)
+    task.owner = Owner(requestid)
+
+    # 记录发送消息使用的producer
+    producers = []
+    send = task.application.amqp.send_task_message
+
+    def send_task_message(producer, *args, **kwargs):
+        producers.append(producer)
+        return send(producer, *args, **kwargs)
+
+    task.application.amqp.send_task_message = send_task_message
+
+    with task.application.connection_for_write() as conn:
+        conn.default_channel.queue_purge(setting['queue'])
+    return task, producers
+
+
+def queued(task):
+    with task.application.connection_for_read() as conn:
+        return conn.default_channel.queue_declare(setting['queue'], passive=True).message_count
+
+
+class TestSyncTask(object):
+    def test_call_many_gather(self):
+        task, producers = build(SyncTask, 'sync_request')
+
+        task_ids = task.call_many([(1, 2), (3, 4), (5, 6)])
+        prefix = task_ids[0].rsplit('-', 1)[0] + '-'
+        assert prefix.startswith('sync_request-fastweb_test_task-')
+        assert task_ids == [prefix + str(i) for i in range(3)]
+        assert queued(task) == 3
+        assert len(producers) == 3 and len(set(map(id, producers))) == 1
+
+        task.backend.store_result(task_ids[0], 3, states.SUCCESS)
+        task.backend.store_result(task_ids[1], 7, states.SUCCESS)
+        results, pending = task.gather(task_ids, timeout=0.3)
+        assert list(results.items()) == [(task_ids[0], 3), (task_ids[1], 7)]
+        assert pending == [task_ids[2]]
+
+        task.backend.store_result(task_ids[2], 11, states.SUCCESS)
+        results, pending = task.gather(task_ids, timeout=0.3)
+        assert list(results.values()) == [3, 7, 11] and not pending
+
+        # 同一请求再次批量调用不会拿到上一批的结果
+        again = task.call_many([(1, 2)])
+        assert again[0] not in task_ids
+        results, pending = task.gather(again, timeout=0.1)
+        assert not results and pending == again
+
+
+class TestAsynTask(object):
+    def test_call_many_gather(self):
+        task, producers = build(AsynTask, 'asyn_request')
+
+        @coroutine
+        def run():
+            task_ids = yield task.call_many([(1, 2), (3, 4), (5, 6)], [{'n': 1}, {'n': 2}, {'n': 3}])
+            assert queued(task) == 3
+            assert len(set(map(id, producers))) == 1
+
+            task.backend.store_result(task_ids[0], 3, states.SUCCESS)
+            ioloop.IOLoop.current().call_later(0.05, task.backend.store_result, task_ids[2], 11, states.SUCCESS)
+            results, pending = yield task.gather(task_ids, timeout=0.3)
+            assert list(results.items()) == [(task_ids[0], 3), (task_ids[2], 11)]
+            assert pending == [task_ids[1]]
+
+        ioloop.IOLoop.current().run_sync(run)
+
+
+class TestWorker(object):
+    def test_reuse(self):
+        worker = Worker(dict(setting, task_class='fastweb.test.test_task.Echo', _name='fastweb_test_worker'))
+
+        requestid, taskid, ret = worker.apply((1, 2), task_id='first').get()
+        assert (requestid, taskid, ret) == ('first', 'first', 3)
+        obj = worker._worker_obj
+
+        requestid, taskid, ret = worker.apply((3, 4), task_id='second').get()
+        assert (requestid, taskid, ret) == ('second', 'second', 7)
+        assert worker._worker_obj is obj and type(obj) is worker._worker_cls
+
+    def test_threads(self):
+        worker = Worker(dict(setting, task_class='fastweb.test.test_task.Sleepy', _name='fastweb_test_threads'))
+        results = {}
+
+        def run(task_id, delay):
+            results[task_id] = worker.apply((delay, ), task_id=task_id).get(), worker._worker_obj
+
+        slow = threading.Thread(target=run, args=('slow', 0.2))
+        slow.start()
+        time.sleep(0.05)
+        # 另一个线程执行任务时不会改写执行中任务的请求状态
+        run('fast', 0)
+        slow.join()
+
+        assert results['slow'][0] == ('slow', 'slow') and results['fast'][0] == ('fast', 'fast')
+        assert results['slow'][1] is not results['fast'][1]
@@ -1,7 +1,15 @@
 # coding:utf8
 
-from fastweb.accesspoint import ioloop
+import pytest
+from thrift import TTornado
+from thrift.protocol import TCompactProtocol
+from thrift.transport import TTransport
+from tornado.testing import bind_unused_port
+
+from fastweb.exception import RpcError
+from fastweb.accesspoint import ioloop, coroutine, Return, sleep
 from fastweb.component.rpc.tft import AsynTftRpc, SyncTftRpc
+from fastweb.test.fastweb_thrift_async.HelloService.HelloService import Processor
 
 sync_setting = {'host': 'localhost', 'port': 7777, 'thrift_module': 'fastweb.test.fastweb_thrift_sync.HelloService.HelloService'}
 asyn_setting = {'host': 'localhost', 'port': 7777, 'thrift_module': 'fastweb.test.fastweb_thrift_async.HelloService.HelloService'}
@@ -32,3 +40,109 @@ class TestAsynThrift(object):
         assert ioloop.IOLoop.current().run_sync(rpc.sayHello) == 'hello'
         rpc.close()
 
+
+
+class DelayHandler(object):
+    """第n个调用延迟delays[n]秒返回,记录调用完成的顺序
+
+    TTornadoServer按顺序处理同一连接上的请求,响应总是按请求的顺序到达
+    使用ConcurrentServer时先完成的调用先响应,响应乱序到达
+    """
+
+    def __init__(self, delays, numbered=False):
+        self.delays = list(delays)
+        self.numbered = numbered
+        self.calls = 0
+        self.finished = []
+
+    @coroutine
+    def sayHello(self):
+        number = self.calls
+        self.calls += 1
+        yield sleep(self.delays[number] if number < len(self.delays) else 0)
+        self.finished.append(number)
+        raise Return('hello {number}'.format(number=number) if self.numbered else 'hello')
+
+
+class ConcurrentServer(TTornado.TTornadoServer):
+    """同时处理同一连接上的所有请求,先处理完的请求先响应"""
+
+    @coroutine
+    def handle_stream(self, stream, address):
+        trans = TTornado.TTornadoStreamTransport(address[0], address[1], stream=stream)
+        oprot = self._oprot_factory.getProtocol(trans)
+
+        try:
+            while not trans.stream.closed():
+                frame = yield trans.readFrame()
+                iprot = self._iprot_factory.getProtocol(TTransport.TMemoryBuffer(frame))
+                # 不等待处理完成就读取下一个请求,响应在处理完成时写入
+                ioloop.IOLoop.current().spawn_callback(self._processor.process, iprot, oprot)
+        except TTransport.TTransportException:
+            trans.close()
+
+
+def start_server(handler, server_cls=TTornado.TTornadoServer):
+    sock, port = bind_unused_port()
+    server = server_cls(Processor(handler), TCompactProtocol.TCompactProtocolFactory())
+    # thrift的TTornadoServer依赖tornado5中已经移除的io_loop属性
+    server.io_loop = ioloop.IOLoop.current()
+    server.add_sockets([sock])
+    return server, port
+
+
+class TestMultiplexThrift(object):
+    def test_reconnect(self):
+        server, port = start_server(DelayHandler([]))
+        rpc = AsynTftRpc(dict(asyn_setting, port=port)).set_name('test reconnect thrift')
+        ioloop.IOLoop.current().run_sync(rpc.connect)
+        transport = rpc._transport
+        transport.stream.close()
+
+        assert ioloop.IOLoop.current().run_sync(rpc.sayHello) == 'hello'
+        assert rpc._transport is not transport
+        rpc.close()
+        server.stop()
+
+    def test_multiplex(self):
+        handler = DelayHandler([0.05, 0.01, 0.03, 0.02, 0], numbered=True)
+        server, port = start_server(handler, ConcurrentServer)
+        setting = dict(asyn_setting, port=port, multiplex=3, deadline=1)
+
+        @coroutine
+        def calls():
+            rpc = yield AsynTftRpc(setting).set_name('test multiplex thrift').connect()
+            other = yield AsynTftRpc(setting).set_name('test multiplex thrift').connect()
+            ret = yield [rpc.sayHello() for _ in range(5)]
+            raise Return((rpc.multiplexer, other.multiplexer, ret))
+
+        multiplexer, other, ret = ioloop.IOLoop.current().run_sync(calls)
+        # 每个组件使用自己的连接
+        assert multiplexer is not other and other.stats()['calls'] == 0
+        # 响应乱序到达,按seqid交给对应的调用
+        assert sorted(handler.finished) == list(range(5)) and handler.finished[-1] == 0
+        assert ret == ['hello {0}'.format(number) for number in range(5)]
+        stats = multiplexer.stats()
+        assert stats['calls'] == 5 and stats['peak'] == 3 and stats['inflight'] == 0 and stats['connects'] == 1
+
+        # 断开后自动重连
+        multiplexer._transport.stream.close()
+        assert ioloop.IOLoop.current().run_sync(lambda: multiplexer.sayHello()) == 'hello 5'
+        assert multiplexer.stats()['connects'] == 2
+        multiplexer.close()
+        other.close()
+        server.stop()
+
+    def test_deadline(self):
+        server, port = start_server(DelayHandler([0.5, 0]))
+        rpc = AsynTftRpc(dict(asyn_setting, port=port, multiplex=10, deadline=0.1)).set_name('test deadline thrift')
+        ioloop.IOLoop.current().run_sync(rpc.connect)
+
+        with pytest.raises(RpcError):
+            ioloop.IOLoop.current().run_sync(rpc.sayHello)
+        # 服务端按顺序处理同一连接上的请求,等待迟到的响应被丢弃
+        ioloop.IOLoop.current().run_sync(lambda: sleep(0.5))
+        assert ioloop.IOLoop.current().run_sync(rpc.sayHello) == 'hello'
+        assert rpc.multiplexer.stats()['timeouts'] == 1
+        rpc.multiplexer.close()
+        server.stop()
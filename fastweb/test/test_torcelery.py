@@ -0,0 +1,151 @@
+# coding:utf8
+
+import queue
+
+from fastweb.spec import torcelery
+from fastweb.spec.torcelery import ResultWaiter, POLL_MIN, POLL_MAX, STARTED_STATES
+from fastweb.accesspoint import ioloop, coroutine, states, sleep, Celery
+
+
+application = Celery('fastweb_test_torcelery', broker='memory://', backend='cache+memory://')
+
+
+@application.task
+def add(x, y):
+    return x + y
+
+
+class FakePubSub(object):
+    """redis pubsub,消息由测试放入"""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.pattern = None
+        self.closed = False
+
+    def psubscribe(self, pattern):
+        self.pattern = pattern
+
+    def get_message(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+
+
+def meta(task_id, status, result=None):
+    return {'task_id': task_id, 'status': status, 'result': result, 'traceback': None, 'children': []}
+
+
+class TestResultWaiter(object):
+    def test_backoff(self):
+        backend = application.backend
+        waiter = ResultWaiter(backend)
+
+        @coroutine
+        def run():
+            future = waiter.wait('backoff-a')
+            intervals = []
+            for _ in range(9):
+                waiter._poll()
+                intervals.append(waiter._interval)
+            assert intervals[:3] == [POLL_MIN * 2, POLL_MIN * 4, POLL_MIN * 8] and intervals[-1] == POLL_MAX
+            assert waiter.stats['polls'] == 9
+
+            # 新任务加入时重置查询间隔
+            waiter.wait('backoff-b')
+            assert waiter._interval == POLL_MIN
+            waiter._poll()
+            assert waiter._interval == POLL_MIN * 2
+
+            # 有任务完成时重置查询间隔
+            backend.store_result('backoff-a', 3, states.SUCCESS)
+            waiter._poll()
+            assert waiter._interval == POLL_MIN
+            assert future.done() and future.result()['result'] == 3
+            assert list(waiter._waiting) == ['backoff-b']
+            waiter.close()
+
+        ioloop.IOLoop.current().run_sync(run)
+
+    def test_expire(self):
+        waiter = ResultWaiter(application.backend)
+
+        @coroutine
+        def run():
+            expired = waiter.wait('expire', timeout=0.05)
+            waiting = waiter.wait('expire')
+            ret = yield expired
+            assert ret is None and not waiting.done()
+            # 只移除超时的等待者
+            assert len(waiter._waiting['expire']) == 1 and waiter.stats['timeouts'] == 1
+
+            waiter._expire('expire', waiting)
+            assert waiting.result() is None and len(waiter) == 0 and waiter.stats['timeouts'] == 2
+            waiter.close()
+
+        ioloop.IOLoop.current().run_sync(run)
+
+    def test_complete(self):
+        waiter = ResultWaiter(application.backend)
+
+        @coroutine
+        def run():
+            started = waiter.wait('complete', STARTED_STATES, timeout=0.05)
+            ready = waiter.wait('complete', states.READY_STATES, timeout=0.05)
+
+            assert not waiter._complete('complete', meta('complete', states.PENDING))
+            assert waiter._complete('complete', meta('complete', states.STARTED))
+            assert started.result()['status'] == states.STARTED and not ready.done()
+            assert len(waiter._waiting['complete']) == 1
+
+            assert waiter._complete('complete', meta('complete', states.SUCCESS, 7))
+            assert ready.result()['result'] == 7 and len(waiter) == 0
+            assert not waiter._complete('complete', meta('complete', states.SUCCESS, 7))
+
+            # 完成后取消超时
+            yield sleep(0.1)
+            assert waiter.stats['completed'] == 2 and waiter.stats['timeouts'] == 0
+            waiter.close()
+
+        ioloop.IOLoop.current().run_sync(run)
+
+    def test_published(self):
+        backend = Celery('fastweb_test_torcelery_published', backend='cache+memory://').backend
+        pubsub = FakePubSub()
+        backend.client.pubsub = lambda **kwargs: pubsub
+        waiter = ResultWaiter(backend)
+        assert pubsub.pattern == backend.get_key_for_task('*')
+
+        @coroutine
+        def run():
+            future = waiter.wait('published')
+            # 结果只通过发布到达,后端中没有结果,poller无法完成等待
+            pubsub.messages.put({'type': 'pmessage', 'channel': backend.get_key_for_task('published'),
+                                 'data': backend.encode(meta('published', states.SUCCESS, 5))})
+            ret = yield future
+            assert ret['result'] == 5
+            assert waiter.stats['published'] == 1 and waiter.stats['completed'] == 1
+
+        try:
+            ioloop.IOLoop.current().run_sync(run, timeout=5)
+        finally:
+            waiter.close()
+        assert pubsub.closed
+
+
+class TestAsyn(object):
+    def test_timeout(self):
+        results = []
+
+        @coroutine
+        def run():
+            # 没有worker执行任务,超时后返回None
+            task_id = yield torcelery.asyn(add, 0.05, (1, 2), callback=results.append)
+            assert task_id is None
+
+        ioloop.IOLoop.current().run_sync(run, timeout=5)
+        assert results == [None]
@@ -0,0 +1,91 @@
+# coding:utf8
+
+import os
+import time
+import signal
+import socket
+import tempfile
+import threading
+from multiprocessing import Process
+
+import requests
+
+from fastweb.loader import app
+from fastweb.web import Api, InFlight, start_web_server
+from fastweb.accesspoint import ioloop, coroutine, sleep
+
+
+class SlowApi(Api):
+
+    @coroutine
+    def get(self):
+        yield sleep(1)
+        self.end('SUC', pid=os.getpid())
+
+
+def serve(port):
+    # 测试进程不能和服务器在同一个进程组中,否则会收到转发的SIGTERM
+    os.setpgrp()
+    log = os.path.join(tempfile.gettempdir(), 'fastweb_test_web.log')
+    app.load_recorder(log, log, application_level='ERROR', system_level='ERROR')
+    app.load_errcode()
+    start_web_server(port, [(r'/slow', SlowApi)], processes=2, drain_timeout=5)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('server not ready on {}'.format(port))
+
+
+class TestWeb(object):
+    def test_drain(self):
+        @coroutine
+        def run():
+            inflight = InFlight()
+            first, second = object(), object()
+            inflight.enter(first)
+            inflight.enter(second)
+            ioloop.IOLoop.current().call_later(0.05, inflight.leave, first)
+            ioloop.IOLoop.current().call_later(0.1, inflight.leave, second)
+            remain = yield inflight.drain(1)
+            assert remain == 0 and not len(inflight)
+
+            inflight.enter(first)
+            inflight.leave(second)
+            remain = yield inflight.drain(0.1)
+            assert remain == 1
+
+        ioloop.IOLoop.current().run_sync(run)
+
+    def test_graceful_shutdown(self):
+        port = free_port()
+        server = Process(target=serve, args=(port, ))
+        server.start()
+        wait_port(port)
+
+        responses = []
+        client = threading.Thread(target=lambda: responses.append(
+            requests.get('http://localhost:{}/slow'.format(port), timeout=10)))
+        client.start()
+        time.sleep(0.3)
+        os.kill(server.pid, signal.SIGTERM)
+
+        client.join()
+        server.join(10)
+        assert responses[0].status_code == 200
+        assert responses[0].json()['pid'] != server.pid
+        assert server.exitcode == 0
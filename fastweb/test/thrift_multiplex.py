@@ -0,0 +1,86 @@
+# coding:utf8
+
+"""Thrift多路复用性能对比: 单连接逐个调用 vs 单连接多路复用
+
+python thrift_multiplex.py [host port]
+不指定服务地址时在当前进程中启动HelloService服务
+"""
+
+import sys
+import time
+
+from thrift import TTornado
+from thrift.protocol import TCompactProtocol
+from tornado.testing import bind_unused_port
+
+from fastweb.accesspoint import ioloop, coroutine
+from fastweb.component.rpc.tft import AsynTftRpc
+from fastweb.test.fastweb_thrift_async.HelloService.HelloService import Processor
+
+
+MODULE = 'fastweb.test.fastweb_thrift_async.HelloService.HelloService'
+CALLS = 5000
+CONCURRENCY = (1, 8, 64, 256)
+
+
+class HelloHandler(object):
+    def sayHello(self):
+        return 'hello'
+
+
+def start_server():
+    sock, port = bind_unused_port()
+    server = TTornado.TTornadoServer(Processor(HelloHandler()), TCompactProtocol.TCompactProtocolFactory())
+    server.io_loop = ioloop.IOLoop.current()
+    server.add_sockets([sock])
+    return port
+
+
+def report(name, calls, total):
+    print('{name:<24}{calls} calls\t{total:.3f}s\t{speed:.0f} calls/s'.format(name=name, calls=calls, total=total,
+                                                                             speed=calls / total))
+
+
+@coroutine
+def sequential(host, port):
+    rpc = yield AsynTftRpc({'host': host, 'port': port, 'thrift_module': MODULE}).set_name('bench').connect()
+    rpc.recorder = lambda level, msg: None
+
+    start = time.time()
+    for _ in range(CALLS):
+        yield rpc.sayHello()
+    report('sequential', CALLS, time.time() - start)
+    rpc.close()
+
+
+@coroutine
+def multiplexed(host, port, concurrency):
+    setting = {'host': host, 'port': port, 'thrift_module': MODULE, 'multiplex': concurrency}
+    rpc = yield AsynTftRpc(setting).set_name('bench').connect()
+    rpc.recorder = lambda level, msg: None
+
+    @coroutine
+    def worker(calls):
+        for _ in range(calls):
+            yield rpc.sayHello()
+
+    start = time.time()
+    yield [worker(CALLS // concurrency) for _ in range(concurrency)]
+    report('multiplex {}'.format(concurrency), CALLS // concurrency * concurrency, time.time() - start)
+    rpc.multiplexer.close()
+
+
+@coroutine
+def main():
+    if len(sys.argv) == 3:
+        host, port = sys.argv[1], int(sys.argv[2])
+    else:
+        host, port = 'localhost', start_server()
+
+    yield sequential(host, port)
+    for concurrency in CONCURRENCY:
+        yield multiplexed(host, port, concurrency)
+
+
+if __name__ == '__main__':
+    ioloop.IOLoop.current().run_sync(main)
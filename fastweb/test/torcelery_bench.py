@@ -0,0 +1,104 @@
+# coding:utf8
+
+"""celery结果等待的CPU占用对比: 逐个add_callback自旋 vs 批量轮询 vs redis发布订阅
+
+PENDING个任务结果等待HOLD秒,统计这段时间内的CPU时间,之后写入所有结果,统计全部完成的耗时
+需要本地redis作为结果后端,不需要broker和worker
+
+python torcelery_bench.py [redis://localhost:6379/15]
+"""
+
+import sys
+import time
+import uuid
+import resource
+
+from celery import Celery, states
+from celery.result import AsyncResult
+
+from fastweb.accesspoint import ioloop, coroutine, Future, sleep
+from fastweb.spec.torcelery import ResultWaiter
+
+
+PENDING = 1000
+HOLD = 3
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def spin(backend, task_id, timeout):
+    """原来的实现: 每个任务不断add_callback检查状态"""
+
+    future = Future()
+    io_loop = ioloop.IOLoop.current()
+    result = AsyncResult(task_id, backend=backend)
+    start = io_loop.time()
+
+    def check():
+        if io_loop.time() - start < timeout:
+            if result.ready():
+                future.set_result(result.result)
+            else:
+                io_loop.add_callback(check)
+        else:
+            future.set_result(None)
+
+    io_loop.add_callback(check)
+    return future
+
+
+@coroutine
+def bench(name, backend, wait):
+    task_ids = [str(uuid.uuid4()) for _ in range(PENDING)]
+    futures = [wait(task_id) for task_id in task_ids]
+
+    begin = cpu()
+    yield sleep(HOLD)
+    held = cpu() - begin
+
+    start = time.time()
+    for task_id in task_ids:
+        backend.store_result(task_id, 'done', states.SUCCESS)
+    results = yield futures
+    finished = time.time() - start
+
+    for task_id in task_ids:
+        backend.forget(task_id)
+
+    print('{name:<12}{pending} pending\tcpu {cpu:.2f}s in {hold}s ({percent:.0f}%)\t'
+          'all done in {done:.3f}s ({ok} ok)'.format(name=name, pending=PENDING, cpu=held, hold=HOLD,
+                                                     percent=held / HOLD * 100, done=finished,
+                                                     ok=results.count('done')))
+
+
+@coroutine
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else 'redis://localhost:6379/15'
+    backend = Celery('torcelery_bench', backend=url).backend
+    timeout = HOLD * 10
+
+    def waited(waiter):
+        def wait(task_id):
+            future = Future()
+            ioloop.IOLoop.current().add_future(waiter.wait(task_id, states.READY_STATES, timeout),
+                                               lambda f: future.set_result(f.result()['result']))
+            return future
+        return wait
+
+    yield bench('spin', backend, lambda task_id: spin(backend, task_id, timeout))
+
+    poller = ResultWaiter(backend, subscribe=False)
+    yield bench('poll', backend, waited(poller))
+    poller.close()
+
+    subscriber = ResultWaiter(backend, subscribe=True)
+    yield bench('subscribe', backend, waited(subscriber))
+    print('subscribe stats {stats}'.format(stats=subscriber.stats))
+    subscriber.close()
+
+
+if __name__ == '__main__':
+    ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,86 @@
+# coding:utf8
+
+"""Worker执行开销对比: 每次执行组合新的类 vs 复用执行对象
+
+使用Task.apply在当前进程中执行空任务,不需要broker和worker
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+
+from fastweb.loader import app
+from fastweb.task import Worker, IFaceWorker
+from fastweb.util.tool import timing
+from fastweb.components import SyncComponents
+
+
+CALLS = 5000
+setting = {'_name': 'worker_bench',
+           'broker': 'memory://',
+           'backend': 'cache+memory://',
+           'queue': 'worker_bench_queue',
+           'exchange': 'worker_bench_exchange',
+           'routing_key': 'worker_bench_routing_key',
+           'task_class': 'fastweb.test.worker_bench.Noop'}
+
+
+class Noop(object):
+    def run(self, x):
+        return x
+
+
+class PerCallWorker(Worker):
+    """原来的实现: 每次执行组合一个新的类"""
+
+    def run(self, *args, **kwargs):
+        self._worker_obj = type('Worker', (self._task_cls, SyncComponents, IFaceWorker), {'request': self.request})()
+        self._worker_obj.setting = self._setting
+        self._worker_obj.requestid = self.request.id
+
+        self._worker_obj.recorder('IMPORTANT', '{obj} start\nRequest:\n{request}\nArgument: {args}\t{kwargs}'.format(
+            obj=self, request=json.dumps(self.request.as_execution_options(), indent=4), args=args, kwargs=kwargs))
+        with timing('ms', 10) as t:
+            ret = self._worker_obj.run(*args, **kwargs)
+        self._worker_obj.recorder('IMPORTANT', '{obj} end\nReturn: {r} -- {t}'.format(obj=self, r=ret, t=t))
+        return ret
+
+    def on_success(self, retval, task_id, args, kwargs):
+        self._worker_obj.recorder('INFO', '{obj} success callback start'.format(obj=self))
+        with timing('ms', 10) as t:
+            r = self._worker_obj.on_success(retval, task_id, args, kwargs)
+        self._worker_obj.recorder('INFO', '{obj} success callback end -- {t}'.format(obj=self, t=t))
+        return r
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        self._worker_obj.recorder('DEBUG', '{obj} after return callback start'.format(obj=self))
+        with timing('ms', 10) as t:
+            self._worker_obj.after_return(status, retval, task_id, args, kwargs, einfo)
+        self._worker_obj.recorder('DEBUG', '{obj} after return callback end -- {t}'.format(obj=self, t=t))
+        self._worker_obj.release()
+
+
+def run(name, worker):
+    start = time.time()
+    for i in range(CALLS):
+        worker.apply((i, ))
+    total = time.time() - start
+    print('{name:<16}{calls} tasks\t{total:.3f}s\t{speed:.0f} tasks/s'.format(name=name, calls=CALLS, total=total,
+                                                                            speed=CALLS / total))
+
+
+def main():
+    log = os.path.join(tempfile.gettempdir(), 'fastweb_worker_bench.log')
+    for level in ('ERROR', 'DEBUG'):
+        print('application log level {level}'.format(level=level))
+        app.load_recorder(log, log, application_level=level, system_level='ERROR')
+        # 只比较fastweb的开销,关闭celery自身的执行日志
+        logging.getLogger('celery').setLevel(logging.WARNING)
+        run('per call class', PerCallWorker(dict(setting, _name='per_call')))
+        run('reuse', Worker(dict(setting, _name='reuse')))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,23 @@
 # coding:utf8
 
+import os
+import sys
+import copy
+import json
+import atexit
 import logging
+import threading
 import traceback
 import logging.config
+import logging.handlers
 from logging import getLogger
+from collections import OrderedDict
 
 from termcolor import colored
 
 import fastweb
 from fastweb.exception import ParameterError
+from fastweb.accesspoint import Queue, Empty, Full
 from fastweb.setting.default_logging import DEFAULT_LOGGING_SETTING
 
 
@@ -27,6 +36,281 @@ COLORMAP = {
     'CRITICAL': 'magenta',
     'IMPORTANT': 'cyan'
 }
+LEVEL_NUMBERS = {
+    'INFO': logging.INFO,
+    'DEBUG': logging.DEBUG,
+    'WARN': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+    'IMPORTANT': logging.INFO
+}
+# 日志级别名 -> (级别数值, 附加到LogRecord上的颜色),大小写都可以直接查表,set_record_color后重新生成
+LEVEL_TABLE = {}
+# 其他库的日志按级别数值着色
+LEVEL_COLORS = {}
+
+
+def _build_level_table():
+    LEVEL_TABLE.clear()
+    for name, number in LEVEL_NUMBERS.items():
+        entry = (number, {'color': COLORMAP.get(name, 'white')})
+        LEVEL_TABLE[name] = LEVEL_TABLE[name.lower()] = entry
+
+    LEVEL_COLORS.clear()
+    for name in LOGGING_LEVEL:
+        LEVEL_COLORS.setdefault(LEVEL_NUMBERS[name], COLORMAP.get(name, 'white'))
+
+
+_build_level_table()
+
+# 异步日志队列满时的处理方式: 丢弃新日志 / 阻塞等待
+LOG_DROP = 'drop'
+LOG_BLOCK = 'block'
+DEFAULT_LOG_CAPACITY = 10000
+# 后台线程每批最多写入的日志条数,一批只flush一次
+DEFAULT_LOG_BATCH = 256
+
+
+class lazy(object):
+    """延迟格式化的日志信息
+
+    只有handler真正输出时才会调用str.format,日志级别未开启时没有格式化开销
+    lazy('{obj} query start\n{sql}', obj=self, sql=sql)
+    extra为log_fields附加的结构化字段
+    """
+
+    __slots__ = ('fmt', 'args', 'kwargs', 'extra')
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+        self.extra = None
+
+    def __str__(self):
+        return self.fmt.format(*self.args, **self.kwargs)
+
+
+class ColoredFormatter(logging.Formatter):
+    """终端输出使用的着色formatter
+
+    只有终端handler着色,文件handler输出原始信息
+    fastweb记录的日志使用record.color,其他库的日志按日志级别着色
+    """
+
+    def format(self, record):
+        color = getattr(record, 'color', None) or LEVEL_COLORS.get(record.levelno, 'white')
+        return colored(super(ColoredFormatter, self).format(record), color, attrs=['bold'])
+
+
+class JsonFormatter(logging.Formatter):
+    """结构化日志formatter,每条日志输出为一行json
+
+    固定字段requestid/ts/level/component/op/latency/pid/msg,没有的字段为null
+    component/op/latency通过log_fields附加到record上,latency单位为毫秒
+    requestid固定在行首,建立索引时不需要解析整行
+    """
+
+    def format(self, record):
+        msg = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            msg = '{msg}\n{exc}'.format(msg=msg, exc=record.exc_text)
+
+        return json.dumps(OrderedDict([('requestid', getattr(record, 'requestid', None)),
+                                       ('ts', round(record.created, 6)),
+                                       ('level', record.levelname),
+                                       ('component', getattr(record, 'component', None)),
+                                       ('op', getattr(record, 'op', None)),
+                                       ('latency', getattr(record, 'latency', None)),
+                                       ('pid', record.process),
+                                       ('msg', msg)]), ensure_ascii=False, default=str)
+
+
+def log_fields(msg, component, op, latency=None):
+    """给日志信息附加结构化日志的固定字段
+
+    字段随日志信息传递,recorder(level, msg)的接口不变
+    self.recorder('INFO', log_fields(lazy('{obj} query successful', obj=self), self.name, 'query', t))
+
+    :parameter:
+      - `msg`:日志信息,不是lazy对象时转为lazy对象
+      - `component`:组件名称
+      - `op`:操作
+      - `latency`:耗时,timing对象或毫秒数
+
+    :return: lazy对象
+    """
+
+    if not isinstance(msg, lazy):
+        msg = lazy('{0}', msg)
+    latency = getattr(latency, 'milliseconds', latency)
+    msg.extra = {'component': component, 'op': op, 'latency': round(latency, 3) if latency is not None else None}
+    return msg
+
+
+class BatchFlushMixin(object):
+    """一批日志只flush一次的handler
+
+    batch为True时handle中emit触发的flush被跳过,由AsynLogHandler写完一批后调用flush
+    batch为False(同步写入)时和原handler一样每条日志flush
+    """
+
+    batch = False
+    _handling = False
+
+    def handle(self, record):
+        self._handling = self.batch
+        try:
+            return super(BatchFlushMixin, self).handle(record)
+        finally:
+            self._handling = False
+
+    def flush(self):
+        if not self._handling:
+            super(BatchFlushMixin, self).flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    """终端handler"""
+
+
+class BatchRotatingFileHandler(BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    """按大小切分的文件handler"""
+
+
+class BatchTimedRotatingFileHandler(BatchFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    """按时间切分的文件handler"""
+
+
+class AsynLogHandler(logging.Handler):
+    """异步日志handler
+
+    在调用线程中格式化日志信息后放入有界队列,后台线程批量写入目标handler,文件和终端IO不会阻塞IOLoop
+    队列满时按policy丢弃(drop)或阻塞(block),丢弃的条数记录在stats中,并在之后写入一条WARNING
+    fork之后子进程第一次记录日志时重新创建队列和后台线程
+
+    :parameter:
+      - `handlers`:目标handler列表,BatchFlushMixin的handler每批只flush一次
+      - `capacity`:队列容量
+      - `policy`:队列满时的处理方式,LOG_DROP或LOG_BLOCK
+      - `batch`:每批最多写入的日志条数
+    """
+
+    _STOP = object()
+
+    def __init__(self, handlers, capacity=DEFAULT_LOG_CAPACITY, policy=LOG_DROP, batch=DEFAULT_LOG_BATCH):
+        super(AsynLogHandler, self).__init__()
+        self.handlers = list(handlers)
+        for handler in self.handlers:
+            if isinstance(handler, BatchFlushMixin):
+                handler.batch = True
+        self.capacity = capacity
+        self.policy = policy
+        self.batch = batch
+        self.stats = {'queued': 0, 'written': 0, 'dropped': 0, 'batches': 0}
+        self._reported = 0
+        self._pid = None
+        self._thread = None
+        self.queue = None
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self.queue = Queue(self.capacity)
+        self._thread = threading.Thread(target=self._run, name='fastweb-log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        """在调用线程中完成格式化,lazy信息和异常信息不会跨线程使用"""
+
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # fork之前其他线程可能持有目标handler的锁
+            for handler in self.handlers:
+                handler.createLock()
+            self._start()
+
+        try:
+            record = self.prepare(record)
+            if self.policy == LOG_BLOCK:
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+            self.stats['queued'] += 1
+        except Full:
+            self.stats['dropped'] += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            if self._STOP in records:
+                stopped = True
+                records = [record for record in records if record is not self._STOP]
+
+            dropped = self.stats['dropped']
+            if dropped > self._reported:
+                records.append(logging.makeLogRecord({
+                    'name': 'fastweb.log', 'levelno': logging.WARNING, 'levelname': 'WARNING', 'requestid': '-',
+                    'msg': 'log queue full, dropped {count} records'.format(count=dropped - self._reported)}))
+                self._reported = dropped
+
+            self._write(records)
+
+    def _write(self, records):
+        if not records:
+            return
+
+        for handler in self.handlers:
+            for record in records:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            try:
+                handler.flush()
+            except Exception:
+                pass
+
+        self.stats['written'] += len(records)
+        self.stats['batches'] += 1
+
+    def flush(self):
+        """等待队列中已有的日志写入"""
+
+        if self._thread is not None and self._pid == os.getpid():
+            while self.queue.qsize() and self._thread.is_alive():
+                self._thread.join(0.01)
+
+    def close(self):
+        """写完队列中的日志后停止后台线程,关闭目标handler"""
+
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+            for handler in self.handlers:
+                handler.close()
+        super(AsynLogHandler, self).close()
 
 
 def setup_logging(setting):
@@ -67,27 +351,54 @@ def console_recorder(level, msg):
 def set_record_color(colormap):
     """设置日志颜色"""
     global COLORMAP
-    if list(colormap.keys()) in LOGGING_LEVEL:
-        COLORMAP = colormap
+    if set(colormap) <= set(LOGGING_LEVEL):
+        COLORMAP = dict(COLORMAP, **colormap)
+        _build_level_table()
     else:
         recorder('CRITICAL', 'colormap invalid, please fill it like {colormap}'.format(colormap=str(COLORMAP)))
 
 
-def record(level, msg, r=None, extra=None):
-    global COLORMAP
-    level = level.upper()
-    check_logging_level(level)
+def record(level, msg, r=None, extra=None, requestid=None):
+    """记录日志
 
-    if level == 'ERROR':
-        msg = '{msg}\n\n{exeinfo}'.format(msg=msg, exeinfo=traceback.format_exc(), whole=4)
+    查表得到日志级别,级别未开启时直接返回,不做任何格式化和分配
+    msg可以是lazy对象,在handler输出时才格式化;颜色由终端handler的ColoredFormatter添加
+    log_fields附加在msg上的结构化字段会合并到extra中
 
-    logger_color = COLORMAP.get(level, 'white')
+    :parameter:
+      - `level`:日志级别
+      - `msg`:日志信息
+      - `r`:logger,为None时打印到终端
+      - `extra`:附加到LogRecord上的属性
+      - `requestid`:请求id,会附加到extra中
+    """
 
-    if r:
-        logger_func = getattr(r,  'info' if level.lower() == 'important' else level.lower())
-        logger_func(colored(msg, logger_color, attrs=['bold']), extra=extra)
-    else:
-        print((colored(msg, logger_color, attrs=['bold'])))
+    entry = LEVEL_TABLE.get(level)
+    if entry is None:
+        level = level.upper()
+        check_logging_level(level)
+        entry = LEVEL_TABLE[level]
+    number, level_extra = entry
+
+    if r is not None and not r.isEnabledFor(number):
+        return
+
+    if isinstance(msg, lazy) and msg.extra is not None:
+        extra = dict(msg.extra, **extra) if extra else msg.extra
+
+    if number == logging.ERROR and sys.exc_info()[0] is not None:
+        # 异常信息只能在当前上下文中获取
+        msg = lazy('{msg}\n\n{exeinfo}', msg=msg, exeinfo=traceback.format_exc())
+
+    if r is None:
+        print((colored(str(msg), level_extra['color'], attrs=['bold'])))
+        return
+
+    if extra is not None or requestid is not None:
+        level_extra = dict(level_extra, **(extra or {}))
+        if requestid is not None:
+            level_extra['requestid'] = requestid
+    r.log(number, msg, extra=level_extra)
 
 
 def check_logging_level(level):
@@ -0,0 +1,194 @@
+# coding:utf8
+
+"""结构化日志的requestid索引
+
+每个日志文件对应一个隐藏的索引文件(.<文件名>.idx),不会被日志轮转当作备份删除
+索引第一行记录已索引的日志大小和文件头的校验值,之后每行为按requestid排序的 `requestid\\t偏移`
+查询时在索引文件上二分查找,不需要读入整个索引,requestid-开头的记录(task/service透传的id)一起返回
+"""
+
+import os
+import re
+import json
+import zlib
+from glob import glob
+
+
+INDEX_VERSION = 1
+INDEX_HEADER = b'#fastweb-log-index'
+# 计算文件头校验值的字节数,日志轮转后同名文件的内容不同,需要重建索引
+HEAD_SIZE = 4096
+# JsonFormatter输出的requestid固定在行首
+REQUESTID_PATTERN = re.compile(br'^\{"requestid": "((?:[^"\\]|\\.)*)"')
+
+
+def index_path(path):
+    """日志文件对应的索引文件路径"""
+
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.{name}.idx'.format(name=basename))
+
+
+def log_files(path):
+    """日志文件及其轮转后的文件,按修改时间排序"""
+
+    files = [f for f in glob(path) + glob(path + '.*') if os.path.isfile(f)]
+    return sorted(set(files), key=os.path.getmtime)
+
+
+def _head(path, size):
+    """文件头的校验值,只计算已索引的部分"""
+
+    with open(path, 'rb') as f:
+        return zlib.crc32(f.read(min(size, HEAD_SIZE))) & 0xffffffff
+
+
+def _read_header(idx):
+    """读取索引头,返回(已索引大小, 文件头校验值),索引不存在或无效时返回None"""
+
+    try:
+        with open(idx, 'rb') as f:
+            fields = f.readline().split()
+    except IOError:
+        return None
+
+    if len(fields) != 4 or fields[0] != INDEX_HEADER or int(fields[1]) != INDEX_VERSION:
+        return None
+    return int(fields[2]), int(fields[3])
+
+
+def _scan(path, start, end):
+    """扫描日志中[start, end)范围内的记录,返回[(requestid, 偏移)]"""
+
+    entries = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            # 最后一行可能还没有写完,下次更新索引时再扫描
+            if not line.endswith(b'\n'):
+                break
+            match = REQUESTID_PATTERN.match(line)
+            if match:
+                entries.append((match.group(1), offset))
+            offset += len(line)
+    return entries, offset
+
+
+def build_index(path):
+    """建立或更新日志文件的索引
+
+    日志只追加时只扫描新增的部分,日志被轮转(大小变小或文件头变化)时重建
+
+    :return: 索引文件路径
+    """
+
+    idx = index_path(path)
+    size = os.path.getsize(path)
+    header = _read_header(idx)
+    valid = header is not None and header[0] <= size and _head(path, header[0]) == header[1]
+
+    if valid and header[0] == size:
+        return idx
+
+    entries = []
+    start = 0
+    if valid:
+        start = header[0]
+        with open(idx, 'rb') as f:
+            f.readline()
+            for line in f:
+                requestid, offset = line.rstrip(b'\n').split(b'\t')
+                entries.append((requestid, int(offset)))
+
+    new, end = _scan(path, start, size)
+    entries.extend(new)
+    head = _head(path, end)
+    # 按requestid排序,同一个requestid按写入顺序
+    entries.sort()
+
+    tmp = idx + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b' '.join([INDEX_HEADER, str(INDEX_VERSION).encode(), str(end).encode(), str(head).encode()]))
+        f.write(b'\n')
+        f.writelines(b''.join([requestid, b'\t', str(offset).encode(), b'\n']) for requestid, offset in entries)
+    os.rename(tmp, idx)
+    return idx
+
+
+def _key(requestid):
+    """与日志中相同的json转义形式"""
+
+    if not isinstance(requestid, bytes):
+        requestid = json.dumps(requestid, ensure_ascii=False)[1:-1].encode('utf8')
+    return requestid
+
+
+def lookup(idx, requestid, exact=False):
+    """在索引文件中二分查找requestid,返回记录偏移
+
+    :parameter:
+      - `idx`:索引文件路径
+      - `requestid`:请求id
+      - `exact`:为False时包括requestid-开头的记录(调用task/service时透传的id)
+    """
+
+    key = _key(requestid)
+    derived = key + b'-'
+    offsets = []
+
+    with open(idx, 'rb') as f:
+        f.readline()
+        start = lo = f.tell()
+        hi = os.fstat(f.fileno()).st_size
+
+        # 查找第一个不小于key的行: lo之后第一个完整行之前的行都小于key
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()
+            line = f.readline()
+            if not line or line.split(b'\t', 1)[0] >= key:
+                hi = mid
+            else:
+                lo = mid
+
+        f.seek(lo)
+        if lo > start:
+            f.readline()
+        for line in f:
+            requestid, offset = line.rstrip(b'\n').split(b'\t')
+            if requestid < key:
+                continue
+            if not requestid.startswith(key):
+                break
+            if requestid == key or (not exact and requestid.startswith(derived)):
+                offsets.append(int(offset))
+    return offsets
+
+
+def trace(path, requestid, exact=False):
+    """从日志文件及其轮转文件中取出requestid的所有记录,按时间排序
+
+    :parameter:
+      - `path`:日志文件路径
+      - `requestid`:请求id
+      - `exact`:为False时包括requestid-开头的记录(调用task/service时透传的id)
+
+    :return: 解析后的记录列表
+    """
+
+    records = []
+    for log in log_files(path):
+        idx = build_index(log)
+        offsets = lookup(idx, requestid, exact)
+        if not offsets:
+            continue
+        with open(log, 'rb') as f:
+            for offset in sorted(offsets):
+                f.seek(offset)
+                records.append(json.loads(f.readline().decode('utf8')))
+
+    records.sort(key=lambda record: record['ts'])
+    return records
@@ -0,0 +1,354 @@
+# coding:utf8
+
+"""进程内指标
+
+计数器和HDR风格的耗时直方图,按标签区分,可以导出为prometheus文本格式
+框架在请求结束,组件调用,重试,连接池获取连接和thrift调用时自动记录
+
+QUERY = registry.histogram('myapp_query_seconds', 'Query latency', ('table', ))
+with QUERY.labels('users').time():
+    ...
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from fastweb.util.tool import timing
+
+
+# HDR直方图每个2倍区间分成的子区间数为2**SUB_BUCKET_BITS,相对误差不超过1/2**SUB_BUCKET_BITS
+SUB_BUCKET_BITS = 6
+# 小于LINEAR_LIMIT的值每个值一个区间
+LINEAR_LIMIT = 2 << SUB_BUCKET_BITS
+MANTISSA_BITS = SUB_BUCKET_BITS + 1
+# 直方图记录的最小单位: 微秒
+RESOLUTION = 1000000
+# prometheus导出时使用的分桶上界(秒)
+EXPORT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+def _bucket(value):
+    """值所在区间的序号"""
+
+    if value < LINEAR_LIMIT:
+        return value
+    shift = value.bit_length() - MANTISSA_BITS
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _bounds(index):
+    """区间序号对应的[下界, 上界)"""
+
+    if index < LINEAR_LIMIT:
+        return index, index + 1
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = index - (shift << SUB_BUCKET_BITS)
+    return mantissa << shift, (mantissa + 1) << shift
+
+
+class Counter(object):
+    """计数器,线程安全"""
+
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class LatencyHistogram(object):
+    """HDR风格的耗时直方图,线程安全
+
+    按2倍区间对数分段,段内线性分成2**SUB_BUCKET_BITS个子区间,精度为微秒
+    只保存有值的区间,任意范围的耗时都不需要预先设置分桶,百分位数的相对误差不超过1/64
+    """
+
+    __slots__ = ('_lock', '_counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """记录一次耗时(秒)"""
+
+        # 与_bucket相同,热点路径上展开
+        value = int(seconds * RESOLUTION)
+        if value < LINEAR_LIMIT:
+            index = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - MANTISSA_BITS
+            index = (shift << SUB_BUCKET_BITS) + (value >> shift)
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self):
+        """with histogram.time(): 记录代码块的耗时"""
+
+        return timing(sink=self)
+
+    def _sorted(self):
+        with self._lock:
+            return sorted(self._counts.items()), self.count, self.total, self.max
+
+    def percentile(self, percent):
+        """百分位数(秒),返回所在区间的上界"""
+
+        return self._percentiles((percent, ))[0]
+
+    def _percentiles(self, percents, data=None):
+        counts, count, _, maximum = data or self._sorted()
+        if not count:
+            return [0.0] * len(percents)
+
+        values = []
+        for percent in percents:
+            rank = percent / 100.0 * count
+            seen = 0
+            value = maximum
+            for index, n in counts:
+                seen += n
+                if seen >= rank:
+                    value = min(float(_bounds(index)[1]) / RESOLUTION, maximum)
+                    break
+            values.append(value)
+        return values
+
+    def buckets(self, bounds=EXPORT_BUCKETS, data=None):
+        """按bounds累计的次数,prometheus的le分桶,最后一个为+Inf"""
+
+        counts, count, _, _ = data or self._sorted()
+        cumulative = [0] * len(bounds)
+        position = 0
+        seen = 0
+        for index, n in counts:
+            lower = float(_bounds(index)[0]) / RESOLUTION
+            while position < len(bounds) and lower > bounds[position]:
+                cumulative[position] = seen
+                position += 1
+            seen += n
+        for i in range(position, len(bounds)):
+            cumulative[i] = seen
+        return cumulative + [count]
+
+    def snapshot(self):
+        data = self._sorted()
+        p50, p90, p99, p999 = self._percentiles((50, 90, 99, 99.9), data)
+        return {'count': data[1], 'sum': data[2], 'max': data[3], 'p50': p50, 'p90': p90, 'p99': p99,
+                'p999': p999}
+
+
+class MetricFamily(object):
+    """同名指标,按标签值区分
+
+    :parameter:
+      - `name`:指标名称
+      - `documentation`:说明
+      - `kind`:类型,counter或histogram
+      - `labelnames`:标签名称
+    """
+
+    _factories = {COUNTER: Counter, HISTOGRAM: LatencyHistogram}
+
+    def __init__(self, name, documentation, kind, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = self._factories[kind]
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """获取标签值对应的指标,第一次使用时创建"""
+
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{name} expects labels {labels}'.format(name=self.name, labels=self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def children(self):
+        with self._lock:
+            return sorted(self._children.items(), key=lambda item: [str(value) for value in item[0]])
+
+    def reset(self):
+        with self._lock:
+            self._children.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{name}="{value}"'.format(name=name, value=_escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append('{name}="{value}"'.format(name=extra[0], value=extra[1]))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """指标注册表
+
+    collector为无参数的函数,导出时调用,返回[(名称, 类型, 说明, [({标签: 值}, 数值)])],
+    用于导出连接池大小等导出时才读取的状态
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = OrderedDict()
+        self._collectors = []
+
+    def _family(self, name, documentation, kind, labelnames):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = MetricFamily(name, documentation, kind, labelnames)
+            elif family.kind != kind or family.labelnames != tuple(labelnames):
+                raise ValueError('metric {name} already registered as {kind}{labels}'.format(
+                    name=name, kind=family.kind, labels=family.labelnames))
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        """注册计数器,同名的计数器已经存在时直接返回"""
+
+        return self._family(name, documentation, COUNTER, labelnames)
+
+    def histogram(self, name, documentation, labelnames=()):
+        """注册耗时直方图,同名的直方图已经存在时直接返回"""
+
+        return self._family(name, documentation, HISTOGRAM, labelnames)
+
+    def register_collector(self, collector):
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def _collect(self):
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            for metric in collector():
+                yield metric
+
+    def snapshot(self):
+        """{名称: [{'labels': {标签: 值}, 'value': 数值或直方图统计}]}"""
+
+        with self._lock:
+            families = list(self._families.values())
+
+        snapshot = OrderedDict()
+        for family in families:
+            snapshot[family.name] = [{'labels': dict(zip(family.labelnames, values)), 'value': child.snapshot()}
+                                     for values, child in family.children()]
+        for name, _, _, samples in self._collect():
+            snapshot[name] = [{'labels': labels, 'value': value} for labels, value in samples]
+        return snapshot
+
+    def exposition(self):
+        """prometheus文本格式"""
+
+        with self._lock:
+            families = list(self._families.values())
+
+        lines = []
+        for family in families:
+            children = family.children()
+            if not children:
+                continue
+            lines.append('# HELP {name} {doc}'.format(name=family.name, doc=family.documentation))
+            lines.append('# TYPE {name} {kind}'.format(name=family.name, kind=family.kind))
+
+            for values, child in children:
+                if family.kind == COUNTER:
+                    lines.append('{name}{labels} {value}'.format(name=family.name, value=child.value,
+                                                                labels=_format_labels(family.labelnames, values)))
+                    continue
+
+                data = child._sorted()
+                bounds = [_format_value(float(bound)) for bound in EXPORT_BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, child.buckets(EXPORT_BUCKETS, data)):
+                    lines.append('{name}_bucket{labels} {count}'.format(
+                        name=family.name, count=count, labels=_format_labels(family.labelnames, values, ('le', bound))))
+                labels = _format_labels(family.labelnames, values)
+                lines.append('{name}_sum{labels} {value}'.format(name=family.name, labels=labels,
+                                                                 value=_format_value(data[2])))
+                lines.append('{name}_count{labels} {value}'.format(name=family.name, labels=labels, value=data[1]))
+
+        for name, kind, documentation, samples in self._collect():
+            if not samples:
+                continue
+            lines.append('# HELP {name} {doc}'.format(name=name, doc=documentation))
+            lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+            for labels, value in samples:
+                names = sorted(labels)
+                lines.append('{name}{labels} {value}'.format(name=name, value=_format_value(value),
+                                                            labels=_format_labels(names, [labels[n] for n in names])))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """把prometheus文本格式写入文件,可以作为node_exporter textfile collector的输入
+
+        先写临时文件再改名,读取方不会读到写了一半的文件
+        """
+
+        tmp = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.exposition())
+        os.rename(tmp, path)
+
+    def reset(self):
+        """清空所有指标的数据"""
+
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            family.reset()
+
+
+registry = Registry()
+
+# 框架自动记录的指标
+WEB_REQUEST = registry.histogram('fastweb_web_request_seconds', 'Web request latency',
+                                 ('handler', 'method', 'code'))
+COMPONENT_CALL = registry.histogram('fastweb_component_seconds', 'Component call latency', ('component', 'op'))
+RETRY = registry.counter('fastweb_retry_total', 'Retry attempts', ('name', 'result'))
+POOL_ACQUIRE = registry.histogram('fastweb_pool_acquire_seconds', 'Time waited to acquire a pooled connection',
+                                  ('pool', ))
+POOL_TIMEOUT = registry.counter('fastweb_pool_acquire_timeout_total', 'Pooled connection acquire timeouts',
+                                ('pool', ))
+RPC_CALL = registry.histogram('fastweb_rpc_seconds', 'Thrift call latency', ('side', 'service', 'method'))
+RPC_ERROR = registry.counter('fastweb_rpc_errors_total', 'Thrift call errors', ('side', 'service', 'method'))
+MYSQL_STATEMENT = registry.histogram('fastweb_mysql_statement_seconds', 'Mysql statement latency by fingerprint',
+                                     ('fingerprint', ))
+MYSQL_SLOW = registry.counter('fastweb_mysql_slow_total', 'Mysql slow statements by fingerprint', ('fingerprint', ))
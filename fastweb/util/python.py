@@ -8,8 +8,8 @@ import hashlib
 from importlib import import_module
 from thrift.TTornado import TTransportException
 
-import fastweb
 from fastweb.accesspoint import coroutine, Return
+from fastweb.util.metrics import RPC_CALL, RPC_ERROR
 
 
 def head(o, h):
@@ -93,7 +93,11 @@ class ExceptionProcessor(object):
 
 
 class AsynProxyCall(object):
-    """异步调用代理,用来解决__getattr__无法传递多个参数的问题"""
+    """异步调用代理,用来解决__getattr__无法传递多个参数的问题
+
+    传输层异常时调用exception_processor重新连接,并重试一次
+    每次调用的耗时和传输层异常计入fastweb_rpc_seconds和fastweb_rpc_errors_total指标
+    """
 
     def __init__(self, proxy, method, throw_exception=None, exception_processor=None):
         self.proxy = proxy
@@ -107,24 +111,34 @@ class AsynProxyCall(object):
     def __call__(self, *arg, **kwargs):
         self._arg = arg
         self._kwargs = kwargs
+        ret = yield self._call(True)
+        raise Return(ret)
+
+    @coroutine
+    def _call(self, retry):
         self.proxy.recorder('INFO', 'call {proxy} <{method}> start'.format(proxy=self.proxy, method=self._method))
+        labels = ('client', getattr(self.proxy, 'name', None) or self.proxy.__class__.__name__, self._method)
         try:
-            with fastweb.util.tool.timing('ms', 8) as t:
-                ret = yield getattr(self.proxy.other, self._method)(*arg, **kwargs)
-            self.proxy.recorder('INFO', 'call {proxy} <{method}> successful\n{ret} <{time}>'.format(proxy=self.proxy,
-                                                                                                    method=self._method,
-                                                                                                    ret=ret,
-                                                                                                    time=t))
-            raise Return(ret)
+            with self.proxy.span(self._method, RPC_CALL.labels(*labels), 'ms', 8) as t:
+                ret = yield getattr(self.proxy.other, self._method)(*self._arg, **self._kwargs)
         except TTransportException as e:
+            RPC_ERROR.labels(*labels).inc()
             self.proxy.recorder('ERROR',
                                 'call {proxy} <{method}> error {e} ({msg})\nreconnect'.format(proxy=self.proxy,
                                                                                               method=self._method,
                                                                                               e=type(e), msg=e))
+            if not retry or not self._exception_processor:
+                raise self._throw_exception
+
             yield self._exception_processor.processor()
-            self(*self._arg, **self._kwargs)
-        else:
-            raise self._throw_exception
+            ret = yield self._call(False)
+            raise Return(ret)
+
+        self.proxy.recorder('INFO', 'call {proxy} <{method}> successful\n{ret} <{time}>'.format(proxy=self.proxy,
+                                                                                                method=self._method,
+                                                                                                ret=ret,
+                                                                                                time=t))
+        raise Return(ret)
 
 
 def load_module(path):
@@ -2,16 +2,30 @@
 
 
 import os
+import time
 import uuid
 import code
 import atexit
 import readline
 from threading import Timer
 
-from fastweb.accesspoint import ioloop, coroutine, Return
+from fastweb.accesspoint import coroutine, Return
 
 from celery import (Celery, platforms)
 
+try:
+    from time import perf_counter_ns as clock_ns
+except ImportError:
+    try:
+        from time import perf_counter as _clock
+    except ImportError:
+        _clock = time.time
+
+    def clock_ns():
+        """单调时钟(纳秒),python3.7以下的近似实现"""
+
+        return int(_clock() * 1000000000)
+
 
 def get_celery_from_object(name, obj=None):
     """获取celery对象"""
@@ -36,35 +50,157 @@ def uniqueid(bit=64):
 
 
 class timing(object):
-    """计时器"""
+    """计时器
+
+    使用单调时钟,不依赖IOLoop,可以在服务端工作线程和celery worker中使用
+    start/end为纳秒时钟值,seconds/milliseconds为耗时,total为按unit换算并保留precision位小数的耗时
+    sink为有observe(seconds)方法的对象(如指标直方图),退出时记录耗时,异常退出时也会记录
+
+    :parameter:
+      - `unit`:输出单位,s/ms/us
+      - `precision`:输出保留的小数位数
+      - `sink`:接收耗时(秒)的对象
+    """
+
+    __slots__ = ('start', 'end', 'unit', 'precision', 'sink', '_factor')
 
     __unitfactor = {'s': 1,
                     'ms': 1000,
                     'us': 1000000}
 
-    def __init__(self, unit='s', precision=4):
+    def __init__(self, unit='s', precision=4, sink=None):
+        if unit not in timing.__unitfactor:
+            raise KeyError('Unsupported time unit.')
         self.start = None
         self.end = None
-        self.total = 0
         self.unit = unit
         self.precision = precision
+        self.sink = sink
+        self._factor = timing.__unitfactor[unit]
 
     def __enter__(self):
-        if self.unit not in timing.__unitfactor:
-            raise KeyError('Unsupported time unit.')
-        self.start = ioloop.IOLoop.current().time()
+        self.start = clock_ns()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.end = ioloop.IOLoop.current().time()
-        self.total = (self.end - self.start) * timing.__unitfactor[self.unit]
-        self.total = round(self.total, self.precision)
+        self.end = clock_ns()
+        if self.sink is not None:
+            self.sink.observe((self.end - self.start) / 1e9)
         return False
 
+    @property
+    def seconds(self):
+        """耗时(秒),不受unit和precision影响"""
+
+        return (self.end - self.start) / 1e9
+
+    @property
+    def milliseconds(self):
+        """耗时(毫秒),不受unit和precision影响"""
+
+        return (self.end - self.start) / 1e6
+
+    @property
+    def total(self):
+        """按unit换算并保留precision位小数的耗时,只在输出时计算"""
+
+        if self.end is None:
+            return 0
+        return round((self.end - self.start) * self._factor / 1e9, self.precision)
+
     def __str__(self):
         return '{total}{unit}'.format(total=self.total, unit=self.unit)
 
 
+class span(timing):
+    """调用树中的一段计时
+
+    进入时挂在所属调用树当前的span下并成为当前span,退出时当前span恢复为最近一个未结束的父span
+    同一请求中并发执行的协程共用一个调用树,并发的span可能挂在另一个协程的span下
+
+    :parameter:
+      - `tree`:所属的SpanTree
+      - `name`:名称,元组输出时用.连接
+    """
+
+    __slots__ = ('tree', 'name', 'parent', 'children')
+
+    def __init__(self, tree, name, unit='ms', precision=3, sink=None):
+        super(span, self).__init__(unit, precision, sink)
+        self.tree = tree
+        self.name = name
+        self.parent = None
+        self.children = []
+
+    def __enter__(self):
+        tree = self.tree
+        self.parent = tree.current
+        (self.parent.children if self.parent is not None else tree.roots).append(self)
+        tree.current = self
+        return super(span, self).__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super(span, self).__exit__(exc_type, exc_val, exc_tb)
+        if self.tree.current is self:
+            parent = self.parent
+            while parent is not None and parent.end is not None:
+                parent = parent.parent
+            self.tree.current = parent
+        return False
+
+    @property
+    def label(self):
+        return '.'.join(str(part) for part in self.name) if isinstance(self.name, tuple) else str(self.name)
+
+    def breakdown(self):
+        """{'name', 'ms', 'self_ms', 'children'},self_ms为不在子span中的耗时"""
+
+        children = [child.breakdown() for child in self.children if child.end is not None]
+        ms = self.milliseconds
+        return {'name': self.label,
+                'ms': ms,
+                'self_ms': max(ms - sum(child['ms'] for child in children), 0),
+                'children': children}
+
+
+class SpanTree(object):
+    """一个请求的调用树,记录嵌套计时的父子关系,用于分析请求的耗时分布
+
+    with self.span('load user'):
+        user = self.mysql.query(sql)
+    """
+
+    __slots__ = ('roots', 'current')
+
+    def __init__(self):
+        self.roots = []
+        self.current = None
+
+    def span(self, name, unit='ms', precision=3, sink=None):
+        """创建span,with语句进入时开始计时"""
+
+        return span(self, name, unit, precision, sink)
+
+    def breakdown(self):
+        """已结束的span的耗时分布"""
+
+        return [root.breakdown() for root in self.roots if root.end is not None]
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __str__(self):
+        lines = []
+
+        def walk(nodes, depth):
+            for node in nodes:
+                lines.append('{indent}{name} {ms:.3f}ms (self {self_ms:.3f}ms)'.format(indent='  ' * depth, **node))
+                walk(node['children'], depth + 1)
+
+        walk(self.breakdown(), 0)
+        return '\n'.join(lines)
+
+
 class RetryPolicy(Exception):
     """重试策略"""
 
@@ -77,7 +213,10 @@ class RetryPolicy(Exception):
 
 
 class Retry(object):
-    """重试机制"""
+    """重试机制
+
+    每次重试和重试次数用尽都会计入fastweb_retry_total指标
+    """
 
     def __init__(self, obj, name, func, *args, **kwargs):
         self._obj = obj
@@ -86,6 +225,13 @@ class Retry(object):
         self._args = args
         self._kwargs = kwargs
 
+    def _count(self, result):
+        """记录重试指标,标签为组件名称或类名,result为retry或exhausted"""
+
+        # metrics依赖本模块,只在重试时导入
+        from fastweb.util.metrics import RETRY
+        RETRY.labels(getattr(self._obj, 'name', None) or self._obj.__class__.__name__, result).inc()
+
     def run_sync(self):
         """运行重试机制"""
 
@@ -95,12 +241,14 @@ class Retry(object):
             if e.retry < e.times:
                 delay = e.interval * e.retry + e.delay
                 e.retry += 1
+                self._count('retry')
                 self._obj.recorder('WARN', '{name} <{retry}> retry in {delay} second...'.format(name=self._name, retry=e.retry, delay=delay))
                 if delay:
                     Timer(delay, self.run).start()
                 else:
                     return self.run_sync()
             else:
+                self._count('exhausted')
                 self._obj.recorder('ERROR', '{name} retry error raise {exc}'.format(name=self._name, exc=e.error))
                 raise e.error
 
@@ -113,6 +261,7 @@ class Retry(object):
             if e.retry < e.times:
                 delay = e.interval * e.retry + e.delay
                 e.retry += 1
+                self._count('retry')
                 self._obj.recorder('WARN', '{name} <{retry}> retry in {delay} second...'.format(name=self._name, retry=e.retry, delay=delay))
                 if delay:
                     Timer(delay, self.run).start()
@@ -120,6 +269,7 @@ class Retry(object):
                     ret = yield self.run_asyn()
                     raise Return(ret)
             else:
+                self._count('exhausted')
                 self._obj.recorder('ERROR', '{name} retry error raise {exc}'.format(name=self._name, exc=e.error))
                 raise e.error
 
@@ -2,32 +2,157 @@
 
 """网络层模块"""
 
+import os
 import json
 import shlex
+import signal
 import traceback
 import subprocess
 
 
 from fastweb.accesspoint import (web, coroutine, Task, Return, options,
                                  AsyncHTTPClient, HTTPError, Subprocess,
-                                 httpserver, ioloop, run_on_executor, StaticFileHandler)
+                                 httpserver, ioloop, run_on_executor, StaticFileHandler,
+                                 Condition, fork_processes, bind_sockets)
 
 from fastweb import app
+import fastweb.manager
 import fastweb.components
 from fastweb.util.tool import timing
 from fastweb.util.thread import FThread
 from fastweb.util.python import to_plain
 from fastweb.util.tool import RetryPolicy, Retry
-from fastweb.util.log import recorder, console_recorder
+from fastweb.util.log import recorder, console_recorder, lazy, log_fields
+from fastweb.util.metrics import registry, WEB_REQUEST, COMPONENT_CALL, PROMETHEUS_CONTENT_TYPE
 from fastweb.exception import HttpError, SubProcessError
 
 
 __all__ = ['Api', 'Page', 'arguments', 'options', 'start_web_server', 'run_on_executor', 'StaticFileHandler',
-           'coroutine', 'AsynComponents']
+           'coroutine', 'AsynComponents', 'inflight', 'MetricsHandler']
+
+# 优雅退出时等待正在处理的请求完成的最长时间(秒)
+DEFAULT_DRAIN_TIMEOUT = 10
+# 指标导出的路径和默认监听地址,指标在单独的端口上导出,不挂载到业务路由中
+DEFAULT_METRICS_PATH = '/metrics'
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'
+
+
+class InFlight(object):
+    """当前进程正在处理的请求,优雅退出时等待这些请求处理完成"""
+
+    def __init__(self):
+        self._handlers = set()
+        self._drained = Condition()
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def enter(self, handler):
+        """请求开始"""
+
+        self._handlers.add(handler)
+
+    def leave(self, handler):
+        """请求结束,同一个请求多次调用只计算一次"""
+
+        self._handlers.discard(handler)
+        if not self._handlers:
+            self._drained.notify_all()
+
+    @coroutine
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """等待所有请求处理完成
+
+        :parameter:
+          - `timeout`:最长等待时间(秒)
+
+        :return: 超时后仍未完成的请求数
+        """
+
+        deadline = ioloop.IOLoop.current().time() + timeout
+        while self._handlers:
+            drained = yield self._drained.wait(deadline)
+            if not drained:
+                break
+        raise Return(len(self._handlers))
+
+
+inflight = InFlight()
+
+
+class MetricsHandler(web.RequestHandler):
+    """导出进程内指标,默认为prometheus文本格式,format=json时返回统计快照
+
+    多进程模式下每个进程只导出自己的指标
+    不做访问控制,只应挂载在不对外的地址上,start_web_server通过metrics_port在单独的端口上导出
+    """
+
+    def get(self):
+        if self.get_argument('format', None) == 'json':
+            self.set_header('Content-Type', 'application/json')
+            self.finish(json.dumps(registry.snapshot()))
+        else:
+            self.set_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+            self.finish(registry.exposition())
 
 
 class AsynComponents(fastweb.components.Components):
-    """异步组件类"""
+    """异步组件类
+
+    异步连接池中的组件通过属性访问时返回PendingComponent,第一次调用组件方法时等待空闲连接
+    同一组件并发的第一次使用等待同一次获取,只占用一个连接
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsynComponents, self).__init__(*args, **kwargs)
+        # 组件名称 -> 正在进行的获取
+        self._pending = {}
+
+    def __getattr__(self, name):
+        """获取组件,异步连接池中尚未获取的组件返回PendingComponent
+
+        :parameter:
+          - `name`: 组件名称
+        """
+
+        if name not in self._blacklist and name not in self._components and \
+                fastweb.manager.Manager.is_asyn_pool(name):
+            return fastweb.components.PendingComponent(self, name)
+        return super(AsynComponents, self).__getattr__(name)
+
+    @coroutine
+    def acquire(self, name, timeout=None):
+        """异步获取组件并放入组件缓冲池,之后可以直接通过属性使用该组件
+
+        连接池为空时等待空闲连接,不会阻塞IOLoop
+
+        :parameter:
+          - `name`:组件名称
+          - `timeout`:最大等待时间(秒)
+        """
+
+        component = self._components.get(name)
+
+        if not component:
+            future = self._pending.get(name)
+            if future is None:
+                future = self._pending[name] = fastweb.manager.Manager.acquire_component(name, self, timeout)
+            try:
+                component = yield future
+            finally:
+                if self._pending.get(name) is future:
+                    del self._pending[name]
+
+            if name not in self._components:
+                self._components[name] = component
+                self.recorder('DEBUG', lazy('{obj} acquire component from manager {name} {com}', obj=self,
+                                            name=name,
+                                            com=component))
+        raise Return(component)
+
+    def reset(self, requestid=None):
+        super(AsynComponents, self).reset(requestid)
+        self._pending.clear()
 
     @coroutine
     def http_request(self, request, timeout=None):
@@ -51,7 +176,7 @@ class AsynComponents(fastweb.components.Components):
         self.recorder(
             'INFO', 'http request start\n{request}'.format(request=request))
 
-        with timing('ms', 10) as t:
+        with self.span(('http', request.method), COMPONENT_CALL.labels('http', request.method), 'ms', 10) as t:
             try:
                 response = yield AsyncHTTPClient().fetch(request)
             except HTTPError as ex:
@@ -59,8 +184,8 @@ class AsynComponents(fastweb.components.Components):
                     request=request, e=ex))
                 raise retry
 
-        self.recorder('INFO', 'http request successful\t({response} <{time}>)'.format(
-            response=response.code, time=t))
+        self.recorder('INFO', log_fields(lazy('http request successful\t({response} <{time}>)',
+                                              response=response.code, time=t), 'http', request.method, t))
         raise Return(response)
 
     @coroutine
@@ -125,20 +250,26 @@ class Api(web.RequestHandler, AsynComponents):
         self.requestid = self.get_argument('requestid') \
             if self.get_argument('requestid', None) \
             else self.gen_requestid()
+        inflight.enter(self)
 
         # TODO: 远程ip获取不准确
         self.recorder(
             'IMPORTANT',
-            'Api request\nIp:<{ip}>\nHost:<{host}{uri}\nUserAgent:<{ua}>'.format(
-                ip=self.remoteip,
-                host=self.host,
-                uri=self.uri,
-                ua=self.request.headers.get('User-Agent', 'Fastweb')))
+            lazy('Api request\nIp:<{ip}>\nHost:<{host}{uri}\nUserAgent:<{ua}>', ip=self.remoteip,
+                 host=self.host,
+                 uri=self.uri,
+                 ua=self.request.headers.get('User-Agent', 'Fastweb')))
         self.set_header_json()
 
     def data_received(self, chunk):
         pass
 
+    def on_finish(self):
+        inflight.leave(self)
+
+    def on_connection_close(self):
+        inflight.leave(self)
+
     def log_exception(self, typ, value, tb):
         """日志记录异常,并自动返回系统错误"""
 
@@ -153,16 +284,14 @@ class Api(web.RequestHandler, AsynComponents):
 
         header = 'Access-Control-Allow-Origin'
         self.set_header(header, allow_ip)
-        self.recorder('INFO', 'set header <{key}:{ip}>'.format(
-            key=header, ip=allow_ip))
+        self.recorder('INFO', lazy('set header <{key}:{ip}>', key=header, ip=allow_ip))
 
     def set_header_json(self):
         """设置返回格式为json"""
 
         header = 'Content-type'
         self.add_header(header, 'text/json')
-        self.recorder('INFO', 'set header <{key}:{type}>'.format(
-            key=header, type='text/json'))
+        self.recorder('INFO', lazy('set header <{key}:{type}>', key=header, type='text/json'))
 
     def end(self, code='SUC', status_code=None, log=True, **kwargs):
         """请求结束"""
@@ -181,14 +310,12 @@ class Api(web.RequestHandler, AsynComponents):
         t = (self.request._finish_time-self.request._start_time) * 1000
 
         if log:
-            self.recorder(
-                'IMPORTANT',
-                'Api response\nStatusCode:{sc}\nResponse:<{ret}>\nTime:<{time}ms>'.format(
-                    ret=ret, time=t, sc=status_code))
+            msg = lazy('Api response\nStatusCode:{sc}\nResponse:<{ret}>\nTime:<{time}ms>', ret=ret, time=t,
+                       sc=status_code)
         else:
-            self.recorder(
-                'IMPORTANT',
-                'Api response\nStatusCode:{sc}\nTime:<{time}ms>'.format(time=t, sc=status_code))
+            msg = lazy('Api response\nStatusCode:{sc}\nTime:<{time}ms>', time=t, sc=status_code)
+        self.recorder('IMPORTANT', log_fields(msg, self.__class__.__name__, self.request.method, t))
+        WEB_REQUEST.labels(self.__class__.__name__, self.request.method, status_code).observe(t / 1000)
 
 
 class Page(web.RequestHandler, AsynComponents):
@@ -204,18 +331,24 @@ class Page(web.RequestHandler, AsynComponents):
         self.requestid = self.get_argument('requestid') \
             if self.get_argument('requestid', None) \
             else self.gen_requestid()
+        inflight.enter(self)
 
         self.recorder(
             'IMPORTANT',
-            'Page request\nIp:<{ip}>\nHost:<{host}{uri}\nUserAgent:<{ua}>'.format(
-                ip=self.remoteip,
-                host=self.host,
-                uri=self.uri,
-                ua=self.request.headers['User-Agent']))
+            lazy('Page request\nIp:<{ip}>\nHost:<{host}{uri}\nUserAgent:<{ua}>', ip=self.remoteip,
+                 host=self.host,
+                 uri=self.uri,
+                 ua=self.request.headers['User-Agent']))
 
     def data_received(self, chunk):
         pass
 
+    def on_finish(self):
+        inflight.leave(self)
+
+    def on_connection_close(self):
+        inflight.leave(self)
+
     def log_exception(self, typ, value, tb):
         """日志记录异常"""
 
@@ -235,15 +368,12 @@ class Page(web.RequestHandler, AsynComponents):
         t = (self.request._finish_time - self.request._start_time) * 1000
 
         if log:
-            self.recorder(
-                'IMPORTANT',
-                'Page response\nTemplate:{tem}\nTemArgs:{args}\nTime:<{time}ms>'.format(
-                    tem=template, args=kwargs, time=t))
+            msg = lazy('Page response\nTemplate:{tem}\nTemArgs:{args}\nTime:<{time}ms>', tem=template, args=kwargs,
+                       time=t)
         else:
-            self.recorder(
-                'IMPORTANT',
-                'Page response\nTemplate:{tem}\nTime:<{time}ms>'.format(
-                    tem=template, time=t))
+            msg = lazy('Page response\nTemplate:{tem}\nTime:<{time}ms>', tem=template, time=t)
+        self.recorder('IMPORTANT', log_fields(msg, self.__class__.__name__, self.request.method, t))
+        WEB_REQUEST.labels(self.__class__.__name__, self.request.method, self.get_status()).observe(t / 1000)
 
 
 def arguments(convert=None, **ckargs):
@@ -303,10 +433,53 @@ def arguments(convert=None, **ckargs):
     return _deco
 
 
-def start_web_server(port, handlers, **settings):
-    """启动服务器"""
+def start_web_server(port, handlers, processes=1, drain_timeout=DEFAULT_DRAIN_TIMEOUT, metrics_port=None,
+                     metrics_address=DEFAULT_METRICS_ADDRESS, **settings):
+    """启动服务器
+
+    先绑定监听socket再fork,所有子进程共享同一个socket,子进程中重新创建异步连接池
+    父进程等待并重启异常退出的子进程,收到SIGTERM或SIGINT时通知子进程优雅退出:
+    停止接受新连接,等待正在处理的请求完成后退出
+
+    :parameter:
+      - `port`:监听端口
+      - `handlers`:路由
+      - `processes`:进程数,大于1时预先fork多个子进程,-1为CPU核数
+      - `drain_timeout`:优雅退出时等待请求完成的最长时间(秒)
+      - `metrics_port`:指标导出的端口,路径为/metrics,为None时不导出
+      - `metrics_address`:指标导出的监听地址,默认只监听本机
+      - `settings`:Application配置
+    """
+
     if not app.bRecorder:
         app.load_recorder()
+    app.load_asyn_recorder()
+
+    sockets = bind_sockets(port)
+    metrics_sockets = bind_sockets(metrics_port, metrics_address) if metrics_port is not None else None
+
+    if processes != 1:
+        parent = os.getpid()
+
+        def forward(signum, frame):
+            # 子进程在安装自己的信号处理之前收到信号时直接退出
+            if os.getpid() != parent:
+                os._exit(0)
+            # 父进程和子进程在同一个进程组中,忽略之后再通知整个进程组
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            os.killpg(os.getpgrp(), signal.SIGTERM)
+
+        # 父进程单独成组,通知时只通知父进程和子进程,不影响启动父进程的shell或脚本
+        if os.getpgrp() != os.getpid():
+            os.setpgrp()
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        # 父进程在这里等待并重启异常退出的子进程,所有子进程正常退出后父进程退出
+        fork_processes(processes if processes > 0 else None)
+        # 子进程不能继续使用fork之前创建的IOLoop
+        ioloop.IOLoop().make_current()
+        fastweb.manager.Manager.reset_connection_pools(asyn=True)
 
     application = web.Application(
         handlers,
@@ -315,14 +488,44 @@ def start_web_server(port, handlers, **settings):
 
     http_server = httpserver.HTTPServer(
         application, xheaders=settings.get('xheaders'))
-    http_server.listen(port)
-    recorder('INFO', 'server start on {port}'.format(port=port))
+    http_server.add_sockets(sockets)
+    io_loop = ioloop.IOLoop.current()
+
+    metrics_server = None
+    if metrics_sockets:
+        metrics_server = httpserver.HTTPServer(web.Application([(DEFAULT_METRICS_PATH, MetricsHandler)]))
+        metrics_server.add_sockets(metrics_sockets)
+        recorder('INFO', 'metrics start on {address}:{port}'.format(address=metrics_address, port=metrics_port))
+
+    @coroutine
+    def shutdown():
+        recorder('INFO', 'server stopping on {port}, {count} requests in flight'.format(port=port,
+                                                                                     count=len(inflight)))
+        http_server.stop()
+        if metrics_server:
+            metrics_server.stop()
+        remain = yield inflight.drain(drain_timeout)
+        if remain:
+            recorder('WARN', 'server stop on {port} with {count} requests unfinished'.format(port=port,
+                                                                                            count=remain))
+        yield http_server.close_all_connections()
+        io_loop.stop()
+
+    def graceful(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        io_loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, graceful)
+    signal.signal(signal.SIGINT, graceful)
+
+    recorder('INFO', 'server start on {port} pid <{pid}>'.format(port=port, pid=os.getpid()))
     try:
-        ioloop.IOLoop.current().start()
+        io_loop.start()
     except KeyboardInterrupt:
-        ioloop.IOLoop.current().stop()
-        FThread.stop(0)
-        recorder('INFO', 'server stop on {port}'.format(port=port))
+        io_loop.stop()
+    FThread.stop(0)
+    recorder('INFO', 'server stop on {port}'.format(port=port))
 
 
 def set_error_handler():
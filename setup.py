@@ -41,7 +41,8 @@ setup(
     entry_points={
         'console_scripts': [
             'fasthrift = fastweb.command.service.thrift:gen_thrift_auxiliary',
-            'fast = fastweb.command.fast:main'
+            'fast = fastweb.command.fast:main',
+            'fastlog = fastweb.command.log:main'
         ],
     },
     author='bslience',